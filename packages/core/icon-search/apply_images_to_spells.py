@@ -18,15 +18,15 @@ import json
 import sys
 import time
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
-import faiss
 import numpy as np
-import torch
-from transformers import CLIPModel, CLIPProcessor
+
+from artifacts import load_published
+from search import MODEL_NAME, make_text_embedder
+from text_embedding_cache import TextEmbeddingCache, add_text_cache_arguments, open_text_cache_from_args
 
 
-MODEL_NAME = "openai/clip-vit-base-patch32"
 BATCH_SIZE = 64
 
 # Translation map for common Spanish descriptors to English
@@ -63,25 +63,6 @@ DESCRIPTOR_TRANSLATIONS = {
 }
 
 
-def get_device() -> str:
-    if torch.cuda.is_available():
-        return "cuda"
-    if hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-        return "mps"
-    return "cpu"
-
-
-def load_metadata(metadata_path: str) -> List[dict]:
-    records = []
-    with open(metadata_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                records.append(json.loads(line))
-    records.sort(key=lambda x: x['id'])
-    return records
-
-
 def build_search_query(spell: dict) -> str:
     """
     Build search query using visualdescription (ultra short, visual-focused).
@@ -98,32 +79,12 @@ def build_search_query(spell: dict) -> str:
     return spell.get('name', '')
 
 
-def get_text_embeddings_batch(
-    processor: CLIPProcessor,
-    model: CLIPModel,
-    texts: List[str],
-    device: str
-) -> np.ndarray:
-    """Get normalized text embeddings for a batch of queries."""
-    inputs = processor(text=texts, return_tensors="pt", padding=True, truncation=True)
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-    
-    with torch.no_grad():
-        outputs = model.get_text_features(**inputs)
-    
-    embeddings = outputs.cpu().numpy().astype(np.float32)
-    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
-    norms = np.where(norms == 0, 1, norms)
-    embeddings = embeddings / norms
-    
-    return embeddings
-
-
 def process_spells(
     spells_dir: str,
     index_path: str,
     metadata_path: str,
-    dry_run: bool = False
+    dry_run: bool = False,
+    text_cache: Optional[TextEmbeddingCache] = None
 ) -> None:
     """Process all spell files with batch optimization."""
     
@@ -141,15 +102,14 @@ def process_spells(
     
     # Load index and metadata
     print("Loading FAISS index and metadata...")
-    index = faiss.read_index(index_path)
-    metadata = load_metadata(metadata_path)
+    try:
+        index, metadata, _ = load_published(index_path, metadata_path)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
     
-    # Load CLIP model
-    device = get_device()
-    print(f"Loading CLIP model (device: {device})...")
-    processor = CLIPProcessor.from_pretrained(MODEL_NAME)
-    model = CLIPModel.from_pretrained(MODEL_NAME).to(device)
-    model.eval()
+    # Cached descriptions skip the model; it is loaded on the first miss
+    embed = make_text_embedder(text_cache)
     
     # Load all spells
     print("Loading spell files...")
@@ -177,7 +137,7 @@ def process_spells(
     
     for i in range(0, len(all_queries), BATCH_SIZE):
         batch_queries = all_queries[i:i + BATCH_SIZE]
-        batch_embeddings = get_text_embeddings_batch(processor, model, batch_queries, device)
+        batch_embeddings = embed(batch_queries)
         all_embeddings.append(batch_embeddings)
         
         progress = min(i + BATCH_SIZE, len(all_queries))
@@ -200,7 +160,7 @@ def process_spells(
     for i, (spell_file, spell, query) in enumerate(spells_data):
         try:
             idx = indices[i][0]
-            if idx >= 0 and idx < len(metadata):
+            if idx >= 0 and idx in metadata:
                 image_path = metadata[idx]['path']
                 spell['image'] = image_path
                 
@@ -223,6 +183,9 @@ def process_spells(
     print(f"  Updated: {updated}")
     print(f"  Errors: {errors}")
     print(f"  Time elapsed: {elapsed:.1f}s")
+    if text_cache is not None:
+        stats = text_cache.stats()
+        print(f"  Text cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%})")
     if dry_run:
         print(f"  (DRY RUN - no files were modified)")
     print(f"{'='*50}")
@@ -255,15 +218,22 @@ def main():
         action="store_true",
         help="Don't modify files, just show what would be done"
     )
+    add_text_cache_arguments(parser)
     
     args = parser.parse_args()
     
-    process_spells(
-        spells_dir=args.spells_dir,
-        index_path=args.index,
-        metadata_path=args.metadata,
-        dry_run=args.dry_run
-    )
+    text_cache = open_text_cache_from_args(args, MODEL_NAME)
+    try:
+        process_spells(
+            spells_dir=args.spells_dir,
+            index_path=args.index,
+            metadata_path=args.metadata,
+            dry_run=args.dry_run,
+            text_cache=text_cache
+        )
+    finally:
+        if text_cache is not None:
+            text_cache.close()
 
 
 if __name__ == "__main__":
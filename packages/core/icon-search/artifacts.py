@@ -0,0 +1,262 @@
+"""
+Versioned, atomically published index artifacts.
+
+Every build writes faiss.index, its sidecar, metadata.jsonl and
+metadata.bin into a fresh directory under out_dir/versions, together
+with index_manifest.json (model, dimension, count, index type, sizes and
+checksums, created_at). The directory is renamed into place once
+complete and then published by atomically replacing the out_dir/current
+symlink. out_dir/faiss.index, faiss.index.json, metadata.jsonl and
+metadata.bin are fixed symlinks through current, so existing
+--index/--metadata paths keep working.
+
+The build state incremental runs start from (embeddings.npy and
+build_manifest.json) lives in the version directory too and is linked
+the same way, so a crash at any point leaves out_dir with the manifest
+and embeddings of one and the same build.
+
+A reader that opens the index and then the metadata separately could
+straddle a publish. load_published() therefore resolves current once,
+pins both files to that version and checks the manifest's recorded sizes
+and counts instead of re-hashing anything.
+Old versions beyond --keep_versions are pruned after each publish.
+"""
+
+import argparse
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Mapping, Optional, Tuple
+
+import faiss
+
+from build_manifest import MANIFEST_FILENAME, hash_file
+from build_profile import profile_stage
+from embedding_store import EMBEDDINGS_FILENAME
+from faiss_index import load_index
+from metadata_store import METADATA_BIN_FILENAME, load_metadata as load_metadata_store
+
+
+VERSIONS_DIRNAME = "versions"
+CURRENT_LINK = "current"
+ARTIFACT_MANIFEST_FILENAME = "index_manifest.json"
+ARTIFACT_MANIFEST_VERSION = 1
+INDEX_FILENAME = "faiss.index"
+METADATA_FILENAME = "metadata.jsonl"
+# Files linked from out_dir through current (the index sidecar included)
+PUBLISHED_FILES = (INDEX_FILENAME, INDEX_FILENAME + ".json", METADATA_FILENAME, METADATA_BIN_FILENAME)
+# Also linked through current, but not in index_manifest.json: searches
+# never read them, and hashing the embedding matrix would slow every build
+BUILD_STATE_FILES = (EMBEDDINGS_FILENAME, MANIFEST_FILENAME)
+PARTIAL_SUFFIX = ".partial"
+DEFAULT_KEEP_VERSIONS = 3
+
+
+def add_version_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--keep_versions",
+        type=int,
+        default=DEFAULT_KEEP_VERSIONS,
+        help=f"Published index versions kept in out_dir/versions (default: {DEFAULT_KEEP_VERSIONS})"
+    )
+
+
+def versions_dir_for(out_path: Path) -> Path:
+    return out_path / VERSIONS_DIRNAME
+
+
+def new_version_dir(out_path: Path) -> Path:
+    """Create an empty work directory for the next version."""
+    name = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    version_dir = versions_dir_for(out_path) / (name + PARTIAL_SUFFIX)
+    version_dir.mkdir(parents=True)
+    return version_dir
+
+
+def discard_version(partial_dir: Path) -> None:
+    """Delete a work directory whose build failed before it was finalized."""
+    shutil.rmtree(partial_dir, ignore_errors=True)
+
+
+def finalize_version(partial_dir: Path, info: dict) -> Path:
+    """
+    Write index_manifest.json for the files in a work directory and rename
+    it to its final version name.
+
+    info holds model, dim, count and index_type.
+    """
+    files = {}
+    for filename in PUBLISHED_FILES:
+        path = partial_dir / filename
+        files[filename] = {"size": path.stat().st_size, "sha256": hash_file(path)}
+
+    manifest = {
+        "version": ARTIFACT_MANIFEST_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        **info,
+        "files": files,
+    }
+    with open(partial_dir / ARTIFACT_MANIFEST_FILENAME, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    version_dir = partial_dir.with_name(partial_dir.name[:-len(PARTIAL_SUFFIX)])
+    os.replace(partial_dir, version_dir)
+    return version_dir
+
+
+def _replace_symlink(link_path: Path, target: str) -> None:
+    """Point link_path at target atomically (rename over the old link or file)."""
+    tmp_link = link_path.with_name(link_path.name + '.tmp')
+    if tmp_link.is_symlink() or tmp_link.exists():
+        tmp_link.unlink()
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link_path)
+
+
+def publish_version(out_path: Path, version_dir: Path) -> None:
+    """Make version_dir the current version."""
+    _replace_symlink(out_path / CURRENT_LINK, os.path.join(VERSIONS_DIRNAME, version_dir.name))
+
+    # Stable entry points; also migrates files written by older builds
+    for filename in PUBLISHED_FILES + BUILD_STATE_FILES:
+        if filename in BUILD_STATE_FILES and not (version_dir / filename).exists():
+            continue
+        link_path = out_path / filename
+        target = os.path.join(CURRENT_LINK, filename)
+        if not (link_path.is_symlink() and os.readlink(link_path) == target):
+            _replace_symlink(link_path, target)
+
+
+def current_version_dir(out_path: Path) -> Optional[Path]:
+    current = out_path / CURRENT_LINK
+    if not current.exists():
+        return None
+    return Path(os.path.realpath(current))
+
+
+def prune_versions(out_path: Path, keep: int) -> int:
+    """Delete all but the newest keep versions (never the current one) and stale work dirs."""
+    versions_dir = versions_dir_for(out_path)
+    if not versions_dir.exists():
+        return 0
+
+    current = current_version_dir(out_path)
+    versions = sorted(
+        (path for path in versions_dir.iterdir() if path.is_dir() and not path.name.endswith(PARTIAL_SUFFIX)),
+        key=lambda path: path.name,
+        reverse=True
+    )
+    doomed = [path for path in versions[max(keep, 1):] if path != current]
+    # Leftovers of interrupted builds
+    doomed += [path for path in versions_dir.glob("*" + PARTIAL_SUFFIX) if path.is_dir()]
+
+    for path in doomed:
+        shutil.rmtree(path, ignore_errors=True)
+    return len(doomed)
+
+
+def load_artifact_manifest(version_dir: Path) -> Optional[dict]:
+    manifest_path = version_dir / ARTIFACT_MANIFEST_FILENAME
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != ARTIFACT_MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def resolve_artifacts(index_path, metadata_path) -> Tuple[Path, Path, Optional[dict]]:
+    """
+    Pin the index and metadata to one published version.
+
+    Follows the symlinks of index_path once. When it lands in a version
+    directory, its metadata.jsonl (and metadata.bin beside it) is used
+    whenever metadata_path is the published one (of any version), and the
+    file sizes are checked against the manifest. Unversioned files are returned unchanged with
+    no manifest.
+
+    Returns:
+        Tuple (index_path, metadata_path, manifest)
+
+    Raises:
+        ValueError: when the files do not match their manifest
+    """
+    real_index = Path(os.path.realpath(index_path))
+    version_dir = real_index.parent
+    manifest = load_artifact_manifest(version_dir)
+    if manifest is None:
+        return Path(index_path), Path(metadata_path), None
+
+    real_metadata = Path(os.path.realpath(metadata_path))
+    if real_metadata.name == METADATA_FILENAME and real_metadata.parent.parent == version_dir.parent:
+        real_metadata = version_dir / METADATA_FILENAME
+
+    # Versions published before metadata.bin existed do not list it
+    for filename in manifest['files']:
+        path = version_dir / filename
+        if filename in (METADATA_FILENAME, METADATA_BIN_FILENAME) and real_metadata.parent != version_dir:
+            continue
+        expected = manifest['files'][filename]['size']
+        if not path.exists() or path.stat().st_size != expected:
+            raise ValueError(f"{path} does not match {version_dir / ARTIFACT_MANIFEST_FILENAME}")
+
+    return real_index, real_metadata, manifest
+
+
+def published_store_path(index_path: Path, metadata_path: Path, manifest: Optional[dict]) -> Optional[Path]:
+    """
+    The metadata.bin to map instead of parsing metadata_path, or None.
+
+    Only the published metadata.jsonl of the index's version qualifies, and
+    only when that version's manifest lists both files; any other JSONL is
+    read as the caller asked.
+    """
+    if manifest is None or metadata_path.name != METADATA_FILENAME:
+        return None
+    if metadata_path.parent != index_path.parent:
+        return None
+    if METADATA_FILENAME not in manifest['files'] or METADATA_BIN_FILENAME not in manifest['files']:
+        return None
+    return metadata_path.with_name(METADATA_BIN_FILENAME)
+
+
+def validate_loaded(manifest: Optional[dict], index_count: int, metadata: Mapping[int, dict]) -> None:
+    """Check the loaded index and metadata against the manifest counts."""
+    if manifest is None:
+        return
+    if index_count != manifest['count']:
+        raise ValueError(f"Index has {index_count} vectors, manifest expects {manifest['count']}")
+    if len(metadata) != manifest['count']:
+        raise ValueError(f"Metadata has {len(metadata)} records, manifest expects {manifest['count']}")
+
+
+def load_published(
+    index_path,
+    metadata_path,
+    load_metadata: Callable[..., Mapping[int, dict]] = load_metadata_store,
+    mmap: bool = False
+) -> Tuple[faiss.Index, Mapping[int, dict], Optional[dict]]:
+    """
+    Load an index and its metadata from one version and validate them.
+
+    The metadata is memory-mapped from metadata.bin when metadata_path is
+    the published metadata.jsonl and the version lists both (see
+    published_store_path), else parsed from metadata_path. mmap=True
+    also maps the index read-only (see faiss_index.load_index).
+
+    Returns:
+        Tuple (index, metadata, manifest); manifest is None for unversioned files
+
+    Raises:
+        ValueError: when the files do not match their manifest
+    """
+    index_path, metadata_path, manifest = resolve_artifacts(index_path, metadata_path)
+    with profile_stage("index_load"):
+        index = load_index(index_path, mmap=mmap)
+    with profile_stage("metadata_load"):
+        metadata = load_metadata(str(metadata_path), published_store_path(index_path, metadata_path, manifest))
+    validate_loaded(manifest, index.ntotal, metadata)
+    return index, metadata, manifest
@@ -0,0 +1,197 @@
+"""
+Checkpoint shards for resumable and multi-process index builds.
+
+A build streams embeddings into a memory-mapped store (embeddings.npy)
+inside its checkpoint directory, and every N batches flushes the store
+and writes the file records of those batches as a numbered shard. Rows
+of the store follow the order of the records across shards. A shard is
+renamed into place only after the store is flushed, so a crash mid-write
+never leaves a shard that --resume would trust without its vectors.
+Records keep each file's size, mtime and sha256, and --resume embeds
+again any file that changed after it was checkpointed.
+
+In --num_shards mode each process writes its store and shards to its own
+part directory and marks it done with part.json; merge_shards.py stitches
+the parts together in order.
+"""
+
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from embedding_store import CHUNK_ROWS
+
+
+CHECKPOINT_DIRNAME = ".build_checkpoint"
+CHECKPOINT_STATE_FILENAME = "checkpoint.json"
+PARTS_DIRNAME = "parts"
+PART_MARKER_FILENAME = "part.json"
+
+
+def checkpoint_dir_for(out_path: Path) -> Path:
+    return out_path / CHECKPOINT_DIRNAME
+
+
+def parts_dir_for(out_path: Path) -> Path:
+    return out_path / PARTS_DIRNAME
+
+
+def part_dir_for(out_path: Path, shard_id: int, num_shards: int) -> Path:
+    return parts_dir_for(out_path) / f"part-{shard_id:03d}-of-{num_shards:03d}"
+
+
+def shard_bounds(total: int, num_shards: int, shard_id: int) -> Tuple[int, int]:
+    """Contiguous [start, end) slice of the sorted image list owned by a shard."""
+    start = total * shard_id // num_shards
+    end = total * (shard_id + 1) // num_shards
+    return start, end
+
+
+def _shard_path(checkpoint_dir: Path, shard_index: int) -> Path:
+    return checkpoint_dir / f"shard_{shard_index:05d}.jsonl"
+
+
+def open_checkpoint(checkpoint_dir: Path, model_name: str, resume: bool) -> bool:
+    """
+    Prepare a checkpoint (or part) directory for a build.
+
+    Existing shards are kept only when resuming a build made with the same
+    model; otherwise the directory is cleared.
+
+    Returns:
+        True when existing shards were kept for resuming
+    """
+    state_path = checkpoint_dir / CHECKPOINT_STATE_FILENAME
+
+    if resume and state_path.exists():
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('model') == model_name:
+            return True
+        print(f"Checkpoint was built with model {state.get('model')}, starting over")
+
+    remove_checkpoint(checkpoint_dir)
+    checkpoint_dir.mkdir(parents=True)
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump({"model": model_name}, f)
+    return False
+
+
+def write_shard(
+    checkpoint_dir: Path,
+    shard_index: int,
+    file_records: List[dict],
+    corrupted: List[str]
+) -> None:
+    """Write the records of one shard; flush the embedding store first."""
+    records_path = _shard_path(checkpoint_dir, shard_index)
+
+    tmp_records = records_path.with_suffix('.jsonl.tmp')
+    with open(tmp_records, 'w', encoding='utf-8') as f:
+        for record in file_records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        for path in corrupted:
+            f.write(json.dumps({"path": path, "corrupted": True}, ensure_ascii=False) + '\n')
+    os.replace(tmp_records, records_path)
+
+
+def load_shards(checkpoint_dir: Path) -> Tuple[List[dict], List[str], int]:
+    """
+    Load the records of every complete shard in order.
+
+    Returns:
+        Tuple (file_records, corrupted_paths, next_shard_index)
+        file_records[i] owns row i of the checkpoint's embedding store.
+    """
+    file_records = []
+    corrupted = []
+    shard_index = 0
+
+    while True:
+        records_path = _shard_path(checkpoint_dir, shard_index)
+        if not records_path.exists():
+            break
+
+        with open(records_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if record.get('corrupted'):
+                    corrupted.append(record['path'])
+                else:
+                    file_records.append(record)
+        shard_index += 1
+
+    return file_records, corrupted, shard_index
+
+
+def drop_records(
+    checkpoint_dir: Path,
+    store: np.memmap,
+    file_records: List[dict],
+    corrupted: List[str],
+    drop_rows: List[int]
+) -> Tuple[List[dict], int]:
+    """
+    Remove records (by row) and their vectors from a checkpoint.
+
+    Kept rows move up so file_records[i] still owns row i of the store, and
+    every shard is replaced by a single one. The state file is removed
+    meanwhile, so a crash here makes the next --resume start over instead
+    of trusting misaligned rows.
+
+    Returns:
+        Tuple (file_records, next_shard_index)
+    """
+    state_path = checkpoint_dir / CHECKPOINT_STATE_FILENAME
+    with open(state_path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    state_path.unlink()
+
+    dropped = set(drop_rows)
+    kept_rows = [row for row in range(len(file_records)) if row not in dropped]
+    # Targets never pass their sources, so ascending chunks are safe in place
+    for start in range(0, len(kept_rows), CHUNK_ROWS):
+        rows = kept_rows[start:start + CHUNK_ROWS]
+        store[start:start + len(rows)] = store[rows]
+    store.flush()
+
+    kept_records = [file_records[row] for row in kept_rows]
+    shard_index = 0
+    while _shard_path(checkpoint_dir, shard_index).exists():
+        shard_index += 1
+    for index in range(shard_index - 1, 0, -1):
+        _shard_path(checkpoint_dir, index).unlink()
+    write_shard(checkpoint_dir, 0, kept_records, corrupted)
+
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    return kept_records, 1
+
+
+def write_part_marker(part_dir: Path, part_info: dict) -> None:
+    """Mark a --num_shards part as complete."""
+    marker_path = part_dir / PART_MARKER_FILENAME
+    tmp_path = marker_path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(part_info, f)
+    os.replace(tmp_path, marker_path)
+
+
+def load_part_marker(part_dir: Path) -> Optional[dict]:
+    marker_path = part_dir / PART_MARKER_FILENAME
+    if not marker_path.exists():
+        return None
+    with open(marker_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def remove_checkpoint(checkpoint_dir: Path) -> None:
+    if checkpoint_dir.exists():
+        shutil.rmtree(checkpoint_dir)
@@ -0,0 +1,144 @@
+"""
+File manifest for incremental index builds.
+
+Records (relative path, size, mtime, content hash, index id) for every
+indexed image together with the model that embedded it, so index_build.py
+can re-embed only files that were added or changed since the last build.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+MANIFEST_FILENAME = "build_manifest.json"
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def hash_bytes(data: bytes) -> str:
+    """Content hash used to detect changed files."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path: Path) -> str:
+    """Content hash of a file on disk, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(out_path: Path) -> Optional[dict]:
+    """Load the manifest from out_path, or None if missing or unreadable."""
+    manifest_path = out_path / MANIFEST_FILENAME
+    if not manifest_path.exists():
+        return None
+
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(
+    out_path: Path,
+    model_name: str,
+    files: Dict[str, dict],
+    dedup_options: Optional[dict] = None
+) -> Path:
+    """
+    Write the manifest atomically.
+
+    files maps relative path -> {"id", "size", "mtime", "sha256"}.
+    dedup_options (see dedup.add_dedup_arguments) are kept so incremental
+    builds collapse duplicates the same way.
+    """
+    manifest_path = out_path / MANIFEST_FILENAME
+    next_id = max((entry['id'] for entry in files.values()), default=-1) + 1
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "model": model_name,
+        "next_id": next_id,
+        "dedup": dedup_options or {"mode": "none"},
+        "files": files,
+    }
+
+    tmp_path = manifest_path.with_suffix('.json.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+    return manifest_path
+
+
+def refresh_entry(full_path: Path, entry: dict) -> Optional[dict]:
+    """
+    The entry with the file's current size and mtime if its content still
+    matches entry's sha256, else None (changed, missing or unreadable).
+
+    Files whose size and mtime match are trusted without reading them;
+    otherwise the content hash decides, so a touched-but-identical file
+    is not re-embedded.
+    """
+    try:
+        stat = full_path.stat()
+    except OSError:
+        return None
+
+    if stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+        return entry
+
+    try:
+        content_hash = hash_file(full_path)
+    except OSError:
+        return None
+
+    if content_hash != entry['sha256']:
+        return None
+    return dict(entry, size=stat.st_size, mtime=stat.st_mtime)
+
+
+def diff_against_manifest(
+    manifest_files: Dict[str, dict],
+    assets_path: Path,
+    image_infos: List[Tuple[str, str]]
+) -> Tuple[Dict[str, dict], List[Tuple[str, str]], List[int]]:
+    """
+    Compare the current asset tree with the manifest (see refresh_entry).
+
+    Returns:
+        Tuple (unchanged, to_embed, removed_ids)
+        unchanged maps relative path -> refreshed manifest entry
+        to_embed lists (relative_path, category) of added or changed files
+        removed_ids lists index ids of files that no longer exist
+    """
+    unchanged = {}
+    to_embed = []
+    current_paths = set()
+
+    for rel_path, category in image_infos:
+        current_paths.add(rel_path)
+        entry = manifest_files.get(rel_path)
+        if entry is None:
+            to_embed.append((rel_path, category))
+            continue
+
+        refreshed = refresh_entry(assets_path / rel_path, entry)
+        if refreshed is not None:
+            unchanged[rel_path] = refreshed
+        else:
+            to_embed.append((rel_path, category))
+
+    removed_ids = [
+        entry['id'] for path, entry in manifest_files.items()
+        if path not in current_paths
+    ]
+    return unchanged, to_embed, removed_ids
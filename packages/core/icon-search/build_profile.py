@@ -0,0 +1,176 @@
+"""
+Per-stage timing for index builds.
+
+index_build.py and merge_shards.py wrap each stage of the pipeline in
+profile_stage(); every call (usually one batch) is timed and counted. At
+the end of a build print_report() shows a table and write_report()
+stores the same numbers as build_profile.json next to the index, so slow
+rebuilds can be attributed to disk, decode or model time and compared
+between versions. search.py uses the same timer for its --timings
+breakdown of startup phases, and clip_server.py observes the stages it
+runs to export them as metrics.
+
+Decode-side stages (read, hash, decode, preprocess) run on several
+worker threads at once, so their cumulative time can exceed the wall
+time of the build.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+
+
+PROFILE_FILENAME = "build_profile.json"
+# Report order; stages not listed here follow in first-seen order
+STAGE_ORDER = (
+    "imports",
+    "walk",
+    "index_load",
+    "metadata_load",
+    "searcher",
+    "filter_compile",
+    "text_cache_lookup",
+    "model_load",
+    "tokenize",
+    "read",
+    "hash",
+    "cache_lookup",
+    "decode",
+    "preprocess",
+    "forward",
+    "normalize",
+    "cache_store",
+    "store_write",
+    "checkpoint",
+    "dedup",
+    "faiss_train",
+    "faiss_add",
+    "serialize",
+    "text_encode",
+    "text_cache_store",
+    "search",
+    "output",
+)
+
+_lock = threading.Lock()
+_durations: Dict[str, List[float]] = {}
+_items: Dict[str, int] = {}
+_started = time.perf_counter()
+_suspended = 0
+# Called with (name, seconds, items) for every timed call, even while suspended
+_observers: List[Callable[[str, float, int], None]] = []
+
+
+def reset_profile() -> None:
+    """Forget every recorded stage and restart the wall clock."""
+    global _started
+    with _lock:
+        _durations.clear()
+        _items.clear()
+        _started = time.perf_counter()
+
+
+def add_stage_observer(observer: Callable[[str, float, int], None]) -> None:
+    """
+    Also pass every timed call to observer, from the thread that made it.
+    Observers see calls made while profiling is suspended.
+    """
+    with _lock:
+        _observers.append(observer)
+
+
+def record_stage(name: str, seconds: float, items: int = 1) -> None:
+    for observer in _observers:
+        observer(name, seconds, items)
+    with _lock:
+        if _suspended:
+            return
+        _durations.setdefault(name, []).append(seconds)
+        _items[name] = _items.get(name, 0) + items
+
+
+@contextmanager
+def profile_stage(name: str, items: int = 1) -> Iterator[None]:
+    """Time one call of a stage that processes items items."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start, items)
+
+
+@contextmanager
+def profiling_suspended() -> Iterator[None]:
+    """Do not record anything inside the block (e.g. one-off comparisons)."""
+    global _suspended
+    with _lock:
+        _suspended += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _suspended -= 1
+
+
+def summary() -> dict:
+    """Counts, cumulative time and per-call percentiles of every stage."""
+    with _lock:
+        durations = {name: list(values) for name, values in _durations.items()}
+        items = dict(_items)
+        wall = time.perf_counter() - _started
+
+    order = [name for name in STAGE_ORDER if name in durations]
+    order += [name for name in durations if name not in STAGE_ORDER]
+
+    stages = {}
+    for name in order:
+        values = np.array(durations[name])
+        stages[name] = {
+            "calls": len(values),
+            "items": items[name],
+            "total_s": round(float(values.sum()), 4),
+            "p50_ms": round(float(np.percentile(values, 50)) * 1000, 3),
+            "p95_ms": round(float(np.percentile(values, 95)) * 1000, 3),
+            "ms_per_item": round(float(values.sum()) * 1000 / items[name], 4) if items[name] else 0.0,
+        }
+    return {"wall_s": round(wall, 4), "stages": stages}
+
+
+def print_report(report: Optional[dict] = None) -> None:
+    """Print the stage table."""
+    report = report or summary()
+    wall = max(report['wall_s'], 1e-9)
+
+    print(f"\nBuild profile (p50/p95 per call, usually one batch):")
+    print(f"  {'stage':<13}{'calls':>7}{'items':>9}{'total s':>10}{'% wall':>8}{'p50 ms':>10}{'p95 ms':>10}{'ms/item':>10}")
+    for name, stats in report['stages'].items():
+        print(
+            f"  {name:<13}{stats['calls']:>7}{stats['items']:>9}{stats['total_s']:>10.2f}"
+            f"{stats['total_s'] / wall:>8.0%}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+            f"{stats['ms_per_item']:>10.3f}"
+        )
+    print(f"  {'wall':<13}{'':>7}{'':>9}{report['wall_s']:>10.2f}")
+
+
+def write_report(out_dir: Path, context: dict, report: Optional[dict] = None) -> Path:
+    """Write build_profile.json (stage table plus build context) into out_dir."""
+    report = report or summary()
+    document = {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        **context,
+        **report,
+    }
+
+    profile_path = Path(out_dir) / PROFILE_FILENAME
+    tmp_path = profile_path.with_name(profile_path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(document, f, indent=2)
+    os.replace(tmp_path, profile_path)
+    return profile_path
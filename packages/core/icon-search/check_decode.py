@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Check that the reduced-resolution decode used by index_build.py yields
+the same embeddings as the decode existing indexes were built with
+(native resolution, plain convert("RGB")).
+
+Embeds a sample of images with both and reports cosine similarity and
+decode + preprocess time. A native-resolution decode with the new alpha
+handling is reported too, to tell resolution differences from alpha
+ones. Exits with status 1 if any image falls below --min_cosine against
+the legacy decode.
+
+Usage:
+    python check_decode.py --assets_root "/path/to/images" --samples 200
+"""
+
+import os
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from image_decode import decode_full, decode_legacy, decode_reduced
+from index_build import collect_image_paths, embed_batch, get_device, load_model
+
+
+DEFAULT_MIN_COSINE = 0.99
+
+
+def prepare_timed(processor, decode, data_list: List[bytes], batch_size: int) -> Tuple[list, list, float]:
+    """Decode and preprocess in batches, timing both together as index_build.py does."""
+    images = []
+    batches = []
+    start = time.perf_counter()
+    for i in range(0, len(data_list), batch_size):
+        batch_images = [decode(data) for data in data_list[i:i + batch_size]]
+        batches.append(processor(images=batch_images, return_tensors="pt")["pixel_values"])
+        images.extend(batch_images)
+    return images, batches, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare reduced-resolution and full decode embeddings"
+    )
+    parser.add_argument(
+        "--assets_root",
+        type=str,
+        required=True,
+        help="Root directory containing images"
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=200,
+        help="Number of images to compare (default: 200, 0 for all)"
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="Batch size for embedding (default: 32)"
+    )
+    parser.add_argument(
+        "--min_cosine",
+        type=float,
+        default=DEFAULT_MIN_COSINE,
+        help=f"Minimum cosine similarity per image (default: {DEFAULT_MIN_COSINE})"
+    )
+
+    args = parser.parse_args()
+
+    assets_path = Path(args.assets_root)
+    if not assets_path.exists():
+        print(f"Error: Assets root does not exist: {assets_path}", file=sys.stderr)
+        sys.exit(1)
+
+    image_infos = collect_image_paths(args.assets_root)
+    if args.samples and len(image_infos) > args.samples:
+        image_infos = sorted(random.Random(0).sample(image_infos, args.samples))
+
+    # Unreadable files are skipped: index_build.py reports them anyway
+    paths = []
+    data_list = []
+    corrupt = 0
+    for rel_path, _ in image_infos:
+        try:
+            data = (assets_path / rel_path).read_bytes()
+            decode_legacy(data)
+        except Exception:
+            corrupt += 1
+            continue
+        paths.append(rel_path)
+        data_list.append(data)
+
+    if not paths:
+        print("Error: No readable images found", file=sys.stderr)
+        sys.exit(1)
+
+    device = get_device()
+    processor, model, _ = load_model(device)
+
+    print(f"\nComparing {len(paths)} images...")
+    legacy_images, legacy_batches, legacy_time = prepare_timed(processor, decode_legacy, data_list, args.batch_size)
+    _, full_batches, _ = prepare_timed(processor, decode_full, data_list, args.batch_size)
+    _, reduced_batches, reduced_time = prepare_timed(processor, decode_reduced, data_list, args.batch_size)
+
+    similarities = []
+    full_similarities = []
+    for legacy_batch, full_batch, reduced_batch in zip(legacy_batches, full_batches, reduced_batches):
+        legacy_emb = embed_batch(model, legacy_batch, device)
+        full_emb = embed_batch(model, full_batch, device)
+        reduced_emb = embed_batch(model, reduced_batch, device)
+        similarities.extend(np.sum(legacy_emb * reduced_emb, axis=1).tolist())
+        full_similarities.extend(np.sum(full_emb * reduced_emb, axis=1).tolist())
+
+    similarities = np.array(similarities)
+    full_similarities = np.array(full_similarities)
+    order = np.argsort(similarities)
+    failures = int(np.sum(similarities < args.min_cosine))
+
+    print(f"\n{'='*50}")
+    print(f"Decode equivalence check")
+    print(f"  Images compared: {len(paths)}")
+    print(f"  Unreadable (skipped): {corrupt}")
+    print(f"  Cosine vs legacy decode min / mean: {similarities.min():.5f} / {similarities.mean():.5f}")
+    print(f"  Cosine vs full decode (same alpha handling) min / mean: "
+          f"{full_similarities.min():.5f} / {full_similarities.mean():.5f}")
+    print(f"  Decode + preprocess legacy: {legacy_time:.2f}s")
+    print(f"  Decode + preprocess reduced: {reduced_time:.2f}s ({legacy_time / max(reduced_time, 1e-9):.1f}x)")
+    print(f"  Below {args.min_cosine} vs legacy: {failures}")
+    print(f"{'='*50}")
+
+    print("\nLeast similar to the legacy decode (vs full decode in brackets):")
+    for position in order[:5]:
+        size = legacy_images[position].size
+        print(
+            f"  {similarities[position]:.5f} [{full_similarities[position]:.5f}]  "
+            f"{paths[position]} ({size[0]}x{size[1]})"
+        )
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
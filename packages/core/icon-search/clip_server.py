@@ -8,49 +8,195 @@ Usage:
     python3 clip_server.py
     
 Then access at http://localhost:8000
+
+Concurrent /search requests are micro-batched: queries that arrive within
+CLIP_BATCH_WINDOW_MS of each other (up to CLIP_MAX_BATCH_SIZE) share one
+text encoder forward pass and one FAISS search per distinct filter.
+Batches run on a bounded inference executor (CLIP_INFERENCE_WORKERS
+threads, each limited to CLIP_THREADS_PER_WORKER torch/FAISS threads), so
+the event loop and /health stay responsive while the model works; when
+more than CLIP_MAX_PENDING queries are waiting, new ones get a 503.
+
+Repeated queries are answered from in-process LRU caches of embeddings and
+results (see query_cache.py) without touching the model or FAISS;
+GET /cache/stats reports their hit rates and memory.
+
+POST /admin/reload (and, with CLIP_WATCH_INTERVAL_S, a watcher of the index
+file) loads a newly published index and metadata in the background and
+swaps them in atomically; requests already running finish on the old
+ones and the model is not reloaded.
+
+POST /search/batch answers up to CLIP_MAX_BATCH_QUERIES queries per request
+with one forward pass and one FAISS search per distinct filter.
+
+GET/POST /similar ("more like this") searches with the stored vector of an
+indexed image, given by path or id, without running the text encoder.
+
+GET /metrics exports Prometheus metrics: request counts, errors, latency
+and in-flight requests per endpoint, latency histograms per query stage
+(queue wait, tokenize, text encode, filter, FAISS search, serialize),
+batch sizes, cache hit rates, index size and process memory.
 """
 
 import os
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
 
-import json
+import asyncio
+import copy
+import hashlib
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Optional
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import faiss
 import numpy as np
-import torch
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from transformers import CLIPModel, CLIPProcessor
+from starlette.routing import Match
+
+from artifacts import load_published, resolve_artifacts
+from build_profile import add_stage_observer, profile_stage, profiling_suspended
+from filtered_search import FilteredSearcher, filter_key, merge_category_filter
+from metadata_store import iter_paths
+from query_cache import EmbeddingLRUCache, LRUCache
+from search import MODEL_NAME, build_results, get_text_embeddings, load_text_model, search_batch
+from server_metrics import (
+    BATCH_SIZE_BUCKETS,
+    CONTENT_TYPE,
+    MetricsRegistry,
+    process_peak_rss_bytes,
+    process_rss_bytes,
+)
+from text_embedding_cache import normalize_text
 
 # =============================================================================
 # Configuration
 # =============================================================================
 
-MODEL_NAME = "openai/clip-vit-base-patch32"
 DEFAULT_INDEX_PATH = "data/faiss.index"
 DEFAULT_METADATA_PATH = "data/metadata.jsonl"
+# Micro-batching: how long the first query of a batch waits for others,
+# and the most queries encoded together
+BATCH_WINDOW_MS = float(os.environ.get('CLIP_BATCH_WINDOW_MS', 5))
+MAX_BATCH_SIZE = int(os.environ.get('CLIP_MAX_BATCH_SIZE', 32))
+# Inference executor: batches run at once, and the torch/FAISS threads each
+# may use (by default the cores are split between workers)
+INFERENCE_WORKERS = max(1, int(os.environ.get('CLIP_INFERENCE_WORKERS', 1)))
+THREADS_PER_WORKER = max(1, int(os.environ.get(
+    'CLIP_THREADS_PER_WORKER', (os.cpu_count() or 1) // INFERENCE_WORKERS
+)))
+# Queries waiting for a slot before new ones are rejected with 503
+MAX_PENDING = int(os.environ.get('CLIP_MAX_PENDING', 256))
+# Query caches: size of each level and entry lifetime (0 = until evicted)
+EMBEDDING_CACHE_MB = float(os.environ.get('CLIP_EMBEDDING_CACHE_MB', 16))
+RESULT_CACHE_MB = float(os.environ.get('CLIP_RESULT_CACHE_MB', 32))
+CACHE_TTL_SECONDS = float(os.environ.get('CLIP_CACHE_TTL_S', 3600))
+# Queries accepted by one POST /search/batch request
+MAX_BATCH_QUERIES = int(os.environ.get('CLIP_MAX_BATCH_QUERIES', 256))
+# Seconds between checks of the index file for a new version (0 = only
+# POST /admin/reload), and the token that endpoint requires when set
+WATCH_INTERVAL_SECONDS = float(os.environ.get('CLIP_WATCH_INTERVAL_S', 0))
+ADMIN_TOKEN = os.environ.get('CLIP_ADMIN_TOKEN')
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# =============================================================================
+# Metrics
+# =============================================================================
+
+REGISTRY = MetricsRegistry()
+REQUESTS = REGISTRY.counter(
+    "clip_requests_total", "HTTP requests answered", ("method", "endpoint", "status")
+)
+REQUEST_ERRORS = REGISTRY.counter(
+    "clip_request_errors_total", "HTTP requests answered with a 4xx or 5xx status", ("method", "endpoint", "status")
+)
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "clip_requests_in_flight", "HTTP requests being handled", ("method", "endpoint")
+)
+REQUEST_LATENCY = REGISTRY.histogram(
+    "clip_request_duration_seconds", "HTTP request latency", ("method", "endpoint")
+)
+STAGE_LATENCY = REGISTRY.histogram(
+    "clip_stage_duration_seconds",
+    "Time per call of a query stage; tokenize, text_encode and faiss_search run once per batch",
+    ("stage",)
+)
+BATCH_SIZE = REGISTRY.histogram(
+    "clip_batch_size", "Queries per batch, from the micro-batching queue or one /search/batch request",
+    ("source",), BATCH_SIZE_BUCKETS
+)
+QUEUE_PENDING = REGISTRY.gauge("clip_queue_pending", "Queries waiting for an inference slot")
+CACHE_HITS = REGISTRY.counter("clip_cache_hits_total", "Query cache hits", ("cache",))
+CACHE_MISSES = REGISTRY.counter("clip_cache_misses_total", "Query cache misses", ("cache",))
+CACHE_HIT_RATIO = REGISTRY.gauge("clip_cache_hit_ratio", "Query cache hits over lookups since startup", ("cache",))
+CACHE_EVICTIONS = REGISTRY.counter("clip_cache_evictions_total", "Query cache entries evicted for space", ("cache",))
+CACHE_ENTRIES = REGISTRY.gauge("clip_cache_entries", "Query cache entries", ("cache",))
+CACHE_BYTES = REGISTRY.gauge("clip_cache_bytes", "Approximate query cache memory", ("cache",))
+INDEX_SIZE = REGISTRY.gauge("clip_index_size", "Images in the loaded index")
+INDEX_INFO = REGISTRY.gauge("clip_index_info", "Version of the loaded index (always 1)", ("version",))
+PROCESS_RSS = REGISTRY.gauge("process_resident_memory_bytes", "Resident memory of the server process")
+PROCESS_PEAK_RSS = REGISTRY.gauge("process_peak_resident_memory_bytes", "Peak resident memory of the server process")
+
+# Timed calls of search.py's stages -> stage label
+STAGE_LABELS = {
+    "tokenize": "tokenize",
+    "text_encode": "text_encode",
+    "filter_compile": "filter",
+    "search": "faiss_search",
+}
+
+
+def observe_stage(name: str, seconds: float, items: int) -> None:
+    stage = STAGE_LABELS.get(name)
+    if stage is not None:
+        STAGE_LATENCY.observe(seconds, stage)
+
+
+add_stage_observer(observe_stage)
+
+
+@contextmanager
+def timed_stage(stage: str) -> Iterator[None]:
+    """Observe the block's duration as one call of stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - start, stage)
+
 # =============================================================================
 # Models
 # =============================================================================
 
+class SearchFilter(BaseModel):
+    """Fields combine with AND; see filtered_search for the semantics."""
+    categories: List[str] = []
+    exclude_categories: List[str] = []
+    path_prefixes: List[str] = []  # Folders at any depth, e.g. "SkillsIcons/Fire"
+    exclude_path_prefixes: List[str] = []
+    flags: List[str] = []  # e.g. "nobg"
+    exclude_flags: List[str] = []
+
+
 class SearchRequest(BaseModel):
     query: str
     top_k: int = 10
     category_filter: Optional[str] = None
+    filter: Optional[SearchFilter] = None
 
 
 class SearchResult(BaseModel):
     path: str
     score: float
     category: str
+    variants: List[str] = []  # Duplicate images collapsed into this one at build time
 
 
 class SearchResponse(BaseModel):
@@ -59,17 +205,131 @@ class SearchResponse(BaseModel):
     results: List[SearchResult]
 
 
+class BatchSearchRequest(BaseModel):
+    queries: List[SearchRequest]
+
+
+class BatchSearchResult(BaseModel):
+    query: str
+    top_k: int
+    results: List[SearchResult] = []
+    error: Optional[str] = None  # Set instead of results when this query is invalid
+
+
+class BatchSearchResponse(BaseModel):
+    results: List[BatchSearchResult]
+
+
+class SimilarRequest(BaseModel):
+    """The image is given by path (as indexed) or by id, not both."""
+    path: Optional[str] = None
+    id: Optional[int] = None
+    top_k: int = 10
+    category_filter: Optional[str] = None
+    filter: Optional[SearchFilter] = None
+
+
+class SimilarResponse(BaseModel):
+    id: int
+    path: str
+    top_k: int
+    results: List[SearchResult]
+
+
 class HealthResponse(BaseModel):
     status: str
     model: str
     device: str
     index_size: int
+    index_version: str
+
+
+class ReloadResponse(BaseModel):
+    reloaded: bool
+    index_version: str
+    previous_version: str
+    index_size: int
+
+
+class CacheStats(BaseModel):
+    entries: int
+    bytes: int
+    max_bytes: int
+    hits: int
+    misses: int
+    hit_rate: float
+    evictions: int
+    expirations: int
+
+
+class CacheStatsResponse(BaseModel):
+    index_version: str
+    embeddings: CacheStats
+    results: CacheStats
 
 
 # =============================================================================
 # CLIP Search Engine
 # =============================================================================
 
+def index_version(index_path, metadata_path, manifest: Optional[dict]) -> str:
+    """
+    Identity of a loaded index and its metadata: a hash of every checksum
+    in the manifest when both come from one published version (so a
+    rebuild that changes only the metadata is a new version), else their
+    paths and mtimes.
+    """
+    if manifest is not None and Path(metadata_path).parent == Path(index_path).parent:
+        digest = hashlib.sha256()
+        for filename in sorted(manifest['files']):
+            digest.update(f"{filename}:{manifest['files'][filename]['sha256']}\n".encode('utf-8'))
+        return digest.hexdigest()
+    parts = []
+    for path in (index_path, metadata_path):
+        real_path = os.path.realpath(path)
+        parts.append(f"{real_path}@{os.stat(real_path).st_mtime_ns}")
+    return "|".join(parts)
+
+
+def index_fingerprint(index_path: str) -> Tuple[str, int, int]:
+    """Cheap check for a new index: the file behind the symlinks, its mtime and size."""
+    real_path = os.path.realpath(index_path)
+    stat = os.stat(real_path)
+    return real_path, stat.st_mtime_ns, stat.st_size
+
+
+class IndexSnapshot:
+    """One loaded index version (index, metadata, searcher); replaced, never modified."""
+    
+    def __init__(self, index_path: str, metadata_path: str):
+        if not Path(index_path).exists():
+            raise FileNotFoundError(f"Index file not found: {index_path}")
+        if not Path(metadata_path).exists():
+            raise FileNotFoundError(f"Metadata file not found: {metadata_path}")
+        
+        # Pinned to one published version
+        real_index, real_metadata, _ = resolve_artifacts(index_path, metadata_path)
+        self.index, self.metadata, self.manifest = load_published(real_index, real_metadata)
+        self.searcher = FilteredSearcher(self.index, self.metadata)
+        self.version = index_version(real_index, real_metadata, self.manifest)
+        # Built on the first /similar by path
+        self._ids_by_path: Optional[Dict[str, int]] = None
+        self._ids_lock = threading.Lock()
+    
+    def id_of_path(self, path: str) -> int:
+        """
+        Id of the image indexed at path (relative to the images folder).
+        
+        Raises:
+            KeyError: when no indexed image has that path
+        """
+        if self._ids_by_path is None:
+            with self._ids_lock:
+                if self._ids_by_path is None:
+                    self._ids_by_path = {image_path: record_id for record_id, image_path in iter_paths(self.metadata)}
+        return self._ids_by_path[path.replace("\\", "/").lstrip("/")]
+
+
 class ClipSearchEngine:
     def __init__(
         self, 
@@ -77,115 +337,406 @@ class ClipSearchEngine:
         metadata_path: str = DEFAULT_METADATA_PATH
     ):
         logger.info("Initializing CLIP Search Engine...")
+        self.index_path = index_path
+        self.metadata_path = metadata_path
         
-        # Validate paths
-        if not Path(index_path).exists():
-            raise FileNotFoundError(f"Index file not found: {index_path}")
-        if not Path(metadata_path).exists():
-            raise FileNotFoundError(f"Metadata file not found: {metadata_path}")
-        
-        # Load FAISS index
+        # Load FAISS index and metadata
         logger.info(f"Loading FAISS index from {index_path}")
-        self.index = faiss.read_index(index_path)
-        
-        # Load metadata
         logger.info(f"Loading metadata from {metadata_path}")
-        self.metadata = self._load_metadata(metadata_path)
+        self.snapshot = IndexSnapshot(index_path, metadata_path)
+        if self.snapshot.manifest is not None:
+            manifest = self.snapshot.manifest
+            logger.info(f"Index version created at {manifest['created_at']} ({manifest['index_type']})")
+        self._reload_lock = threading.Lock()
         
-        # Determine device
-        self.device = self._get_device()
+        # Load the CLIP text encoder
+        logger.info(f"Loading CLIP model: {MODEL_NAME}")
+        self.tokenizer, self.model, self.device = load_text_model()
         logger.info(f"Using device: {self.device}")
         
-        # Load CLIP model
-        logger.info(f"Loading CLIP model: {MODEL_NAME}")
-        self.processor = CLIPProcessor.from_pretrained(MODEL_NAME)
-        self.model = CLIPModel.from_pretrained(MODEL_NAME).to(self.device)
-        self.model.eval()
+        # Fast tokenizers can't be shared between threads: one copy per worker
+        self._local = threading.local()
+        
+        self.embedding_cache = EmbeddingLRUCache(int(EMBEDDING_CACHE_MB * 1024 * 1024), CACHE_TTL_SECONDS)
+        self.result_cache = LRUCache(int(RESULT_CACHE_MB * 1024 * 1024), CACHE_TTL_SECONDS)
         
         logger.info(f"✓ CLIP Search Engine ready! ({len(self.metadata)} images indexed)")
     
-    def _get_device(self) -> str:
-        if torch.cuda.is_available():
-            return "cuda"
-        if hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
-            return "mps"
-        return "cpu"
-    
-    def _load_metadata(self, metadata_path: str) -> List[dict]:
-        records = []
-        with open(metadata_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    record = json.loads(line)
-                    records.append(record)
+    # The current snapshot's parts; code that needs several of them at once
+    # reads self.snapshot once instead, so a reload can't split them
+    @property
+    def metadata(self):
+        return self.snapshot.metadata
+    
+    @property
+    def searcher(self) -> FilteredSearcher:
+        return self.snapshot.searcher
+    
+    @property
+    def index_version(self) -> str:
+        return self.snapshot.version
+    
+    def reload(self) -> dict:
+        """
+        Load the index and metadata now published at the engine's paths and
+        swap them in. Requests already running finish on the snapshot they
+        started with; the model is kept.
+        
+        Returns:
+            Dict with reloaded (False when the version is unchanged),
+            index_version, previous_version and index_size
         
-        # Sort by id to ensure correct indexing
-        records.sort(key=lambda x: x['id'])
-        return records
-    
-    def _get_text_embedding(self, text: str) -> np.ndarray:
-        inputs = self.processor(
-            text=[text], 
-            return_tensors="pt", 
-            padding=True, 
-            truncation=True
+        Raises:
+            FileNotFoundError, ValueError, RuntimeError: when the new files
+                can't be loaded or don't fit the model; the current
+                snapshot stays in place
+        """
+        with self._reload_lock:
+            previous = self.snapshot
+            real_index, real_metadata, manifest = resolve_artifacts(self.index_path, self.metadata_path)
+            if index_version(real_index, real_metadata, manifest) == previous.version:
+                return {
+                    "reloaded": False,
+                    "index_version": previous.version,
+                    "previous_version": previous.version,
+                    "index_size": len(previous.metadata)
+                }
+            
+            logger.info(f"Loading new index version from {real_index}")
+            snapshot = IndexSnapshot(self.index_path, self.metadata_path)
+            self._check_snapshot(snapshot)
+            
+            # A single reference assignment: readers see the old or the new snapshot
+            self.snapshot = snapshot
+            # Results of the old version can never match again
+            self.result_cache.clear()
+            logger.info(f"✓ Index reloaded: {len(snapshot.metadata)} images (version {snapshot.version[:12]})")
+            return {
+                "reloaded": True,
+                "index_version": snapshot.version,
+                "previous_version": previous.version,
+                "index_size": len(snapshot.metadata)
+            }
+    
+    def _check_snapshot(self, snapshot: IndexSnapshot) -> None:
+        """Make sure a new snapshot can answer queries from this model."""
+        dim = self.model.config.projection_dim
+        if snapshot.index.d != dim:
+            raise ValueError(f"Index dimension {snapshot.index.d} does not match the model ({dim})")
+        if len(snapshot.metadata) == 0:
+            raise ValueError("New index is empty")
+        probe = np.zeros((1, dim), dtype=np.float32)
+        probe[0, 0] = 1.0
+        _, ids = snapshot.searcher.search(probe, 1)
+        if ids[0, 0] < 0 or ids[0, 0] not in snapshot.metadata:
+            raise ValueError("New index returned ids without metadata")
+    
+    def _get_text_embeddings(self, texts: List[str]) -> np.ndarray:
+        tokenizer = getattr(self._local, 'tokenizer', None)
+        if tokenizer is None:
+            tokenizer = self._local.tokenizer = copy.deepcopy(self.tokenizer)
+        return get_text_embeddings(tokenizer, self.model, texts, self.device)
+    
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        return self.embedding_cache.embed(texts, self._get_text_embeddings)
+    
+    def _result_key(self, job: dict, snapshot: IndexSnapshot) -> tuple:
+        """
+        Cache key of a job's results on a snapshot. Results hold paths,
+        categories and variants, so the key includes the snapshot version,
+        which covers the metadata as well as the index (see index_version):
+        results stored late by a batch that started on an older snapshot
+        are never served for the new one.
+        
+        Raises:
+            ValueError: when the job's filter is invalid
+        """
+        return (
+            snapshot.version,
+            normalize_text(job['query']),
+            job['top_k'],
+            filter_key(merge_category_filter(job['filter'], job['category']))
         )
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+    
+    def cached_result(
+        self,
+        job: dict,
+        count_miss: bool = True,
+        snapshot: Optional[IndexSnapshot] = None
+    ) -> Optional[dict]:
+        """The job's result when it is in the result cache (no model or FAISS work)."""
+        try:
+            key = self._result_key(job, snapshot or self.snapshot)
+        except ValueError:
+            return None
+        results = self.result_cache.get(key, count_miss)
+        if results is None:
+            return None
+        return {
+            "query": job['query'],
+            "top_k": job['top_k'],
+            "category_filter": job['category'],
+            "filter": job['filter'],
+            "results": results
+        }
+    
+    def search_many(self, jobs: List[dict]) -> List[dict]:
+        """
+        Answer several queries ({query, top_k, category, filter}): cached
+        ones from the result cache, the rest with one forward pass (for
+        texts not in the embedding cache) and one FAISS search per
+        distinct filter.
         
-        with torch.no_grad():
-            outputs = self.model.get_text_features(**inputs)
+        Returns:
+            One dict per job, in order: search.py's result record, or
+            {query, error} when the job's filter is invalid
+        """
+        # The whole batch uses one snapshot even if a reload swaps it meanwhile
+        snapshot = self.snapshot
+        results: List[Optional[dict]] = [self.cached_result(job, snapshot=snapshot) for job in jobs]
+        misses = [i for i, result in enumerate(results) if result is None]
+        if not misses:
+            return results
         
-        # Convert to numpy and normalize L2
-        embedding = outputs.cpu().numpy().astype(np.float32)
-        norm = np.linalg.norm(embedding, axis=1, keepdims=True)
-        if norm[0, 0] != 0:
-            embedding = embedding / norm
+        # The server never reports stage timings; don't let them accumulate
+        with profiling_suspended():
+            searched = search_batch(snapshot.searcher, self._embed, [jobs[i] for i in misses])
         
-        return embedding
+        for i, result in zip(misses, searched):
+            results[i] = result
+            if 'results' in result:
+                self.result_cache.put(self._result_key(jobs[i], snapshot), result['results'])
+        return results
+    
+    def similar(
+        self,
+        path: Optional[str] = None,
+        record_id: Optional[int] = None,
+        top_k: int = 10,
+        category_filter: Optional[str] = None,
+        search_filter: Optional[dict] = None
+    ) -> dict:
+        """
+        Images closest to an indexed one ("more like this"), searched with
+        the vector stored for it in the index; the text encoder isn't used.
+        The image itself is left out of its results.
+        
+        Returns:
+            Dict with the image's id and path, and its result records
+        
+        Raises:
+            KeyError: when the path or id is not indexed
+            ValueError: when the filter is invalid
+        """
+        snapshot = self.snapshot
+        if record_id is None:
+            record_id = snapshot.id_of_path(path)
+        elif record_id not in snapshot.metadata:
+            raise KeyError(record_id)
+        
+        merged_filter = merge_category_filter(search_filter, category_filter)
+        key = ("similar", snapshot.version, record_id, top_k, filter_key(merged_filter))
+        results = self.result_cache.get(key)
+        if results is None:
+            searcher = snapshot.searcher
+            with profiling_suspended():
+                with profile_stage("filter_compile"):
+                    subset = searcher.compile_filter(merged_filter)
+                vector = searcher.stored_vectors(np.array([record_id], dtype=np.int64))
+                # One extra hit, since the image usually finds itself first
+                with profile_stage("search"):
+                    scores, ids = searcher.search(vector, top_k + 1, subset)
+            others = ids[0] != record_id
+            results = build_results(snapshot.metadata, scores[0][others][:top_k], ids[0][others][:top_k])
+            self.result_cache.put(key, results)
+        
+        return {
+            "id": record_id,
+            "path": snapshot.metadata[record_id]['path'],
+            "results": results
+        }
     
     def search(
         self, 
         query: str, 
         top_k: int = 10,
-        category_filter: Optional[str] = None
+        category_filter: Optional[str] = None,
+        search_filter: Optional[dict] = None
     ) -> List[SearchResult]:
-        # Get query embedding
-        query_embedding = self._get_text_embedding(query)
-        
-        # Search with multiplier if filtering
-        search_k = top_k
-        if category_filter:
-            search_k = min(top_k * 5, self.index.ntotal)
-        else:
-            search_k = min(top_k, self.index.ntotal)
-        
-        # Search FAISS index
-        scores, indices = self.index.search(query_embedding, search_k)
+        result = self.search_many([{
+            "query": query,
+            "top_k": top_k,
+            "category": category_filter,
+            "filter": search_filter
+        }])[0]
+        if 'error' in result:
+            raise ValueError(result['error'])
+        return [SearchResult(**record) for record in result['results']]
+
+
+# =============================================================================
+# Inference executor and micro-batching
+# =============================================================================
+
+def _limit_inference_threads(threads: int) -> None:
+    """
+    Thread budget of an executor worker: each torch forward pass and FAISS
+    search uses at most threads threads. Every worker sets the same value,
+    so it holds whether the runtime keeps the setting per thread or per process.
+    """
+    import torch
+    
+    torch.set_num_threads(threads)
+    faiss.omp_set_num_threads(threads)
+
+
+def make_inference_executor(
+    workers: int = INFERENCE_WORKERS,
+    threads_per_worker: int = THREADS_PER_WORKER
+) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=workers,
+        thread_name_prefix="inference",
+        initializer=_limit_inference_threads,
+        initargs=(threads_per_worker,)
+    )
+
+
+class ServerBusyError(Exception):
+    """Too many queries are already waiting."""
+
+
+class QueryBatcher:
+    """
+    Queue of pending queries, answered in batches on an executor.
+    
+    The first query of a batch waits up to window_ms for more to arrive
+    (at most max_batch_size); then the whole batch is run with one call to
+    run_batch on the executor and each waiting request gets its own result
+    back. At most slots batches run at once; while they do, new queries
+    queue up (at most max_pending) and form the next, larger batches.
+    """
+    
+    def __init__(
+        self,
+        run_batch: Callable[[List[dict]], List[dict]],
+        executor: ThreadPoolExecutor,
+        slots: int = INFERENCE_WORKERS,
+        window_ms: float = BATCH_WINDOW_MS,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_pending: int = MAX_PENDING
+    ):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.window = window_ms / 1000
+        self.max_batch_size = max(1, max_batch_size)
+        # (job, future for its result, loop time it was queued at)
+        self._queue: "asyncio.Queue[Tuple[dict, asyncio.Future, float]]" = asyncio.Queue(maxsize=max(0, max_pending))
+        self._slots = asyncio.Semaphore(max(1, slots))
+        self._running: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
+    
+    def pending(self) -> int:
+        return self._queue.qsize()
+    
+    async def submit(self, job: dict) -> dict:
+        """
+        Result of one query.
         
-        # Build results
-        results = []
-        for score, idx in zip(scores[0], indices[0]):
-            if idx < 0 or idx >= len(self.metadata):
-                continue
-            
-            record = self.metadata[idx]
+        Raises:
+            ServerBusyError: when max_pending queries are already waiting
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        try:
+            self._queue.put_nowait((job, future, loop.time()))
+        except asyncio.QueueFull:
+            raise ServerBusyError(f"Too many pending queries ({self._queue.maxsize})")
+        return await future
+    
+    async def run(self, jobs: List[dict]) -> List[dict]:
+        """Run jobs that already form a batch, sharing the executor slots with queued queries."""
+        return await self.call(self.run_batch, jobs)
+    
+    async def call(self, function: Callable, *args):
+        """Run other work on the executor, sharing its slots with queued queries."""
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+    
+    async def _collect(self, first: Tuple[dict, asyncio.Future, float]) -> List[Tuple[dict, asyncio.Future, float]]:
+        loop = asyncio.get_running_loop()
+        batch = [first]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Queries queued while the previous batch ran don't wait for the window
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+    
+    async def _run(self) -> None:
+        while True:
+            # Only start collecting once a slot is free, so queries that
+            # arrive while every slot is busy join the same batch (the slot
+            # is taken after the first query, leaving it to run() meanwhile)
+            first = await self._queue.get()
+            await self._slots.acquire()
+            try:
+                batch = await self._collect(first)
+            except BaseException:
+                self._slots.release()
+                raise
+            task = asyncio.get_running_loop().create_task(self._dispatch(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+    
+    async def _dispatch(self, batch: List[Tuple[dict, asyncio.Future, float]]) -> None:
+        try:
+            # Requests that disconnected while waiting are dropped
+            batch = [(job, future, queued) for job, future, queued in batch if not future.done()]
+            if not batch:
+                return
             
-            # Apply category filter
-            if category_filter:
-                if record['category'].lower() != category_filter.lower():
-                    continue
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            for _, _, queued in batch:
+                STAGE_LATENCY.observe(now - queued, "queue_wait")
+            BATCH_SIZE.observe(len(batch), "queue")
             
-            results.append(SearchResult(
-                path=record['path'],
-                score=float(score),
-                category=record['category']
-            ))
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.run_batch, [job for job, _, _ in batch]
+                )
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
             
-            if len(results) >= top_k:
-                break
-        
-        return results
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
 
 
 # =============================================================================
@@ -209,16 +760,121 @@ app.add_middleware(
 
 # Global search engine instance
 search_engine: Optional[ClipSearchEngine] = None
+query_batcher: Optional[QueryBatcher] = None
+index_watcher: Optional[asyncio.Task] = None
+
+
+def collect_server_metrics() -> None:
+    """Read the metrics kept elsewhere (caches, index, memory) when /metrics is scraped."""
+    rss = process_rss_bytes()
+    if rss is not None:
+        PROCESS_RSS.set(rss)
+    peak_rss = process_peak_rss_bytes()
+    if peak_rss is not None:
+        PROCESS_PEAK_RSS.set(peak_rss)
+    if query_batcher is not None:
+        QUEUE_PENDING.set(query_batcher.pending())
+    
+    engine = search_engine
+    if engine is None:
+        return
+    snapshot = engine.snapshot
+    INDEX_SIZE.set(len(snapshot.metadata))
+    INDEX_INFO.clear()
+    INDEX_INFO.set(1, snapshot.version)
+    for name, cache in (("embeddings", engine.embedding_cache), ("results", engine.result_cache)):
+        stats = cache.stats()
+        CACHE_HITS.set(stats['hits'], name)
+        CACHE_MISSES.set(stats['misses'], name)
+        CACHE_HIT_RATIO.set(stats['hit_rate'], name)
+        CACHE_EVICTIONS.set(stats['evictions'], name)
+        CACHE_ENTRIES.set(stats['entries'], name)
+        CACHE_BYTES.set(stats['bytes'], name)
+
+
+REGISTRY.add_collector(collect_server_metrics)
+
+
+def endpoint_label(scope: dict) -> str:
+    """Route path of a request (e.g. "/search"), or "other" when none matches."""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "other"
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    method = request.method
+    endpoint = endpoint_label(request.scope)
+    REQUESTS_IN_FLIGHT.inc(method, endpoint)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec(method, endpoint)
+        REQUEST_LATENCY.observe(time.perf_counter() - start, method, endpoint)
+        REQUESTS.inc(method, endpoint, str(status))
+        if status >= 400:
+            REQUEST_ERRORS.inc(method, endpoint, str(status))
+
+
+def json_response(model: BaseModel) -> Response:
+    """Serialize a response model once, instead of FastAPI validating and encoding it again."""
+    return Response(content=model.model_dump_json(), media_type="application/json")
+
+
+async def watch_index(engine: ClipSearchEngine, interval: float) -> None:
+    """Reload the engine whenever the file behind its index path changes."""
+    seen = index_fingerprint(engine.index_path)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            fingerprint = index_fingerprint(engine.index_path)
+        except OSError:
+            # Being replaced right now; look again next time
+            continue
+        if fingerprint == seen:
+            continue
+        seen = fingerprint
+        
+        try:
+            await asyncio.to_thread(engine.reload)
+        except Exception as e:
+            logger.error(f"Index reload failed, still serving version {engine.index_version[:12]}: {e}")
 
 
 @app.on_event("startup")
 async def startup_event():
-    global search_engine
+    global search_engine, query_batcher, index_watcher
     try:
         search_engine = ClipSearchEngine()
     except Exception as e:
         logger.error(f"Failed to initialize search engine: {e}")
         raise
+    
+    if WATCH_INTERVAL_SECONDS > 0:
+        index_watcher = asyncio.get_running_loop().create_task(watch_index(search_engine, WATCH_INTERVAL_SECONDS))
+        logger.info(f"Watching {search_engine.index_path} for new versions every {WATCH_INTERVAL_SECONDS:g}s")
+    
+    query_batcher = QueryBatcher(search_engine.search_many, make_inference_executor())
+    query_batcher.start()
+    logger.info(
+        f"Micro-batching: window {BATCH_WINDOW_MS:g} ms, up to {MAX_BATCH_SIZE} queries; "
+        f"{INFERENCE_WORKERS} inference worker(s) x {THREADS_PER_WORKER} threads"
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if index_watcher is not None:
+        index_watcher.cancel()
+    if query_batcher is not None:
+        await query_batcher.stop()
 
 
 @app.get("/health", response_model=HealthResponse)
@@ -231,7 +887,8 @@ async def health_check():
         status="ok",
         model=MODEL_NAME,
         device=search_engine.device,
-        index_size=len(search_engine.metadata)
+        index_size=len(search_engine.metadata),
+        index_version=search_engine.index_version
     )
 
 
@@ -247,6 +904,16 @@ async def search_images(request: SearchRequest):
             "top_k": 10,
             "category_filter": "SkillsIcons"
         }
+    
+    or, with a filter:
+        {
+            "query": "blue lightning strike",
+            "filter": {
+                "categories": ["SkillsIcons", "SpellIcons"],
+                "exclude_path_prefixes": ["SkillsIcons/Old"],
+                "flags": ["nobg"]
+            }
+        }
     """
     if search_engine is None:
         raise HTTPException(status_code=503, detail="Search engine not initialized")
@@ -257,21 +924,101 @@ async def search_images(request: SearchRequest):
     if request.top_k < 1 or request.top_k > 100:
         raise HTTPException(status_code=400, detail="top_k must be between 1 and 100")
     
+    job = {
+        "query": request.query,
+        "top_k": request.top_k,
+        "category": request.category_filter,
+        "filter": request.filter.model_dump() if request.filter else None
+    }
     try:
-        results = search_engine.search(
-            query=request.query,
-            top_k=request.top_k,
-            category_filter=request.category_filter
-        )
-        
-        return SearchResponse(
-            query=request.query,
-            top_k=request.top_k,
-            results=results
-        )
+        # Repeated queries are answered right away (a miss is counted when
+        # the batch looks again); the rest are encoded and searched
+        # together with concurrent requests
+        result = search_engine.cached_result(job, count_miss=False)
+        if result is None:
+            result = await query_batcher.submit(job)
+    except ServerBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Search error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    
+    if 'error' in result:
+        raise HTTPException(status_code=400, detail=result['error'])
+    
+    with timed_stage("serialize"):
+        return json_response(SearchResponse(
+            query=request.query,
+            top_k=request.top_k,
+            results=[SearchResult(**record) for record in result['results']]
+        ))
+
+
+@app.post("/search/batch", response_model=BatchSearchResponse)
+async def search_images_batch(request: BatchSearchRequest):
+    """
+    Several searches in one request, answered in order. Each query has its
+    own top_k, category_filter and filter; all of them are encoded in one
+    forward pass and searched with one FAISS call per distinct filter. An
+    invalid query gets an error in its position instead of failing the rest.
+    
+    Example:
+        POST /search/batch
+        {
+            "queries": [
+                {"query": "fire explosion", "top_k": 5},
+                {"query": "blue lightning strike", "category_filter": "SkillsIcons"}
+            ]
+        }
+    """
+    if search_engine is None:
+        raise HTTPException(status_code=503, detail="Search engine not initialized")
+    
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="queries cannot be empty")
+    
+    if len(request.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUERIES} queries per batch")
+    
+    results: List[Optional[BatchSearchResult]] = [None] * len(request.queries)
+    jobs = []
+    positions = []
+    for i, query in enumerate(request.queries):
+        if not query.query.strip():
+            error = "Query cannot be empty"
+        elif query.top_k < 1 or query.top_k > 100:
+            error = "top_k must be between 1 and 100"
+        else:
+            error = None
+        if error:
+            results[i] = BatchSearchResult(query=query.query, top_k=query.top_k, error=error)
+            continue
+        jobs.append({
+            "query": query.query,
+            "top_k": query.top_k,
+            "category": query.category_filter,
+            "filter": query.filter.model_dump() if query.filter else None
+        })
+        positions.append(i)
+    
+    if jobs:
+        BATCH_SIZE.observe(len(jobs), "request")
+        try:
+            searched = await query_batcher.run(jobs)
+        except Exception as e:
+            logger.error(f"Batch search error: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+        
+        for i, job, result in zip(positions, jobs, searched):
+            results[i] = BatchSearchResult(
+                query=job['query'],
+                top_k=job['top_k'],
+                results=[SearchResult(**record) for record in result.get('results', [])],
+                error=result.get('error')
+            )
+    
+    with timed_stage("serialize"):
+        return json_response(BatchSearchResponse(results=results))
 
 
 @app.get("/search", response_model=SearchResponse)
@@ -293,6 +1040,121 @@ async def search_images_get(
     ))
 
 
+@app.post("/similar", response_model=SimilarResponse)
+async def similar_images(request: SimilarRequest):
+    """
+    Images similar to an indexed one ("more like this"), found with its
+    stored embedding instead of a text query. Takes the same top_k,
+    category_filter and filter as /search.
+    
+    Example:
+        POST /similar
+        {
+            "path": "SkillsIcons/Fire/fireball.png",
+            "top_k": 10,
+            "filter": {"exclude_categories": ["SkillsIcons"]}
+        }
+    """
+    if search_engine is None:
+        raise HTTPException(status_code=503, detail="Search engine not initialized")
+    
+    if (request.path is None) == (request.id is None):
+        raise HTTPException(status_code=400, detail="Give either path or id")
+    
+    if request.top_k < 1 or request.top_k > 100:
+        raise HTTPException(status_code=400, detail="top_k must be between 1 and 100")
+    
+    try:
+        # No model work, but the FAISS search still runs off the event loop
+        result = await query_batcher.call(
+            search_engine.similar,
+            request.path,
+            request.id,
+            request.top_k,
+            request.category_filter,
+            request.filter.model_dump() if request.filter else None
+        )
+    except KeyError:
+        image = f"path {request.path}" if request.path is not None else f"id {request.id}"
+        raise HTTPException(status_code=404, detail=f"No indexed image with {image}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Similar search error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    with timed_stage("serialize"):
+        return json_response(SimilarResponse(
+            id=result['id'],
+            path=result['path'],
+            top_k=request.top_k,
+            results=[SearchResult(**record) for record in result['results']]
+        ))
+
+
+@app.get("/similar", response_model=SimilarResponse)
+async def similar_images_get(
+    path: Optional[str] = Query(None, description="Path of an indexed image"),
+    id: Optional[int] = Query(None, description="Id of an indexed image"),
+    top_k: int = Query(10, ge=1, le=100, description="Number of results"),
+    category: Optional[str] = Query(None, description="Filter by category")
+):
+    """
+    Images similar to an indexed one (GET endpoint for convenience).
+    
+    Example:
+        GET /similar?path=SkillsIcons/Fire/fireball.png&top_k=5
+    """
+    return await similar_images(SimilarRequest(
+        path=path,
+        id=id,
+        top_k=top_k,
+        category_filter=category
+    ))
+
+
+@app.get("/cache/stats", response_model=CacheStatsResponse)
+async def cache_stats():
+    """Hit rates and memory of the query embedding and result caches"""
+    if search_engine is None:
+        raise HTTPException(status_code=503, detail="Search engine not initialized")
+    
+    return CacheStatsResponse(
+        index_version=search_engine.index_version,
+        embeddings=CacheStats(**search_engine.embedding_cache.stats()),
+        results=CacheStats(**search_engine.result_cache.stats())
+    )
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus metrics in the text exposition format"""
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@app.post("/admin/reload", response_model=ReloadResponse)
+async def reload_index(x_admin_token: Optional[str] = Header(None)):
+    """
+    Load the index and metadata now published at the configured paths and
+    swap them in without downtime (requires X-Admin-Token when
+    CLIP_ADMIN_TOKEN is set).
+    """
+    if search_engine is None:
+        raise HTTPException(status_code=503, detail="Search engine not initialized")
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    
+    # Loading runs off the event loop; searches keep using the old snapshot
+    try:
+        return ReloadResponse(**await asyncio.to_thread(search_engine.reload))
+    except Exception as e:
+        logger.error(f"Index reload failed: {e}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Reload failed, still serving version {search_engine.index_version[:12]}: {e}"
+        )
+
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -302,6 +1164,11 @@ async def root():
         "endpoints": {
             "health": "GET /health",
             "search": "POST /search or GET /search?q=...",
+            "search_batch": "POST /search/batch",
+            "similar": "POST /similar or GET /similar?path=...",
+            "cache_stats": "GET /cache/stats",
+            "metrics": "GET /metrics",
+            "reload": "POST /admin/reload",
         }
     }
 
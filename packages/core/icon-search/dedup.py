@@ -0,0 +1,167 @@
+"""
+Duplicate collapsing for index builds.
+
+Asset packs ship many near-identical variants (the same icon in several
+sizes, *_nobg copies next to the original). With --dedup, index_build.py
+groups them and indexes only one canonical vector per group, the file
+with the lowest id. The other paths are kept in the canonical record's
+"variants" list in metadata.jsonl so search results can still expand them.
+
+Modes (each one also collapses exact byte duplicates):
+    exact      identical content hash
+    phash      difference hash within --dedup_hamming bits
+    embedding  embedding cosine similarity >= --dedup_cosine
+"""
+
+import argparse
+from typing import Dict, List, Optional, Set
+
+import faiss
+import numpy as np
+from PIL import Image
+
+
+DEDUP_MODES = ("none", "exact", "phash", "embedding")
+DEFAULT_DEDUP_HAMMING = 4
+DEFAULT_DEDUP_COSINE = 0.97
+DHASH_SIZE = 8
+QUERY_CHUNK_ROWS = 4096
+
+
+def compute_dhash(img: Image.Image) -> str:
+    """64-bit difference hash (hex): brightness gradients of an 9x8 thumbnail."""
+    gray = img.convert("L").resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return np.packbits(bits).tobytes().hex()
+
+
+def add_dedup_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the --dedup family of options to a builder CLI."""
+    parser.add_argument(
+        "--dedup",
+        type=str,
+        choices=DEDUP_MODES,
+        default=None,
+        help="Collapse duplicate images into one indexed vector "
+             "(default: the previous build's setting with --incremental, else none)"
+    )
+    parser.add_argument(
+        "--dedup_hamming",
+        type=int,
+        default=DEFAULT_DEDUP_HAMMING,
+        help=f"Max differing hash bits for --dedup phash (default: {DEFAULT_DEDUP_HAMMING})"
+    )
+    parser.add_argument(
+        "--dedup_cosine",
+        type=float,
+        default=DEFAULT_DEDUP_COSINE,
+        help=f"Min cosine similarity for --dedup embedding (default: {DEFAULT_DEDUP_COSINE})"
+    )
+
+
+def dedup_options_from_args(args: argparse.Namespace) -> Optional[dict]:
+    """Dedup options from CLI args, or None when --dedup was not given."""
+    if args.dedup is None:
+        return None
+    return {
+        "mode": args.dedup,
+        "hamming": args.dedup_hamming,
+        "cosine": args.dedup_cosine,
+    }
+
+
+def _link_exact(neighbours: Dict[int, Set[int]], files: Dict[str, dict]) -> None:
+    ids_by_hash = {}
+    for entry in files.values():
+        ids_by_hash.setdefault(entry['sha256'], []).append(entry['id'])
+    for ids in ids_by_hash.values():
+        for item in ids:
+            neighbours[item].update(ids)
+
+
+def _link_range_results(
+    neighbours: Dict[int, Set[int]],
+    ids: List[int],
+    start: int,
+    lims: np.ndarray,
+    found: np.ndarray
+) -> None:
+    for row in range(len(lims) - 1):
+        item = ids[start + row]
+        neighbours[item].update(ids[position] for position in found[lims[row]:lims[row + 1]])
+
+
+def _link_phash(neighbours: Dict[int, Set[int]], files: Dict[str, dict], hamming: int) -> None:
+    entries = [entry for entry in files.values() if entry.get('dhash')]
+    if len(entries) < 2:
+        return
+
+    ids = [entry['id'] for entry in entries]
+    codes = np.array([np.frombuffer(bytes.fromhex(entry['dhash']), dtype=np.uint8) for entry in entries])
+    index = faiss.IndexBinaryFlat(codes.shape[1] * 8)
+    index.add(codes)
+
+    # Binary range_search returns distances strictly below the radius
+    for start in range(0, len(ids), QUERY_CHUNK_ROWS):
+        lims, _, found = index.range_search(codes[start:start + QUERY_CHUNK_ROWS], hamming + 1)
+        _link_range_results(neighbours, ids, start, lims, found)
+
+
+def _link_embedding(
+    neighbours: Dict[int, Set[int]],
+    embeddings: np.ndarray,
+    live_ids: np.ndarray,
+    cosine: float
+) -> None:
+    ids = [int(i) for i in live_ids]
+    index = faiss.IndexFlatIP(embeddings.shape[1])
+    for start in range(0, len(ids), QUERY_CHUNK_ROWS):
+        index.add(np.ascontiguousarray(embeddings[live_ids[start:start + QUERY_CHUNK_ROWS]]))
+
+    for start in range(0, len(ids), QUERY_CHUNK_ROWS):
+        queries = np.ascontiguousarray(embeddings[live_ids[start:start + QUERY_CHUNK_ROWS]])
+        lims, _, found = index.range_search(queries, cosine)
+        _link_range_results(neighbours, ids, start, lims, found)
+
+
+def group_duplicates(
+    files: Dict[str, dict],
+    embeddings: np.ndarray,
+    live_ids: np.ndarray,
+    options: dict
+) -> Dict[int, List[int]]:
+    """
+    Group duplicate files.
+
+    files are build manifest entries (id, sha256, dhash); embeddings is
+    addressed by id. Grouping is leader-based rather than transitive:
+    walking ids in order, each file not yet grouped becomes canonical and
+    claims its ungrouped neighbours, so every variant is within the
+    threshold of its canonical and chains of look-alikes never snowball.
+
+    Returns:
+        canonical id -> ids of its variants, for groups with variants
+    """
+    mode = options['mode']
+    if mode == "none":
+        return {}
+
+    neighbours = {entry['id']: set() for entry in files.values()}
+    _link_exact(neighbours, files)
+    if mode == "phash":
+        _link_phash(neighbours, files, options['hamming'])
+    elif mode == "embedding":
+        _link_embedding(neighbours, embeddings, live_ids, options['cosine'])
+
+    groups = {}
+    grouped = set()
+    for item in sorted(neighbours):
+        if item in grouped:
+            continue
+        grouped.add(item)
+        variants = sorted(other for other in neighbours[item] if other not in grouped)
+        if variants:
+            grouped.update(variants)
+            groups[item] = variants
+    return groups
@@ -0,0 +1,213 @@
+"""
+Persistent content-addressed cache of image embeddings.
+
+index_build.py looks every image up by (sha256 of its bytes, model,
+preprocessing version) before decoding it, and stores what it embeds
+afterwards. The cache is a single SQLite file outside the output
+directory (by default under ~/.cache), so it is shared by every build,
+branch and checkout on the machine: rebuilding after moving or renaming
+folders, switching branches or starting a fresh out_dir costs a hash
+per file instead of a forward pass.
+
+Entries also keep the image's difference hash so cache hits skip
+decoding entirely. The file is trimmed to --embedding_cache_mb when
+closed, evicting the least recently used entries first.
+"""
+
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from image_decode import DECODE_VERSION
+
+
+DEFAULT_CACHE_MAX_MB = 2048
+# Bound parameters per lookup query (SQLite limits them)
+LOOKUP_CHUNK = 500
+
+
+def cache_root() -> Path:
+    """Per-user cache directory shared by every checkout (embeddings, exported models)."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / ".cache"
+    return Path(cache_home) / "icon-search"
+
+
+def default_cache_path() -> Path:
+    return cache_root() / "embeddings.sqlite"
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the --embedding_cache family of options to a builder CLI."""
+    parser.add_argument(
+        "--embedding_cache",
+        type=str,
+        default=str(default_cache_path()),
+        help="SQLite file caching embeddings by content hash (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--embedding_cache_mb",
+        type=int,
+        default=DEFAULT_CACHE_MAX_MB,
+        help=f"Maximum cache size in MB, least recently used entries are evicted (default: {DEFAULT_CACHE_MAX_MB})"
+    )
+    parser.add_argument(
+        "--no_embedding_cache",
+        action="store_true",
+        help="Neither read nor write the embedding cache"
+    )
+
+
+def open_cache_from_args(args: argparse.Namespace, model_name: str) -> Optional["EmbeddingCache"]:
+    if args.no_embedding_cache:
+        return None
+    return EmbeddingCache(args.embedding_cache, model_name, args.embedding_cache_mb)
+
+
+class EmbeddingCache:
+    """
+    SQLite embedding cache for one model and preprocessing version.
+
+    A single connection is shared by the decode workers (lookups) and the
+    inference thread (inserts), serialized by a lock.
+    """
+
+    def __init__(self, path, model_name: str, max_mb: int = DEFAULT_CACHE_MAX_MB):
+        self.path = Path(path)
+        self.model_name = model_name
+        self.preprocess = DECODE_VERSION
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Several sharded builds may share the file: wait on their writes
+        self._conn = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                sha256 TEXT NOT NULL,
+                model TEXT NOT NULL,
+                preprocess INTEGER NOT NULL,
+                dim INTEGER NOT NULL,
+                dhash TEXT,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (sha256, model, preprocess)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    def embedding_dim(self) -> Optional[int]:
+        """Dimension of the cached vectors for this model, None if it has none."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT dim FROM embeddings WHERE model = ? AND preprocess = ? LIMIT 1",
+                (self.model_name, self.preprocess)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_many(self, hashes: List[str]) -> Dict[str, Tuple[np.ndarray, str]]:
+        """Look up content hashes, returning sha256 -> (embedding, dhash) for hits."""
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+
+        with self._lock:
+            for start in range(0, len(unique), LOOKUP_CHUNK):
+                chunk = unique[start:start + LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT sha256, dim, dhash, vector FROM embeddings "
+                    f"WHERE model = ? AND preprocess = ? AND sha256 IN ({placeholders})",
+                    [self.model_name, self.preprocess] + chunk
+                ).fetchall()
+                for sha256, dim, dhash, vector in rows:
+                    embedding = np.frombuffer(vector, dtype=np.float32)
+                    if embedding.shape[0] == dim:
+                        found[sha256] = (embedding, dhash)
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE sha256 = ? AND model = ? AND preprocess = ?",
+                    [(now, sha256, self.model_name, self.preprocess) for sha256 in found]
+                )
+                self._conn.commit()
+
+            self.hits += sum(1 for sha256 in hashes if sha256 in found)
+            self.misses += sum(1 for sha256 in hashes if sha256 not in found)
+        return found
+
+    def put_many(self, entries: List[Tuple[str, str, np.ndarray]]) -> None:
+        """Store (sha256, dhash, embedding) entries."""
+        if not entries:
+            return
+        now = time.time()
+        rows = [
+            (
+                sha256, self.model_name, self.preprocess, embedding.shape[0], dhash,
+                np.ascontiguousarray(embedding, dtype=np.float32).tobytes(), now
+            )
+            for sha256, dhash, embedding in entries
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings "
+                "(sha256, model, preprocess, dim, dhash, vector, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+        return row[0]
+
+    def evict(self) -> None:
+        """Drop least recently used entries (of any model) until under max size."""
+        excess = self.size_bytes() - self.max_bytes
+        if excess <= 0:
+            return
+
+        with self._lock:
+            keys = []
+            freed = 0
+            cursor = self._conn.execute(
+                "SELECT sha256, model, preprocess, LENGTH(vector) FROM embeddings ORDER BY last_used"
+            )
+            for sha256, model, preprocess, size in cursor:
+                keys.append((sha256, model, preprocess))
+                freed += size
+                if freed >= excess:
+                    break
+
+            self._conn.executemany(
+                "DELETE FROM embeddings WHERE sha256 = ? AND model = ? AND preprocess = ?", keys
+            )
+            self._conn.commit()
+            self._conn.execute("PRAGMA incremental_vacuum")
+            self.evicted += len(keys)
+
+    def close(self) -> None:
+        self.evict()
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,66 @@
+"""
+Memory-mapped .npy embedding store.
+
+index_build.py writes each batch of embeddings straight into a
+preallocated memory-mapped matrix instead of keeping a Python list and
+calling np.vstack, so memory stays bounded by the batch size. The final
+embeddings.npy next to faiss.index is row-addressed by index id: row i
+holds the vector of metadata id i (rows of removed ids are zero).
+"""
+
+import os
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import numpy as np
+
+
+EMBEDDINGS_FILENAME = "embeddings.npy"
+# Rows copied or added to FAISS per step when streaming from a store
+CHUNK_ROWS = 8192
+
+
+def create_store(path: Path, rows: int, dim: int) -> np.memmap:
+    """Preallocate a zeroed float32 (rows, dim) store on disk."""
+    return np.lib.format.open_memmap(
+        str(path), mode='w+', dtype=np.float32, shape=(rows, dim)
+    )
+
+
+def open_store(path: Path, writable: bool = False) -> np.memmap:
+    """Memory-map an existing store."""
+    return np.load(str(path), mmap_mode='r+' if writable else 'r')
+
+
+def iter_chunks(store: np.ndarray, rows: int) -> Iterator[Tuple[int, np.ndarray]]:
+    """Yield (start_row, chunk) over the first rows of a store."""
+    for start in range(0, rows, CHUNK_ROWS):
+        yield start, np.ascontiguousarray(store[start:min(start + CHUNK_ROWS, rows)])
+
+
+def copy_rows(source: np.ndarray, target: np.ndarray, rows: int, target_start: int = 0) -> None:
+    """Copy the first rows of source into target chunk by chunk."""
+    for start, chunk in iter_chunks(source, rows):
+        target[target_start + start:target_start + start + len(chunk)] = chunk
+
+
+def resize_store(store: np.memmap, path: Path, rows: int) -> np.memmap:
+    """
+    Grow or shrink a store to exactly rows rows.
+
+    The data is copied chunk by chunk into a new file that then replaces
+    the old one, so memory use stays bounded. Returns the writable new map.
+    """
+    if store.shape[0] == rows:
+        return store
+
+    tmp_path = path.with_name(path.name + '.resize')
+    resized = create_store(tmp_path, rows, store.shape[1])
+    copy_rows(store, resized, min(rows, store.shape[0]))
+    resized.flush()
+    del resized
+
+    store.flush()
+    del store
+    os.replace(tmp_path, path)
+    return open_store(path, writable=True)
@@ -0,0 +1,330 @@
+"""
+FAISS index construction and loading shared by the builder and every loader.
+
+index_build.py picks an index type (exact flat, IVF, HNSW, PQ or scalar
+quantized, optionally PCA-reduced), trains it on the collected
+embeddings and writes a JSON sidecar next to the index (faiss.index.json)
+with the type and its search parameters. load_index() reads the index
+and applies those parameters, so search.py, clip_server.py and the other
+scripts search every index type the way it was built to be searched.
+"""
+
+import argparse
+import json
+from pathlib import Path
+from typing import Optional, Tuple
+
+import faiss
+import numpy as np
+
+from build_profile import profile_stage
+
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "sq8", "sq_fp16")
+DEFAULT_INDEX_TYPE = "flat"
+SIDECAR_SUFFIX = ".json"
+
+DEFAULT_NPROBE = 16
+DEFAULT_PQ_M = 32
+DEFAULT_HNSW_M = 32
+DEFAULT_EF_SEARCH = 64
+# Training points per IVF centroid (faiss warns below 39)
+TRAIN_POINTS_PER_CENTROID = 64
+# k-means needs 39 points per centroid, for IVF lists and PQ codes alike.
+# A PQ sub-quantizer has 2^nbits centroids, so 8-bit codes need 9984
+# training points; smaller inputs get fewer bits per code, down to
+# PQ_MIN_NBITS.
+MIN_TRAIN_POINTS_PER_CENTROID = 39
+PQ_MAX_NBITS = 8
+PQ_MIN_NBITS = 4
+PQ_MIN_TRAIN_POINTS = MIN_TRAIN_POINTS_PER_CENTROID * 2 ** PQ_MIN_NBITS
+MAX_TRAIN_POINTS = 100_000
+ADD_CHUNK_ROWS = 8192
+
+
+def sidecar_path_for(index_path) -> Path:
+    index_path = Path(index_path)
+    return index_path.with_name(index_path.name + SIDECAR_SUFFIX)
+
+
+def default_nlist(ntotal: int) -> int:
+    """Roughly 4 * sqrt(n) lists, capped so each list gets enough training points."""
+    nlist = int(4 * np.sqrt(ntotal))
+    nlist = min(nlist, ntotal // TRAIN_POINTS_PER_CENTROID)
+    return max(1, nlist)
+
+
+def pq_nbits(ntotal: int) -> Optional[int]:
+    """Bits per PQ code that ntotal training points can train, or None if too few."""
+    for nbits in range(PQ_MAX_NBITS, PQ_MIN_NBITS - 1, -1):
+        if ntotal >= MIN_TRAIN_POINTS_PER_CENTROID * 2 ** nbits:
+            return nbits
+    return None
+
+
+def make_index_options(
+    index_type: str = DEFAULT_INDEX_TYPE,
+    nlist: Optional[int] = None,
+    nprobe: int = DEFAULT_NPROBE,
+    pq_m: int = DEFAULT_PQ_M,
+    hnsw_m: int = DEFAULT_HNSW_M,
+    ef_search: int = DEFAULT_EF_SEARCH,
+    pca_dim: int = 0
+) -> dict:
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type: {index_type}")
+    return {
+        "index_type": index_type,
+        "nlist": nlist,
+        "nprobe": nprobe,
+        "pq_m": pq_m,
+        "hnsw_m": hnsw_m,
+        "ef_search": ef_search,
+        "pca_dim": pca_dim,
+    }
+
+
+def add_index_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the --index_type family of options to a builder CLI."""
+    parser.add_argument(
+        "--index_type",
+        type=str,
+        choices=INDEX_TYPES,
+        default=None,
+        help=f"FAISS index type (default: {DEFAULT_INDEX_TYPE}, or the previous one for --incremental)"
+    )
+    parser.add_argument(
+        "--nlist",
+        type=int,
+        default=None,
+        help="Inverted lists for ivf_* types (default: ~4*sqrt(n))"
+    )
+    parser.add_argument(
+        "--nprobe",
+        type=int,
+        default=DEFAULT_NPROBE,
+        help=f"Lists visited per query for ivf_* types (default: {DEFAULT_NPROBE})"
+    )
+    parser.add_argument(
+        "--pq_m",
+        type=int,
+        default=DEFAULT_PQ_M,
+        help=f"PQ sub-quantizers for ivf_pq, must divide the dimension (default: {DEFAULT_PQ_M}); codes are 8-bit from 9984 vectors, fewer bits below"
+    )
+    parser.add_argument(
+        "--hnsw_m",
+        type=int,
+        default=DEFAULT_HNSW_M,
+        help=f"Graph neighbours per node for hnsw (default: {DEFAULT_HNSW_M})"
+    )
+    parser.add_argument(
+        "--ef_search",
+        type=int,
+        default=DEFAULT_EF_SEARCH,
+        help=f"Search depth for hnsw (default: {DEFAULT_EF_SEARCH})"
+    )
+    parser.add_argument(
+        "--pca_dim",
+        type=int,
+        default=0,
+        help="Reduce vectors to this many dimensions with PCA before indexing (default: off)"
+    )
+
+
+def index_options_from_args(args: argparse.Namespace) -> Optional[dict]:
+    """Index options from CLI args, or None when --index_type was not given."""
+    if args.index_type is None:
+        return None
+    return make_index_options(
+        index_type=args.index_type,
+        nlist=args.nlist,
+        nprobe=args.nprobe,
+        pq_m=args.pq_m,
+        hnsw_m=args.hnsw_m,
+        ef_search=args.ef_search,
+        pca_dim=args.pca_dim
+    )
+
+
+def index_factory_string(options: dict, dim: int, ntotal: int) -> Tuple[str, dict]:
+    """
+    Build the faiss.index_factory description for the options.
+
+    Also the check that ntotal vectors of dim can train an index with these
+    options; builders call it before embedding anything.
+
+    Returns:
+        Tuple (factory_string, search_params)
+    """
+    index_type = options['index_type']
+    pca_dim = options['pca_dim']
+    search_params = {}
+
+    prefix = ""
+    if pca_dim:
+        if pca_dim >= dim:
+            raise ValueError(f"pca_dim ({pca_dim}) must be smaller than the dimension ({dim})")
+        # Re-normalize after the projection so inner product stays cosine-like
+        prefix = f"PCA{pca_dim},L2norm,"
+        dim = pca_dim
+
+    if index_type == "flat":
+        body = "Flat"
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        nlist = options['nlist'] or default_nlist(ntotal)
+        # A single list needs no clustering; more need k-means training points
+        if nlist > 1 and ntotal < nlist * MIN_TRAIN_POINTS_PER_CENTROID:
+            raise ValueError(
+                f"nlist ({nlist}) needs at least {nlist * MIN_TRAIN_POINTS_PER_CENTROID} vectors "
+                f"({MIN_TRAIN_POINTS_PER_CENTROID} per list), got {ntotal}"
+            )
+        if index_type == "ivf_flat":
+            body = f"IVF{nlist},Flat"
+        else:
+            if dim % options['pq_m'] != 0:
+                raise ValueError(f"pq_m ({options['pq_m']}) must divide the dimension ({dim})")
+            nbits = pq_nbits(ntotal)
+            if nbits is None:
+                raise ValueError(f"ivf_pq needs at least {PQ_MIN_TRAIN_POINTS} vectors, got {ntotal}")
+            body = f"IVF{nlist},PQ{options['pq_m']}x{nbits}"
+        search_params['nprobe'] = min(options['nprobe'], nlist)
+    elif index_type == "hnsw":
+        body = f"HNSW{options['hnsw_m']}"
+        search_params['efSearch'] = options['ef_search']
+    elif index_type == "sq8":
+        body = "SQ8"
+    else:
+        body = "SQfp16"
+
+    return prefix + body, search_params
+
+
+def build_faiss_index(
+    embeddings: np.ndarray,
+    ids: np.ndarray,
+    options: dict
+) -> Tuple[faiss.Index, dict]:
+    """
+    Train (if needed) and fill an ID-mapped index from embedding rows.
+
+    embeddings is addressed by id (e.g. the memory-mapped embeddings.npy)
+    and only the rows listed in ids are indexed, chunk by chunk.
+
+    Returns:
+        Tuple (index, sidecar_config)
+    """
+    dim = embeddings.shape[1]
+    ntotal = len(ids)
+    factory, search_params = index_factory_string(options, dim, ntotal)
+    if options['index_type'] == "ivf_pq" and pq_nbits(ntotal) < PQ_MAX_NBITS:
+        print(f"ivf_pq: {ntotal} vectors are too few for {PQ_MAX_NBITS}-bit codes, using {factory}")
+
+    index = faiss.IndexIDMap2(faiss.index_factory(dim, factory, faiss.METRIC_INNER_PRODUCT))
+
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        nlist = options['nlist'] or default_nlist(ntotal)
+        train_count = min(ntotal, max(MAX_TRAIN_POINTS, nlist * MIN_TRAIN_POINTS_PER_CENTROID))
+        train_ids = np.sort(rng.choice(ids, size=train_count, replace=False))
+        with profile_stage("faiss_train", train_count):
+            index.train(np.ascontiguousarray(embeddings[train_ids], dtype=np.float32))
+
+    for start in range(0, ntotal, ADD_CHUNK_ROWS):
+        chunk_ids = ids[start:start + ADD_CHUNK_ROWS]
+        with profile_stage("faiss_add", len(chunk_ids)):
+            index.add_with_ids(np.ascontiguousarray(embeddings[chunk_ids], dtype=np.float32), chunk_ids)
+
+    apply_search_params(index, search_params)
+
+    config = {
+        "index_type": options['index_type'],
+        "factory": factory,
+        "metric": "inner_product",
+        "dim": dim,
+        "pca_dim": options['pca_dim'],
+        "nlist": options['nlist'],
+        "pq_m": options['pq_m'],
+        "hnsw_m": options['hnsw_m'],
+        "ntotal": int(index.ntotal),
+        "search_params": search_params,
+    }
+    return index, config
+
+
+def index_options_from_config(config: dict) -> dict:
+    """Rebuild options from a sidecar so --incremental keeps the previous index type."""
+    search_params = config.get('search_params', {})
+    return make_index_options(
+        index_type=config['index_type'],
+        nlist=config.get('nlist'),
+        nprobe=search_params.get('nprobe', DEFAULT_NPROBE),
+        pq_m=config.get('pq_m', DEFAULT_PQ_M),
+        hnsw_m=config.get('hnsw_m', DEFAULT_HNSW_M),
+        ef_search=search_params.get('efSearch', DEFAULT_EF_SEARCH),
+        pca_dim=config.get('pca_dim', 0)
+    )
+
+
+def _innermost_index(index: faiss.Index) -> faiss.Index:
+    """Strip ID maps and pre-transforms down to the index that does the search."""
+    index = faiss.downcast_index(index)
+    while hasattr(index, 'index'):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def apply_search_params(index: faiss.Index, search_params: dict) -> None:
+    """Set nprobe / efSearch on the searching index."""
+    inner = _innermost_index(index)
+    if 'nprobe' in search_params and hasattr(inner, 'nprobe'):
+        inner.nprobe = search_params['nprobe']
+    if 'efSearch' in search_params and hasattr(inner, 'hnsw'):
+        inner.hnsw.efSearch = search_params['efSearch']
+
+
+def save_index(index: faiss.Index, index_path, config: dict) -> None:
+    """Write the index and its sidecar."""
+    faiss.write_index(index, str(index_path))
+    with open(sidecar_path_for(index_path), 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2)
+
+
+def load_index_config(index_path) -> Optional[dict]:
+    """Sidecar config, or None for indexes built before sidecars existed (flat)."""
+    sidecar_path = sidecar_path_for(index_path)
+    if not sidecar_path.exists():
+        return None
+    with open(sidecar_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def mmap_io_flags(config: Optional[dict]) -> int:
+    """
+    read_index flags that map an index instead of copying it into RAM:
+    IVF inverted lists are mapped from the file, every other type maps
+    its flat codes in place.
+    """
+    if config is not None and config['index_type'].startswith("ivf"):
+        return faiss.IO_FLAG_MMAP
+    return getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+
+
+def load_index(index_path, mmap: bool = False) -> faiss.Index:
+    """
+    Read an index and apply the search parameters from its sidecar.
+
+    mmap=True maps the index read-only (fast cold start, pages loaded on
+    demand); only for indexes that are searched, never modified.
+    """
+    config = load_index_config(index_path)
+    index = None
+    if mmap:
+        try:
+            index = faiss.read_index(str(index_path), mmap_io_flags(config))
+        except RuntimeError:
+            index = None  # Layout this faiss cannot map: read it normally
+    if index is None:
+        index = faiss.read_index(str(index_path))
+    if config is not None:
+        apply_search_params(index, config.get('search_params', {}))
+    return index
@@ -0,0 +1,415 @@
+"""
+Exact filtered search over a loaded index.
+
+search.py and clip_server.py used to over-fetch top_k * 5 neighbours and
+drop rows of other categories afterwards, so small categories came back
+short or empty and large top_k values did a lot of wasted work.
+FilteredSearcher restricts the search itself to a subset of ids (e.g. one
+category) and picks the strategy by the subset's cardinality:
+
+    small subsets   (at most subindex_max_fraction of the index) are
+                    searched exhaustively in a flat sub-index built on
+                    first use from the vectors stored in the index itself,
+                    and kept in a bounded LRU cache
+    larger subsets  search the main index with a FAISS IDSelectorBitmap,
+                    so IVF and HNSW indexes are exactly as approximate as
+                    an unfiltered search; a subset that still comes back
+                    short falls back to a sub-index
+
+Either way a query gets the top_k of the subset (as scored by the index,
+quantization included), and fewer only when the subset is smaller.
+
+Subsets come from filters, dicts with any of these fields:
+
+    categories              any of these categories
+    exclude_categories      none of these categories
+    path_prefixes           under any of these folders (any depth, e.g.
+                            "SkillsIcons/Fire")
+    exclude_path_prefixes   under none of these folders
+    flags                   all of these flags (metadata_store.FLAGS,
+                            e.g. "nobg")
+    exclude_flags           none of these flags
+
+Fields combine with AND; names and folders are case-insensitive. Every
+category and flag gets a packed bitmap over index positions when the
+searcher is created (folders on the first prefix filter), so compiling a
+filter is a handful of vectorized bitwise operations whose result is
+handed to FAISS as the IDSelectorBitmap itself. Compiled filters are
+cached, so repeated filters also reuse their sub-index.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from pathlib import PurePosixPath
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from metadata_store import FLAGS, iter_paths, metadata_columns
+
+
+DEFAULT_SUBINDEX_MAX_FRACTION = 0.05
+# Vectors held by all cached sub-indexes together
+SUBINDEX_CACHE_MAX_VECTORS = 500_000
+COMPILED_FILTER_CACHE_SIZE = 256
+
+FILTER_FIELDS = (
+    "categories",
+    "exclude_categories",
+    "path_prefixes",
+    "exclude_path_prefixes",
+    "flags",
+    "exclude_flags",
+)
+
+
+def normalize_filter(spec: Optional[dict]) -> Optional[dict]:
+    """
+    Validate a filter and bring it to canonical form (lower case, sorted).
+
+    Returns:
+        The normalized filter, or None when it does not restrict anything
+
+    Raises:
+        ValueError: on unknown fields or flags
+    """
+    if not spec:
+        return None
+    unknown = set(spec) - set(FILTER_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown filter fields: {', '.join(sorted(unknown))}")
+
+    normalized = {}
+    for field in FILTER_FIELDS:
+        values = spec.get(field) or []
+        if isinstance(values, str):
+            values = [values]
+        values = {value.strip().strip("/").lower() for value in values}
+        values.discard("")
+        if field in ("flags", "exclude_flags"):
+            unknown_flags = values - set(FLAGS)
+            if unknown_flags:
+                raise ValueError(
+                    f"Unknown flags: {', '.join(sorted(unknown_flags))} (known: {', '.join(FLAGS)})"
+                )
+        if values:
+            normalized[field] = sorted(values)
+    return normalized or None
+
+
+def filter_key(spec: Optional[dict]) -> Optional[str]:
+    """
+    Canonical key of a filter: equal for filters that select the same ids.
+
+    Returns:
+        The key, or None when the filter does not restrict anything
+
+    Raises:
+        ValueError: on unknown fields or flags
+    """
+    normalized = normalize_filter(spec)
+    if normalized is None:
+        return None
+    return "filter:" + json.dumps(normalized, sort_keys=True)
+
+
+def merge_category_filter(spec: Optional[dict], category: Optional[str]) -> Optional[dict]:
+    """Fold the older single category_filter into a filter."""
+    if not category:
+        return spec
+    spec = dict(spec or {})
+    if spec.get('categories'):
+        raise ValueError("Use either category_filter or filter.categories, not both")
+    spec['categories'] = [category]
+    return spec
+
+
+def _bitmap_of(positions: np.ndarray, ntotal: int) -> np.ndarray:
+    """Packed bitmap in the IDSelectorBitmap layout (bit i & 7 of byte i >> 3)."""
+    mask = np.zeros(ntotal, dtype=bool)
+    mask[positions] = True
+    return np.packbits(mask, bitorder='little')
+
+
+class IdSubset:
+    """
+    Positions of a subset of the index, as a packed FAISS bitmap and as a
+    sorted array; whichever one it was not created from is derived on use.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        ntotal: int,
+        positions: Optional[np.ndarray] = None,
+        bitmap: Optional[np.ndarray] = None
+    ):
+        self.key = key
+        self.ntotal = ntotal
+        self._positions = positions
+        self._bitmap = bitmap
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    @property
+    def positions(self) -> np.ndarray:
+        if self._positions is None:
+            mask = np.unpackbits(self._bitmap, count=self.ntotal, bitorder='little')
+            self._positions = np.flatnonzero(mask)
+        return self._positions
+
+    def bitmap(self) -> np.ndarray:
+        if self._bitmap is None:
+            self._bitmap = _bitmap_of(self._positions, self.ntotal)
+        return self._bitmap
+
+
+class FilteredSearcher:
+    """
+    Search an (ID-mapped) index, optionally restricted to an IdSubset.
+
+    Selectors and sub-indexes work on positions inside the index wrapped
+    by IndexIDMap2, which skips id translation during the search; labels
+    are mapped back to ids at the end.
+    """
+
+    def __init__(
+        self,
+        index: faiss.Index,
+        metadata: Mapping[int, dict],
+        subindex_max_fraction: float = DEFAULT_SUBINDEX_MAX_FRACTION
+    ):
+        self.index = index
+        self.subindex_max_fraction = subindex_max_fraction
+
+        wrapped = faiss.downcast_index(index)
+        if hasattr(wrapped, 'id_map'):
+            self.ids = faiss.vector_to_array(wrapped.id_map).astype(np.int64)
+            self.inner = faiss.downcast_index(wrapped.index)
+        else:
+            # Indexes built before ids were stable: position is the id
+            self.ids = np.arange(wrapped.ntotal, dtype=np.int64)
+            self.inner = wrapped
+        self._id_order = np.argsort(self.ids, kind='stable')
+        self._sorted_ids = self.ids[self._id_order]
+
+        # PCA and friends: sub-indexes live in the transformed space
+        if isinstance(self.inner, faiss.IndexPreTransform):
+            self.pretransform = self.inner
+            self.base = faiss.downcast_index(self.inner.index)
+        else:
+            self.pretransform = None
+            self.base = self.inner
+
+        self._lock = threading.Lock()
+        self._subindexes: "OrderedDict[str, Tuple[faiss.Index, np.ndarray]]" = OrderedDict()
+        self._subindex_vectors = 0
+        self._direct_map_ready = False
+        self._compiled: "OrderedDict[str, IdSubset]" = OrderedDict()
+
+        # Bitmaps of every category and flag; folders on first use
+        ntotal = self.inner.ntotal
+        self.metadata = metadata
+        self._full = _bitmap_of(np.arange(ntotal), ntotal)
+        columns = metadata_columns(metadata)
+        self._row_positions = self._locate(columns['ids'])
+        present = self._row_positions >= 0
+
+        self._category_bitmaps: Dict[str, np.ndarray] = {}
+        for code, category in enumerate(columns['categories']):
+            bitmap = _bitmap_of(self._row_positions[present & (columns['category_codes'] == code)], ntotal)
+            key = category.lower()
+            if key in self._category_bitmaps:
+                bitmap |= self._category_bitmaps[key]
+            self._category_bitmaps[key] = bitmap
+
+        self._flag_bitmaps = {
+            name: _bitmap_of(self._row_positions[present & (columns['flags'] & bit != 0)], ntotal)
+            for name, bit in FLAGS.items()
+        }
+        self._folder_positions: Optional[Dict[str, np.ndarray]] = None
+
+    def _locate(self, ids: np.ndarray) -> np.ndarray:
+        """Index position of each id, -1 for ids missing from the index."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(self._sorted_ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        found = np.minimum(np.searchsorted(self._sorted_ids, ids), len(self._sorted_ids) - 1)
+        return np.where(self._sorted_ids[found] == ids, self._id_order[found], -1)
+
+    def _folders(self) -> Dict[str, np.ndarray]:
+        """Lower-case folder (every depth) -> positions of the images under it."""
+        with self._lock:
+            if self._folder_positions is None:
+                folders: Dict[str, List[int]] = {}
+                for row, (_, path) in enumerate(iter_paths(self.metadata)):
+                    position = int(self._row_positions[row])
+                    if position < 0:
+                        continue
+                    parents = PurePosixPath(path.lower()).parents
+                    for folder in list(parents)[:-1]:
+                        folders.setdefault(str(folder), []).append(position)
+                self._folder_positions = {
+                    folder: np.array(positions, dtype=np.int64) for folder, positions in folders.items()
+                }
+            return self._folder_positions
+
+    def _any_of(self, bitmaps: Dict[str, np.ndarray], names: List[str]) -> np.ndarray:
+        result = np.zeros_like(self._full)
+        for name in names:
+            if name in bitmaps:
+                result |= bitmaps[name]
+        return result
+
+    def _any_folder(self, prefixes: List[str]) -> np.ndarray:
+        folders = self._folders()
+        positions = [folders[prefix] for prefix in prefixes if prefix in folders]
+        if not positions:
+            return np.zeros_like(self._full)
+        return _bitmap_of(np.concatenate(positions), self.inner.ntotal)
+
+    def compile_filter(self, spec: Optional[dict]) -> Optional[IdSubset]:
+        """
+        Compile a filter (see the module docstring) into a subset.
+
+        Returns:
+            The subset, or None when the filter does not restrict anything
+
+        Raises:
+            ValueError: on unknown fields or flags
+        """
+        normalized = normalize_filter(spec)
+        if normalized is None:
+            return None
+        key = filter_key(normalized)
+        with self._lock:
+            cached = self._compiled.get(key)
+            if cached is not None:
+                self._compiled.move_to_end(key)
+                return cached
+
+        bitmap = self._full.copy()
+        if 'categories' in normalized:
+            bitmap &= self._any_of(self._category_bitmaps, normalized['categories'])
+        if 'path_prefixes' in normalized:
+            bitmap &= self._any_folder(normalized['path_prefixes'])
+        for flag in normalized.get('flags', []):
+            bitmap &= self._flag_bitmaps[flag]
+        if 'exclude_categories' in normalized:
+            bitmap &= ~self._any_of(self._category_bitmaps, normalized['exclude_categories'])
+        if 'exclude_path_prefixes' in normalized:
+            bitmap &= ~self._any_folder(normalized['exclude_path_prefixes'])
+        if 'exclude_flags' in normalized:
+            bitmap &= ~self._any_of(self._flag_bitmaps, normalized['exclude_flags'])
+
+        subset = IdSubset(key, self.inner.ntotal, bitmap=bitmap)
+        with self._lock:
+            self._compiled[key] = subset
+            while len(self._compiled) > COMPILED_FILTER_CACHE_SIZE:
+                self._compiled.popitem(last=False)
+        return subset
+
+    def category_subset(self, category: str) -> IdSubset:
+        """Subset of one category (case-insensitive); empty for unknown categories."""
+        return self.compile_filter({"categories": [category]})
+
+    def search(
+        self,
+        queries: np.ndarray,
+        top_k: int,
+        subset: Optional[IdSubset] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Search like faiss.Index.search, restricted to subset when given.
+
+        Returns:
+            Tuple (scores, ids), each of shape (len(queries), k) with
+            k = min(top_k, candidates); missing hits have id -1
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if subset is None:
+            return self.index.search(queries, min(top_k, self.index.ntotal))
+
+        k = min(top_k, len(subset))
+        if k == 0:
+            return np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+
+        if len(subset) <= self.subindex_max_fraction * self.inner.ntotal:
+            scores, labels = self._search_subindex(queries, k, subset)
+        else:
+            scores, labels = self._search_selector(queries, k, subset)
+            if (labels < 0).any():
+                scores, labels = self._search_subindex(queries, k, subset)
+
+        return scores, np.where(labels >= 0, self.ids[np.maximum(labels, 0)], -1)
+
+    def _search_selector(self, queries: np.ndarray, k: int, subset: IdSubset) -> Tuple[np.ndarray, np.ndarray]:
+        bitmap = subset.bitmap()
+        selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+
+        if isinstance(self.base, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=self.base.nprobe)
+        elif isinstance(self.base, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=max(self.base.hnsw.efSearch, k))
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        if self.pretransform is not None:
+            outer = faiss.SearchParametersPreTransform()
+            outer.index_params = params
+            params = outer
+
+        return self.inner.search(queries, k, params=params)
+
+    def _search_subindex(self, queries: np.ndarray, k: int, subset: IdSubset) -> Tuple[np.ndarray, np.ndarray]:
+        subindex, positions = self._subindex(subset)
+        if self.pretransform is not None:
+            for i in range(self.pretransform.chain.size()):
+                queries = faiss.downcast_VectorTransform(self.pretransform.chain.at(i)).apply(queries)
+
+        scores, rows = subindex.search(np.ascontiguousarray(queries, dtype=np.float32), k)
+        return scores, np.where(rows >= 0, positions[np.maximum(rows, 0)], -1)
+
+    def _ensure_direct_map(self) -> None:
+        """IVF indexes can only reconstruct vectors with a direct map (call with the lock held)."""
+        if isinstance(self.base, faiss.IndexIVF) and not self._direct_map_ready:
+            self.base.make_direct_map()
+            self._direct_map_ready = True
+
+    def stored_vectors(self, ids: np.ndarray) -> np.ndarray:
+        """
+        The vectors stored for ids, decoded (quantization included) and in
+        the space queries are given in, so they can be searched with.
+
+        Raises:
+            KeyError: when an id is not in the index
+        """
+        positions = self._locate(ids)
+        if (positions < 0).any():
+            raise KeyError(int(np.asarray(ids)[positions < 0][0]))
+        with self._lock:
+            self._ensure_direct_map()
+        return self.inner.reconstruct_batch(positions)
+
+    def _subindex(self, subset: IdSubset) -> Tuple[faiss.Index, np.ndarray]:
+        """Flat inner-product index over the subset's stored vectors, cached LRU."""
+        with self._lock:
+            cached = self._subindexes.get(subset.key)
+            if cached is not None:
+                self._subindexes.move_to_end(subset.key)
+                return cached
+
+            self._ensure_direct_map()
+            # Decoded vectors: scores match what the index itself computes
+            vectors = self.base.reconstruct_batch(subset.positions)
+            subindex = faiss.IndexFlatIP(self.base.d)
+            subindex.add(np.ascontiguousarray(vectors, dtype=np.float32))
+
+            self._subindexes[subset.key] = (subindex, subset.positions)
+            self._subindex_vectors += len(subset)
+            while self._subindex_vectors > SUBINDEX_CACHE_MAX_VECTORS and len(self._subindexes) > 1:
+                _, (_, evicted) = self._subindexes.popitem(last=False)
+                self._subindex_vectors -= len(evicted)
+            return subindex, subset.positions
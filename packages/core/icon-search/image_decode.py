@@ -0,0 +1,96 @@
+"""
+Image decoding for CLIP preprocessing.
+
+CLIPProcessor shrinks every image so its shortest side is 224px, so
+decoding a large source asset at native resolution mostly produces
+pixels that are thrown away. load_image_safe() decodes at a reduced
+size instead, keeping the shortest side at least DECODE_MIN_SIDE (twice
+the CLIP input, so the processor's bicubic resize still does the final
+filtering):
+
+    JPEG   DCT-domain downscale while decoding (Image.draft, 1/2..1/8)
+    other  full decode followed by a cheap integer box reduce
+           (Image.reduce) before any further work
+
+Transparency is composited over ALPHA_BACKGROUND. Plain convert("RGB")
+simply drops the alpha channel and keeps whatever colour the encoder
+left under transparent pixels; compositing over black matches that for
+the common case (transparent pixels stored as black) and is well defined
+for the rest.
+
+check_decode.py compares embeddings of this path against
+decode_legacy(), the plain native-resolution convert("RGB") that existing
+embeddings were computed from.
+"""
+
+import io
+from pathlib import Path
+from typing import Optional, Union
+
+from PIL import Image
+
+
+# Bump when decoding changes in a way that changes embeddings
+DECODE_VERSION = 1
+CLIP_INPUT_SIZE = 224
+DECODE_MIN_SIDE = 2 * CLIP_INPUT_SIZE
+ALPHA_BACKGROUND = (0, 0, 0)
+
+
+def _open(source: Union[Path, bytes]) -> Image.Image:
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    return Image.open(source)
+
+
+def _has_alpha(img: Image.Image) -> bool:
+    return img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+
+
+def composite_alpha(img: Image.Image) -> Image.Image:
+    """Flatten transparency over ALPHA_BACKGROUND and return an RGB image."""
+    if not _has_alpha(img):
+        return img.convert("RGB")
+
+    img = img.convert("RGBA")
+    background = Image.new("RGBA", img.size, ALPHA_BACKGROUND + (255,))
+    return Image.alpha_composite(background, img).convert("RGB")
+
+
+def decode_reduced(source: Union[Path, bytes], min_side: int = DECODE_MIN_SIDE) -> Image.Image:
+    """Decode an RGB image whose shortest side is at least min_side (or native if smaller)."""
+    img = _open(source)
+
+    if img.format == "JPEG":
+        # Picks the largest 1/2^k scale that keeps both sides >= min_side
+        img.draft(None, (min_side, min_side))
+    img.load()
+
+    # Integer box reduce needs a mode with real channels
+    if img.mode not in ("RGB", "RGBA", "L", "LA"):
+        img = img.convert("RGBA" if _has_alpha(img) else "RGB")
+    factor = min(img.size) // min_side
+    if factor >= 2:
+        img = img.reduce(factor)
+
+    return composite_alpha(img)
+
+
+def decode_full(source: Union[Path, bytes]) -> Image.Image:
+    """Native-resolution decode with the same alpha handling as decode_reduced."""
+    return composite_alpha(_open(source))
+
+
+def decode_legacy(source: Union[Path, bytes]) -> Image.Image:
+    """The decode used before reduced decoding: native resolution, alpha dropped."""
+    return _open(source).convert("RGB")
+
+
+def load_image_safe(source: Union[Path, bytes], full: bool = False) -> Optional[Image.Image]:
+    """Load an image from a path or raw file bytes, returning None if corrupted."""
+    try:
+        if full:
+            return decode_full(source)
+        return decode_reduced(source)
+    except Exception:
+        return None
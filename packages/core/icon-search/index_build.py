@@ -4,7 +4,13 @@ Index builder for CLIP-based image search.
 Processes a directory of images and creates a FAISS index for semantic search.
 
 Usage:
-    python index_build.py --assets_root "/path/to/images" --out_dir "data" --batch_size 32
+    python index_build.py --assets_root "/path/to/images" --out_dir "data" --batch_size 32 --workers 4
+    python index_build.py --assets_root "/path/to/images" --out_dir "data" --incremental
+    python index_build.py --assets_root "/path/to/images" --out_dir "data" --resume
+    python index_build.py --assets_root "/path/to/images" --out_dir "data" --num_shards 4 --shard_id 0
+    python index_build.py --assets_root "/path/to/images" --out_dir "data" --index_type ivf_pq --nprobe 16
+    python index_build.py --assets_root "/path/to/images" --out_dir "data" --embedding_cache_mb 512
+    python index_build.py --assets_root "/path/to/images" --out_dir "data" --backend onnx
 """
 
 import argparse
@@ -12,18 +18,101 @@ import json
 import os
 import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import faiss
 import numpy as np
 import torch
 from PIL import Image
-from transformers import CLIPModel, CLIPProcessor
+from transformers import CLIPConfig, CLIPModel, CLIPProcessor
+
+from artifacts import (
+    CURRENT_LINK,
+    DEFAULT_KEEP_VERSIONS,
+    INDEX_FILENAME,
+    METADATA_FILENAME,
+    add_version_arguments,
+    discard_version,
+    finalize_version,
+    new_version_dir,
+    prune_versions,
+    publish_version,
+)
+from build_checkpoint import (
+    checkpoint_dir_for,
+    drop_records,
+    load_shards,
+    open_checkpoint,
+    part_dir_for,
+    remove_checkpoint,
+    shard_bounds,
+    write_part_marker,
+    write_shard,
+)
+from build_manifest import (
+    MANIFEST_FILENAME,
+    diff_against_manifest,
+    hash_bytes,
+    load_manifest,
+    refresh_entry,
+    save_manifest,
+)
+from build_profile import (
+    print_report,
+    profile_stage,
+    profiling_suspended,
+    record_stage,
+    reset_profile,
+    write_report,
+)
+from dedup import add_dedup_arguments, compute_dhash, dedup_options_from_args, group_duplicates
+from embedding_cache import EmbeddingCache, add_cache_arguments, open_cache_from_args
+from embedding_store import (
+    EMBEDDINGS_FILENAME,
+    copy_rows,
+    create_store,
+    iter_chunks,
+    open_store,
+    resize_store,
+)
+from faiss_index import (
+    add_index_arguments,
+    build_faiss_index,
+    index_factory_string,
+    index_options_from_args,
+    index_options_from_config,
+    load_index_config,
+    make_index_options,
+    save_index,
+)
+from image_decode import load_image_safe
+from metadata_store import METADATA_BIN_FILENAME, write_metadata_store
+from vision_backend import (
+    DEFAULT_BACKEND,
+    Encoder,
+    add_backend_arguments,
+    backend_cache_key,
+    export_onnx,
+    l2_normalize,
+    onnx_encoder,
+    onnx_export_path,
+    quantize_int8,
+)
 
 
 SUPPORTED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'}
 MODEL_NAME = "openai/clip-vit-base-patch32"
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+# Prepared batches allowed to wait in the queue per decode worker
+PREFETCH_PER_WORKER = 2
+# Batches between checkpoint shard flushes (0 disables checkpointing)
+DEFAULT_CHECKPOINT_EVERY = 50
+
+# (pixel_values, file_records, corrupted_paths, cached_embeddings) produced by a decode worker
+PreparedBatch = Tuple[Optional[torch.Tensor], List[dict], List[str], List[Optional[np.ndarray]]]
 
 
 def get_device() -> str:
@@ -68,44 +157,540 @@ def collect_image_paths(assets_root: Path) -> List[Tuple[str, str]]:
     return image_paths
 
 
-def load_image_safe(path: Path) -> Image.Image:
-    """Load an image, returning None if corrupted."""
-    try:
-        img = Image.open(path)
-        img = img.convert("RGB")
-        return img
-    except Exception:
-        return None
+def prepare_batch(
+    processor: CLIPProcessor,
+    assets_path: Path,
+    batch_infos: List[Tuple[str, str]],
+    cache: Optional[EmbeddingCache] = None
+) -> PreparedBatch:
+    """
+    Read, hash, decode and preprocess a batch of images. Runs on a decode worker thread.
+    
+    Images found in the embedding cache are not decoded at all.
+    
+    Returns:
+        Tuple (pixel_values, file_records, corrupted_paths, cached_embeddings)
+        file_records hold path, category, size, mtime, sha256 and dhash of each kept image.
+        cached_embeddings[i] is the cached vector of file_records[i], or None
+        when it was decoded; pixel_values holds the decoded ones in order and
+        is None when there are none.
+    """
+    read_files = []
+    corrupted = []
+    
+    with profile_stage("read", len(batch_infos)):
+        for rel_path, category in batch_infos:
+            full_path = assets_path / rel_path
+            try:
+                data = full_path.read_bytes()
+                stat = full_path.stat()
+            except OSError:
+                corrupted.append(rel_path)
+                continue
+            read_files.append((rel_path, category, data, stat))
+    
+    with profile_stage("hash", len(read_files)):
+        hashes = [hash_bytes(data) for _, _, data, _ in read_files]
+    
+    cached = {}
+    if cache is not None and read_files:
+        with profile_stage("cache_lookup", len(read_files)):
+            cached = cache.get_many(hashes)
+    
+    images = []
+    file_records = []
+    cached_embeddings = []
+    
+    with profile_stage("decode", sum(1 for sha256 in hashes if sha256 not in cached)):
+        for (rel_path, category, data, stat), sha256 in zip(read_files, hashes):
+            if sha256 in cached:
+                embedding, dhash = cached[sha256]
+            else:
+                img = load_image_safe(data)
+                if img is None:
+                    corrupted.append(rel_path)
+                    continue
+                images.append(img)
+                embedding, dhash = None, compute_dhash(img)
+            
+            cached_embeddings.append(embedding)
+            file_records.append({
+                "path": rel_path,
+                "category": category,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "sha256": sha256,
+                "dhash": dhash
+            })
+    
+    if not images:
+        return None, file_records, corrupted, cached_embeddings
+    
+    with profile_stage("preprocess", len(images)):
+        inputs = processor(images=images, return_tensors="pt")
+    return inputs["pixel_values"], file_records, corrupted, cached_embeddings
 
 
-def process_batch(
+def iter_prepared_batches(
     processor: CLIPProcessor,
+    assets_path: Path,
+    image_infos: List[Tuple[str, str]],
+    batch_size: int,
+    workers: int,
+    cache: Optional[EmbeddingCache] = None
+) -> Iterator[PreparedBatch]:
+    """
+    Yield prepared batches in input order while decoding ahead on a thread pool.
+    
+    At most workers * PREFETCH_PER_WORKER batches are in flight, so memory
+    stays bounded even when inference is slower than decoding.
+    """
+    max_pending = max(1, workers * PREFETCH_PER_WORKER)
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode") as executor:
+        pending = deque()
+        for start in range(0, len(image_infos), batch_size):
+            batch_infos = image_infos[start:start + batch_size]
+            pending.append(executor.submit(prepare_batch, processor, assets_path, batch_infos, cache))
+            
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        
+        while pending:
+            yield pending.popleft().result()
+
+
+def embed_batch(
     model: CLIPModel,
-    images: List[Image.Image],
+    pixel_values: torch.Tensor,
     device: str
 ) -> np.ndarray:
-    """Process a batch of images and return normalized embeddings."""
-    inputs = processor(images=images, return_tensors="pt", padding=True)
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    """Run the vision encoder on preprocessed pixels and return normalized embeddings."""
+    with profile_stage("forward", len(pixel_values)):
+        with torch.no_grad():
+            outputs = model.get_image_features(pixel_values=pixel_values.to(device))
+        # Copying back waits for asynchronous devices, so it belongs to the forward pass
+        outputs = outputs.cpu().numpy()
+    
+    with profile_stage("normalize", len(outputs)):
+        return l2_normalize(outputs)
+
+
+def load_model(device: str) -> Tuple[CLIPProcessor, CLIPModel, int]:
+    """Load the CLIP processor and model, returning them with the embedding dimension."""
+    print(f"Loading CLIP model: {MODEL_NAME}")
+    print(f"Device: {device}")
+    
+    processor = CLIPProcessor.from_pretrained(MODEL_NAME)
+    model = CLIPModel.from_pretrained(MODEL_NAME).to(device)
+    model.eval()
     
+    # Get embedding dimension
+    dummy_input = processor(images=[Image.new("RGB", (224, 224))], return_tensors="pt")
+    dummy_input = {k: v.to(device) for k, v in dummy_input.items()}
     with torch.no_grad():
-        outputs = model.get_image_features(**inputs)
+        dummy_output = model.get_image_features(**dummy_input)
+    embedding_dim = dummy_output.shape[1]
+    print(f"Embedding dimension: {embedding_dim}")
+    
+    return processor, model, embedding_dim
+
+
+def model_embedding_dim() -> int:
+    """Embedding dimension of MODEL_NAME, from its config (the model isn't loaded)."""
+    return CLIPConfig.from_pretrained(MODEL_NAME).projection_dim
+
+
+def load_encoder(device: str, backend: str = DEFAULT_BACKEND) -> Tuple[CLIPProcessor, Encoder, int]:
+    """
+    Load the CLIP processor and an image encoder for the inference backend,
+    returning them with the embedding dimension.
+    
+    The onnx backend exports the vision tower on first use and afterwards
+    runs the cached export without loading the PyTorch model.
+    """
+    if backend == "onnx":
+        export_path = onnx_export_path(MODEL_NAME)
+        processor = CLIPProcessor.from_pretrained(MODEL_NAME)
+        dummy = processor(images=[Image.new("RGB", (224, 224))], return_tensors="pt")["pixel_values"]
+        if not export_path.exists():
+            _, model, _ = load_model("cpu")
+            print(f"Exporting vision encoder to ONNX: {export_path}")
+            export_onnx(model, export_path, dummy.shape[-1])
+            del model
+        print(f"Backend: onnx ({export_path})")
+        encode = onnx_encoder(export_path)
+        return processor, encode, encode(dummy).shape[1]
+    
+    if backend == "torch-int8":
+        # Dynamic quantization only runs on the CPU
+        processor, model, embedding_dim = load_model("cpu")
+        model = quantize_int8(model)
+        device = "cpu"
+        print("Backend: torch-int8 (cpu)")
+    else:
+        processor, model, embedding_dim = load_model(device)
+    
+    def encode(pixel_values: torch.Tensor) -> np.ndarray:
+        return embed_batch(model, pixel_values, device)
+    
+    return processor, encode, embedding_dim
+
+
+def check_backend(
+    processor: CLIPProcessor,
+    encode: Encoder,
+    backend: str,
+    device: str,
+    assets_path: Path,
+    image_infos: List[Tuple[str, str]],
+    samples: int
+) -> None:
+    """Report how closely a non-fp32 backend agrees with fp32 torch on a spread sample."""
+    step = max(1, len(image_infos) // samples)
+    pixel_values, _, _, _ = prepare_batch(processor, assets_path, image_infos[::step][:samples])
+    if pixel_values is None:
+        print("Warning: backend check skipped, no readable images in the sample", file=sys.stderr)
+        return
+    
+    _, reference_model, _ = load_model(device)
+    reference_start = time.time()
+    reference = embed_batch(reference_model, pixel_values, device)
+    reference_elapsed = time.time() - reference_start
+    del reference_model
+    
+    candidate_start = time.time()
+    candidate = encode(pixel_values)
+    candidate_elapsed = time.time() - candidate_start
+    
+    cosines = np.sum(reference * candidate, axis=1)
+    
+    # Nearest neighbour of each sample image within the sample, in both spaces
+    agreement = 1.0
+    if len(reference) > 1:
+        reference_sims = reference @ reference.T
+        candidate_sims = candidate @ candidate.T
+        np.fill_diagonal(reference_sims, -np.inf)
+        np.fill_diagonal(candidate_sims, -np.inf)
+        agreement = float(np.mean(reference_sims.argmax(axis=1) == candidate_sims.argmax(axis=1)))
+    
+    print(f"Backend check ({backend} vs torch fp32, {len(reference)} images):")
+    print(f"  Cosine min / mean: {cosines.min():.4f} / {cosines.mean():.4f}")
+    print(f"  Nearest-neighbour agreement: {agreement:.1%}")
+    print(
+        f"  Speed: {len(reference) / max(reference_elapsed, 1e-9):.1f} -> "
+        f"{len(reference) / max(candidate_elapsed, 1e-9):.1f} images/s"
+    )
+
+
+def embed_images(
+    processor: CLIPProcessor,
+    encode: Optional[Encoder],
+    device: str,
+    assets_path: Path,
+    image_infos: List[Tuple[str, str]],
+    batch_size: int,
+    workers: int,
+    store: np.memmap,
+    first_row: int = 0,
+    checkpoint_dir: Optional[Path] = None,
+    checkpoint_every: int = 0,
+    first_shard: int = 0,
+    cache: Optional[EmbeddingCache] = None,
+    backend: str = DEFAULT_BACKEND
+) -> Tuple[List[dict], List[str], int]:
+    """
+    Embed images with decode workers filling a bounded queue of pixel
+    tensors while this thread only runs inference.
+    
+    Embeddings are written in record order into the memory-mapped store
+    starting at first_row. When checkpointing, the store is flushed and
+    the records are written as a new shard every checkpoint_every batches.
+    
+    Cached embeddings are copied as they are and new ones are added to the
+    cache. encode may be None, in which case the backend is loaded on the
+    first miss.
+    
+    Returns:
+        Tuple (file_records, corrupted_paths, next_shard_index) for the
+        batches not yet written to a shard
+    """
+    total_images = len(image_infos)
+    start_time = time.time()
+    pending_records = []
+    pending_corrupted = []
+    pending_batches = 0
+    shard_index = first_shard
+    row = first_row
+    seen_count = 0
+    
+    batches = iter_prepared_batches(processor, assets_path, image_infos, batch_size, workers, cache)
+    for pixel_values, batch_records, corrupted, cached_embeddings in batches:
+        pending_corrupted.extend(corrupted)
+        seen_count += len(batch_records) + len(corrupted)
+        
+        computed = []
+        if pixel_values is not None:
+            if encode is None:
+                with profile_stage("model_load"):
+                    _, encode, _ = load_encoder(device, backend)
+            computed = encode(pixel_values)
+            if cache is not None:
+                misses = [record for record, cached in zip(batch_records, cached_embeddings) if cached is None]
+                with profile_stage("cache_store", len(misses)):
+                    cache.put_many([
+                        (record['sha256'], record['dhash'], embedding)
+                        for record, embedding in zip(misses, computed)
+                    ])
+        
+        # Interleave cached and computed vectors back into record order
+        with profile_stage("store_write", len(cached_embeddings)):
+            computed_rows = iter(computed)
+            for cached in cached_embeddings:
+                store[row] = cached if cached is not None else next(computed_rows)
+                row += 1
+        pending_records.extend(batch_records)
+        pending_batches += 1
+        
+        if checkpoint_dir is not None and checkpoint_every and pending_batches >= checkpoint_every:
+            with profile_stage("checkpoint", len(pending_records)):
+                store.flush()
+                write_shard(checkpoint_dir, shard_index, pending_records, pending_corrupted)
+            shard_index += 1
+            pending_records, pending_corrupted = [], []
+            pending_batches = 0
+        
+        # Progress update
+        progress = seen_count / total_images * 100
+        rate = (row - first_row) / max(time.time() - start_time, 1e-9)
+        print(
+            f"\rProcessing: {progress:.1f}% ({seen_count}/{total_images}) {rate:.1f} img/s",
+            end="", flush=True
+        )
+    
+    print()  # New line after progress
+    return pending_records, pending_corrupted, shard_index
+
+
+def load_existing_build(out_path: Path, model_key: str = MODEL_NAME) -> Tuple[Optional[dict], Optional[dict]]:
+    """
+    Load the manifest and index config of a previous build for an incremental run.
+    
+    model_key identifies the model and backend (see backend_cache_key).
+    Returns (None, None) when there is nothing usable to update.
+    """
+    manifest = load_manifest(out_path)
+    index_path = out_path / "faiss.index"
+    
+    if manifest is None or not index_path.exists():
+        print("No previous build manifest found, running a full build")
+        return None, None
+    
+    if manifest.get('model') != model_key:
+        print(f"Previous build used model {manifest.get('model')}, running a full build")
+        return None, None
     
-    # Convert to numpy and normalize L2
-    embeddings = outputs.cpu().numpy().astype(np.float32)
-    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
-    norms = np.where(norms == 0, 1, norms)  # Avoid division by zero
-    embeddings = embeddings / norms
+    if not (out_path / EMBEDDINGS_FILENAME).exists():
+        print(f"Previous build has no {EMBEDDINGS_FILENAME}, running a full build")
+        return None, None
     
-    return embeddings
+    return manifest, load_index_config(index_path)
+
+
+def report_corrupted(corrupted_files: List[str]) -> None:
+    """Print the unreadable files that were skipped."""
+    if not corrupted_files:
+        return
+    print(f"\nWarning: {len(corrupted_files)} corrupted/unreadable files skipped:", file=sys.stderr)
+    for path in corrupted_files[:20]:
+        print(f"  - {path}", file=sys.stderr)
+    if len(corrupted_files) > 20:
+        print(f"  ... and {len(corrupted_files) - 20} more", file=sys.stderr)
+
+
+def select_index_ids(
+    files: Dict[str, dict],
+    embeddings_path: Path,
+    dedup_options: dict
+) -> Tuple[np.ndarray, Dict[int, List[int]]]:
+    """
+    Pick the ids to put in the FAISS index, collapsing duplicates if enabled.
+    
+    Returns:
+        Tuple (index_ids, duplicate_groups) where duplicate_groups maps a
+        canonical id to the ids of its variants
+    """
+    live_ids = np.array(sorted(entry['id'] for entry in files.values()), dtype=np.int64)
+    groups = group_duplicates(files, open_store(embeddings_path), live_ids, dedup_options)
+    if not groups:
+        return live_ids, groups
+    
+    variant_ids = {variant for variants in groups.values() for variant in variants}
+    index_ids = np.array([i for i in live_ids if i not in variant_ids], dtype=np.int64)
+    return index_ids, groups
+
+
+def write_outputs(
+    out_path: Path,
+    version_dir: Path,
+    index: faiss.Index,
+    index_config: dict,
+    files: Dict[str, dict],
+    categories: Dict[str, str],
+    duplicate_groups: Optional[Dict[int, List[int]]] = None,
+    model_key: str = MODEL_NAME,
+    keep_versions: int = DEFAULT_KEEP_VERSIONS,
+    dedup_options: Optional[dict] = None
+) -> None:
+    """
+    Publish a new index version together with its build manifest.
+    
+    faiss.index with its sidecar, metadata.jsonl and metadata.bin (both
+    sorted by id) and build_manifest.json are written into version_dir
+    (from new_version_dir, already holding embeddings.npy), which
+    atomically becomes out_path/current once complete (see artifacts);
+    older versions are pruned down to keep_versions.
+    
+    Collapsed duplicates get no metadata record of their own; their paths
+    are listed in the "variants" field of the canonical record.
+    """
+    index_path = version_dir / INDEX_FILENAME
+    save_index(index, index_path, index_config)
+    
+    duplicate_groups = duplicate_groups or {}
+    path_by_id = {entry['id']: path for path, entry in files.items()}
+    variant_ids = {variant for variants in duplicate_groups.values() for variant in variants}
+    
+    # Ids may have gaps after incremental updates or deduplication
+    metadata_path = version_dir / METADATA_FILENAME
+    records = []
+    with open(metadata_path, 'w', encoding='utf-8') as f:
+        for path, entry in sorted(files.items(), key=lambda item: item[1]['id']):
+            if entry['id'] in variant_ids:
+                continue
+            record = {
+                "id": entry['id'],
+                "path": path,
+                "category": categories[path]
+            }
+            if entry['id'] in duplicate_groups:
+                record["variants"] = [path_by_id[i] for i in duplicate_groups[entry['id']]]
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            records.append(record)
+    write_metadata_store(version_dir / METADATA_BIN_FILENAME, records)
+    save_manifest(version_dir, model_key, files, dedup_options)
+    
+    version_dir = finalize_version(version_dir, {
+        "model": model_key,
+        "dim": int(index.d),
+        "count": int(index.ntotal),
+        "index_type": index_config['factory'],
+    })
+    publish_version(out_path, version_dir)
+    # The work directory is gone by now; these resolve to the new version
+    current_dir = out_path / CURRENT_LINK
+    print(f"Published index version: {version_dir.name}")
+    print(f"Saved index to: {current_dir / INDEX_FILENAME} ({index_config['factory']})")
+    print(f"Saved metadata to: {current_dir / METADATA_FILENAME} (+ {METADATA_BIN_FILENAME})")
+    print(f"Saved embeddings to: {current_dir / EMBEDDINGS_FILENAME}")
+    print(f"Saved manifest to: {current_dir / MANIFEST_FILENAME}")
+    pruned = prune_versions(out_path, keep_versions)
+    if pruned:
+        print(f"Pruned {pruned} old index versions")
+
+
+def write_embeddings(
+    out_path: Path,
+    version_dir: Path,
+    work_store: Optional[np.memmap],
+    work_store_path: Path,
+    row_ids: np.ndarray,
+    stale_ids: List[int],
+    total_rows: int,
+    embedding_dim: int,
+    incremental: bool
+) -> Path:
+    """
+    Write embeddings.npy (row i = vector of id i) into the unpublished
+    version_dir; it becomes visible with the rest of the version.
+    
+    A full build assigns ids in row order, so the work store is trimmed and
+    moved into place. An incremental build copies the previous matrix
+    (out_path's, still the published one), zeroes stale rows and scatters
+    the new rows by id, chunk by chunk.
+    """
+    embeddings_path = version_dir / EMBEDDINGS_FILENAME
+    
+    if not incremental:
+        work_store = resize_store(work_store, work_store_path, total_rows)
+        work_store.flush()
+        del work_store
+        os.replace(work_store_path, embeddings_path)
+        return embeddings_path
+    
+    previous = open_store(out_path / EMBEDDINGS_FILENAME)
+    updated = create_store(embeddings_path, total_rows, embedding_dim)
+    copy_rows(previous, updated, min(previous.shape[0], total_rows))
+    del previous
+    
+    if stale_ids:
+        updated[np.array(stale_ids, dtype=np.int64)] = 0
+    if work_store is not None:
+        for start, chunk in iter_chunks(work_store, len(row_ids)):
+            updated[row_ids[start:start + len(chunk)]] = chunk
+    
+    updated.flush()
+    del updated
+    return embeddings_path
+
+
+def report_profile(out_dir: Path, context: dict) -> None:
+    """Print the per-stage table and write build_profile.json into out_dir."""
+    print_report()
+    profile_path = write_report(out_dir, context)
+    print(f"Saved build profile to: {profile_path}")
+
+
+def print_cache_stats(cache: Optional[EmbeddingCache]) -> None:
+    """Summary line for the embedding cache, if one was used."""
+    if cache is None:
+        return
+    stats = cache.stats()
+    print(f"  Embedding cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
 
 
 def build_index(
     assets_root: str,
     out_dir: str,
-    batch_size: int = 32
+    batch_size: int = 32,
+    workers: int = DEFAULT_WORKERS,
+    incremental: bool = False,
+    checkpoint_every: int = DEFAULT_CHECKPOINT_EVERY,
+    resume: bool = False,
+    num_shards: int = 1,
+    shard_id: int = 0,
+    torch_threads: int = 0,
+    index_options: Optional[dict] = None,
+    dedup_options: Optional[dict] = None,
+    cache: Optional[EmbeddingCache] = None,
+    backend: str = DEFAULT_BACKEND,
+    backend_check: int = 0,
+    keep_versions: int = DEFAULT_KEEP_VERSIONS
 ) -> None:
-    """Main function to build the FAISS index."""
+    """
+    Main function to build (or incrementally update) the FAISS index.
+    
+    With num_shards > 1 only the shard_id slice of the sorted image list is
+    embedded and written to out_dir/parts; merge_shards.py builds the index.
+    
+    index_options (see faiss_index.make_index_options) selects the FAISS
+    index type; by default flat, or the previous type for incremental builds.
+    dedup_options (see dedup.add_dedup_arguments) collapses duplicate images.
+    cache (see embedding_cache) supplies and stores embeddings by content hash.
+    backend (see vision_backend) runs the vision encoder; for non-torch
+    backends backend_check sample images are first compared against fp32.
+    Each build publishes a new index version and keeps keep_versions of them.
+    """
     
     assets_path = Path(assets_root)
     out_path = Path(out_dir)
@@ -115,9 +700,13 @@ def build_index(
         sys.exit(1)
     
     out_path.mkdir(parents=True, exist_ok=True)
+    start_time = time.time()
+    reset_profile()
     
     print(f"Collecting images from: {assets_root}")
+    walk_start = time.perf_counter()
     image_infos = collect_image_paths(assets_path)
+    record_stage("walk", time.perf_counter() - walk_start, len(image_infos))
     total_images = len(image_infos)
     print(f"Found {total_images} images")
     
@@ -125,118 +714,295 @@ def build_index(
         print("Error: No images found", file=sys.stderr)
         sys.exit(1)
     
-    # Load model
-    device = get_device()
-    print(f"Loading CLIP model: {MODEL_NAME}")
-    print(f"Device: {device}")
+    sharded = num_shards > 1
+    if sharded:
+        start, end = shard_bounds(total_images, num_shards, shard_id)
+        image_infos = image_infos[start:end]
+        print(f"Shard {shard_id + 1}/{num_shards}: images {start}..{end - 1} ({len(image_infos)})")
     
-    processor = CLIPProcessor.from_pretrained(MODEL_NAME)
-    model = CLIPModel.from_pretrained(MODEL_NAME).to(device)
-    model.eval()
+    if torch_threads:
+        torch.set_num_threads(torch_threads)
     
-    # Get embedding dimension
-    dummy_input = processor(images=[Image.new("RGB", (224, 224))], return_tensors="pt")
-    dummy_input = {k: v.to(device) for k, v in dummy_input.items()}
-    with torch.no_grad():
-        dummy_output = model.get_image_features(**dummy_input)
-    embedding_dim = dummy_output.shape[1]
-    print(f"Embedding dimension: {embedding_dim}")
+    model_key = backend_cache_key(MODEL_NAME, backend)
+    manifest, previous_index_config = None, None
+    if incremental:
+        manifest, previous_index_config = load_existing_build(out_path, model_key)
     
-    # Process images in batches
-    start_time = time.time()
-    all_embeddings = []
-    metadata_records = []
-    corrupted_files = []
-    processed_count = 0
+    if dedup_options is None:
+        # Keep collapsing variants the way the previous build did
+        if manifest is not None and 'dedup' in manifest:
+            dedup_options = manifest['dedup']
+            if dedup_options['mode'] != "none":
+                print(f"Using the previous build's dedup settings ({dedup_options['mode']})")
+        else:
+            dedup_options = {"mode": "none"}
+    if index_options is None:
+        if previous_index_config is not None:
+            index_options = index_options_from_config(previous_index_config)
+        else:
+            index_options = make_index_options()
     
-    batch_images = []
-    batch_infos = []
+    # Work out which files need embedding
+    if manifest is not None:
+        previous_files = manifest['files']
+        unchanged, to_embed, removed_ids = diff_against_manifest(
+            previous_files, assets_path, image_infos
+        )
+        changed_ids = [
+            previous_files[path]['id'] for path, _ in to_embed if path in previous_files
+        ]
+        next_id = manifest['next_id']
+        print(
+            f"Incremental: {len(unchanged)} unchanged, "
+            f"{len(to_embed) - len(changed_ids)} added, "
+            f"{len(changed_ids)} changed, {len(removed_ids)} removed"
+        )
+    else:
+        previous_files = {}
+        unchanged, to_embed, removed_ids, changed_ids = {}, image_infos, [], []
+        next_id = 0
     
-    for idx, (rel_path, category) in enumerate(image_infos):
-        full_path = assets_path / rel_path
-        img = load_image_safe(full_path)
-        
-        if img is None:
-            corrupted_files.append(rel_path)
-            continue
+    # Options the index can't be built with fail now, not after the embedding work
+    if not sharded:
+        try:
+            index_factory_string(index_options, model_embedding_dim(), len(unchanged) + len(to_embed))
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+    
+    # Embeddings stream into a memory-mapped store in a work directory: the
+    # checkpoint dir, or the part dir of a sharded run (its output)
+    if sharded:
+        work_dir = part_dir_for(out_path, shard_id, num_shards)
+    else:
+        work_dir = checkpoint_dir_for(out_path)
+    can_resume = sharded or checkpoint_every > 0
+    if resume and not can_resume:
+        print("Warning: --resume has no effect with --checkpoint_every 0", file=sys.stderr)
+    
+    # Pick up shards flushed by an interrupted run
+    file_records, corrupted_files = [], []
+    next_shard = 0
+    resumed = open_checkpoint(work_dir, model_key, resume and can_resume)
+    if resumed:
+        file_records, corrupted_files, next_shard = load_shards(work_dir)
+        # Files edited (or removed) since they were checkpointed are embedded again
+        stale_rows = [
+            row for row, record in enumerate(file_records)
+            if refresh_entry(assets_path / record['path'], record) is None
+        ]
+        if stale_rows:
+            print(f"Resuming: {len(stale_rows)} checkpointed images changed since, embedding them again")
+            file_records, next_shard = drop_records(
+                work_dir, open_store(work_dir / EMBEDDINGS_FILENAME, writable=True),
+                file_records, corrupted_files, stale_rows
+            )
+        done_paths = {record['path'] for record in file_records}
+        done_paths.update(corrupted_files)
+        to_embed = [info for info in to_embed if info[0] not in done_paths]
+        print(f"Resuming: {len(done_paths)} images already processed in {next_shard} shards")
+    resumed_count = len(file_records)
+    
+    store_path = work_dir / EMBEDDINGS_FILENAME
+    store = None
+    if store_path.exists():
+        store = open_store(store_path, writable=True)
+    
+    # Embed added/changed images (the model is only loaded when needed)
+    device = get_device()
+    processor, encode, embedding_dim = None, None, None
+    embed_elapsed = 0.0
+    if backend != DEFAULT_BACKEND and backend_check:
+        # Even when every vector comes from the cache, on a spread sample of
+        # the whole library; the encoder is then reused for the misses
+        with profile_stage("model_load"):
+            processor, encode, embedding_dim = load_encoder(device, backend)
+        # One-off comparison, kept out of the build profile
+        with profiling_suspended():
+            check_backend(processor, encode, backend, device, assets_path, image_infos, backend_check)
+    if to_embed:
+        # With a warm cache the model may never be needed, so it is loaded on the first miss
+        if encode is None and cache is not None:
+            embedding_dim = cache.embedding_dim()
+        if embedding_dim is None:
+            with profile_stage("model_load"):
+                processor, encode, embedding_dim = load_encoder(device, backend)
+        elif processor is None:
+            processor = CLIPProcessor.from_pretrained(MODEL_NAME)
         
-        batch_images.append(img)
-        batch_infos.append((processed_count, rel_path, category))
+        # One row per image still to embed; unreadable files leave spare rows
+        capacity = resumed_count + len(to_embed)
+        if store is None:
+            store = create_store(store_path, capacity, embedding_dim)
+        elif store.shape[0] < capacity:
+            store = resize_store(store, store_path, capacity)
         
-        # Process batch when full
-        if len(batch_images) >= batch_size:
-            embeddings = process_batch(processor, model, batch_images, device)
-            all_embeddings.append(embeddings)
-            
-            for (record_id, path, cat), _ in zip(batch_infos, range(len(batch_images))):
-                metadata_records.append({
-                    "id": record_id,
-                    "path": path,
-                    "category": cat
-                })
-                processed_count += 1
-            
-            batch_images = []
-            batch_infos = []
-            
-            # Progress update
-            progress = (idx + 1) / total_images * 100
-            print(f"\rProcessing: {progress:.1f}% ({idx + 1}/{total_images})", end="", flush=True)
-    
-    # Process remaining batch
-    if batch_images:
-        embeddings = process_batch(processor, model, batch_images, device)
-        all_embeddings.append(embeddings)
+        print(f"Decode workers: {workers}")
+        embed_start = time.time()
+        tail_records, tail_corrupted, next_shard = embed_images(
+            processor, encode, device, assets_path, to_embed, batch_size, workers,
+            store,
+            first_row=resumed_count,
+            checkpoint_dir=work_dir if can_resume else None,
+            checkpoint_every=checkpoint_every,
+            first_shard=next_shard,
+            cache=cache,
+            backend=backend
+        )
+        embed_elapsed = time.time() - embed_start
         
-        for (record_id, path, cat), _ in zip(batch_infos, range(len(batch_images))):
-            metadata_records.append({
-                "id": record_id,
-                "path": path,
-                "category": cat
-            })
-            processed_count += 1
+        store.flush()
+        write_shard(work_dir, next_shard, tail_records, tail_corrupted)
+        file_records, corrupted_files, _ = load_shards(work_dir)
     
-    print()  # New line after progress
+    if embedding_dim is None:
+        if store is not None:
+            embedding_dim = store.shape[1]
+        elif manifest is not None:
+            embedding_dim = open_store(out_path / EMBEDDINGS_FILENAME).shape[1]
     
-    # Report corrupted files
-    if corrupted_files:
-        print(f"\nWarning: {len(corrupted_files)} corrupted/unreadable files skipped:", file=sys.stderr)
-        for path in corrupted_files[:20]:
-            print(f"  - {path}", file=sys.stderr)
-        if len(corrupted_files) > 20:
-            print(f"  ... and {len(corrupted_files) - 20} more", file=sys.stderr)
+    report_corrupted(corrupted_files)
     
-    # Combine all embeddings
-    all_embeddings_np = np.vstack(all_embeddings)
+    if sharded:
+        write_part_marker(work_dir, {
+            "model": model_key,
+            "shard_id": shard_id,
+            "num_shards": num_shards,
+            "images": len(image_infos),
+            "embedded": len(file_records),
+            "corrupted": len(corrupted_files)
+        })
+        elapsed = time.time() - start_time
+        embedded_count = len(file_records) - resumed_count
+        print(f"\n{'='*50}")
+        print(f"Shard {shard_id + 1}/{num_shards} complete!")
+        print(f"  Images in shard: {len(image_infos)}")
+        print(f"  Embedded this run: {embedded_count}")
+        print(f"  Output: {work_dir}")
+        print(f"  Time elapsed: {elapsed:.1f}s")
+        print(f"  Throughput: {embedded_count / max(embed_elapsed, 1e-9):.1f} images/s")
+        print_cache_stats(cache)
+        print(f"  Corrupted/skipped: {len(corrupted_files)}")
+        print(f"  Run merge_shards.py --out_dir {out_dir} once every shard is done")
+        print(f"{'='*50}")
+        report_profile(work_dir, {
+            "command": "index_build",
+            "model": model_key,
+            "device": device,
+            "workers": workers,
+            "batch_size": batch_size,
+            "shard_id": shard_id,
+            "num_shards": num_shards,
+            "images": len(image_infos),
+            "embedded": embedded_count,
+        })
+        return
     
-    # Build FAISS index (IndexFlatIP for inner product / cosine similarity on normalized vectors)
-    print(f"\nBuilding FAISS index...")
-    index = faiss.IndexFlatIP(embedding_dim)
-    index.add(all_embeddings_np)
+    # Changed files keep their id; new files get fresh ones
+    new_files = {}
+    new_ids = []
+    for record in file_records:
+        path = record['path']
+        if path in previous_files:
+            record_id = previous_files[path]['id']
+        else:
+            record_id = next_id
+            next_id += 1
+        new_ids.append(record_id)
+        new_files[path] = {
+            "id": record_id,
+            "size": record['size'],
+            "mtime": record['mtime'],
+            "sha256": record['sha256'],
+            "dhash": record['dhash']
+        }
+    row_ids = np.array(new_ids, dtype=np.int64)
     
-    # Save index
-    index_path = out_path / "faiss.index"
-    faiss.write_index(index, str(index_path))
-    print(f"Saved index to: {index_path}")
+    final_files = dict(unchanged)
+    final_files.update(new_files)
     
-    # Save metadata
-    metadata_path = out_path / "metadata.jsonl"
-    with open(metadata_path, 'w', encoding='utf-8') as f:
-        for record in metadata_records:
-            f.write(json.dumps(record, ensure_ascii=False) + '\n')
-    print(f"Saved metadata to: {metadata_path}")
+    if not final_files:
+        print("Error: No readable images found", file=sys.stderr)
+        sys.exit(1)
+    
+    stale_ids = removed_ids + changed_ids
+    version_dir = new_version_dir(out_path)
+    with profile_stage("serialize", len(row_ids)):
+        embeddings_path = write_embeddings(
+            out_path, version_dir, store, store_path, row_ids, stale_ids,
+            total_rows=next_id,
+            embedding_dim=embedding_dim,
+            incremental=manifest is not None
+        )
+    store = None
+    
+    # (Re)build the FAISS index from the mapped embeddings: approximate
+    # types are retrained on the current vectors and HNSW cannot remove ids
+    with profile_stage("dedup", len(final_files)):
+        index_ids, duplicate_groups = select_index_ids(final_files, embeddings_path, dedup_options)
+    duplicate_count = len(final_files) - len(index_ids)
+    if dedup_options['mode'] != "none":
+        print(f"Dedup ({dedup_options['mode']}): {duplicate_count} duplicates collapsed into {len(duplicate_groups)} groups")
+    
+    print(f"\nBuilding FAISS index ({index_options['index_type']})...")
+    try:
+        index, index_config = build_faiss_index(open_store(embeddings_path), index_ids, index_options)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        if manifest is None:
+            # A full build moved the checkpoint's vectors; give them back for --resume
+            os.replace(embeddings_path, store_path)
+        discard_version(version_dir)
+        sys.exit(1)
+    
+    with profile_stage("serialize", len(final_files)):
+        write_outputs(
+            out_path, version_dir, index, index_config, final_files, dict(image_infos), duplicate_groups,
+            model_key=model_key,
+            keep_versions=keep_versions,
+            dedup_options=dedup_options
+        )
+    
+    # Outputs are complete, the work directory is no longer needed
+    remove_checkpoint(work_dir)
     
     # Summary
     elapsed = time.time() - start_time
+    embedded_count = len(file_records) - resumed_count
     print(f"\n{'='*50}")
     print(f"Indexing complete!")
-    print(f"  Total images indexed: {processed_count}")
+    print(f"  Total images indexed: {index.ntotal}")
+    if duplicate_count:
+        print(f"  Duplicates collapsed: {duplicate_count}")
+    print(f"  Embedded this run: {embedded_count}")
+    if resumed_count:
+        print(f"  Resumed from checkpoint: {resumed_count}")
+    if manifest is not None:
+        print(f"  Unchanged (reused): {len(unchanged)}")
+        print(f"  Removed: {len(removed_ids)}")
     print(f"  Embedding dimension: {embedding_dim}")
+    print(f"  Index type: {index_config['factory']}")
     print(f"  Device: {device}")
     print(f"  Model: {MODEL_NAME}")
+    print(f"  Backend: {backend}")
+    print(f"  Decode workers: {workers}")
     print(f"  Time elapsed: {elapsed:.1f}s")
+    print(f"  Throughput: {embedded_count / max(embed_elapsed, 1e-9):.1f} images/s")
+    print_cache_stats(cache)
     print(f"  Corrupted/skipped: {len(corrupted_files)}")
     print(f"{'='*50}")
+    report_profile(out_path, {
+        "command": "index_build",
+        "model": model_key,
+        "device": device,
+        "workers": workers,
+        "batch_size": batch_size,
+        "index_type": index_config['factory'],
+        "images": total_images,
+        "indexed": int(index.ntotal),
+        "embedded": embedded_count,
+        "incremental": manifest is not None,
+    })
 
 
 def main():
@@ -261,9 +1027,100 @@ def main():
         default=32,
         help="Batch size for processing (default: 32)"
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=f"Image decode/preprocess worker threads (default: {DEFAULT_WORKERS})"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only embed images added or changed since the last build in out_dir"
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=DEFAULT_CHECKPOINT_EVERY,
+        help=f"Flush embeddings to a checkpoint shard every N batches, 0 to disable (default: {DEFAULT_CHECKPOINT_EVERY})"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted build from its last completed checkpoint shard"
+    )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=1,
+        help="Split the build across N processes; combine them with merge_shards.py (default: 1)"
+    )
+    parser.add_argument(
+        "--shard_id",
+        type=int,
+        default=0,
+        help="Which shard (0..num_shards-1) this process embeds (default: 0)"
+    )
+    parser.add_argument(
+        "--torch_threads",
+        type=int,
+        default=None,
+        help="Torch intra-op threads (default: torch default, or cores / num_shards when sharded)"
+    )
+    add_index_arguments(parser)
+    add_dedup_arguments(parser)
+    add_cache_arguments(parser)
+    add_backend_arguments(parser)
+    add_version_arguments(parser)
     
     args = parser.parse_args()
-    build_index(args.assets_root, args.out_dir, args.batch_size)
+    
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.checkpoint_every < 0:
+        parser.error("--checkpoint_every cannot be negative")
+    if args.num_shards < 1:
+        parser.error("--num_shards must be at least 1")
+    if not 0 <= args.shard_id < args.num_shards:
+        parser.error("--shard_id must be between 0 and num_shards - 1")
+    if args.num_shards > 1 and args.incremental:
+        parser.error("--incremental cannot be combined with --num_shards")
+    if args.embedding_cache_mb < 0:
+        parser.error("--embedding_cache_mb cannot be negative")
+    if args.backend_check < 0:
+        parser.error("--backend_check cannot be negative")
+    if args.keep_versions < 1:
+        parser.error("--keep_versions must be at least 1")
+    
+    torch_threads = args.torch_threads
+    if torch_threads is None:
+        torch_threads = 0
+        if args.num_shards > 1:
+            torch_threads = max(1, (os.cpu_count() or 1) // args.num_shards)
+    
+    cache = open_cache_from_args(args, backend_cache_key(MODEL_NAME, args.backend))
+    try:
+        build_index(
+            args.assets_root,
+            args.out_dir,
+            args.batch_size,
+            args.workers,
+            incremental=args.incremental,
+            checkpoint_every=args.checkpoint_every,
+            resume=args.resume,
+            num_shards=args.num_shards,
+            shard_id=args.shard_id,
+            torch_threads=torch_threads,
+            index_options=index_options_from_args(args),
+            dedup_options=dedup_options_from_args(args),
+            cache=cache,
+            backend=args.backend,
+            backend_check=args.backend_check,
+            keep_versions=args.keep_versions
+        )
+    finally:
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Merge the parts written by `index_build.py --num_shards N --shard_id K`
+into the final faiss.index, metadata.jsonl and build manifest.
+
+Parts cover contiguous slices of the sorted image list, so concatenating
+them in shard order yields the same ids as a serial build.
+
+Usage:
+    python merge_shards.py --out_dir "data"
+    python merge_shards.py --out_dir "data" --num_shards 4 --keep_parts
+    python merge_shards.py --out_dir "data" --index_type hnsw
+"""
+
+import os
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+from artifacts import DEFAULT_KEEP_VERSIONS, add_version_arguments, discard_version, new_version_dir
+from build_checkpoint import (
+    load_part_marker,
+    load_shards,
+    part_dir_for,
+    parts_dir_for,
+    remove_checkpoint,
+)
+from build_profile import profile_stage, reset_profile
+from dedup import add_dedup_arguments, dedup_options_from_args
+from embedding_store import EMBEDDINGS_FILENAME, copy_rows, create_store, open_store
+from faiss_index import (
+    add_index_arguments,
+    build_faiss_index,
+    index_factory_string,
+    index_options_from_args,
+    make_index_options,
+)
+from index_build import MODEL_NAME, report_corrupted, report_profile, select_index_ids, write_outputs
+
+
+def detect_num_shards(out_path: Path) -> Optional[int]:
+    """Read num_shards from the first part directory found."""
+    parts_dir = parts_dir_for(out_path)
+    if not parts_dir.exists():
+        return None
+    for part_dir in sorted(parts_dir.iterdir()):
+        marker = load_part_marker(part_dir)
+        if marker is not None:
+            return marker['num_shards']
+    return None
+
+
+def merge_shards(
+    out_dir: str,
+    num_shards: Optional[int] = None,
+    keep_parts: bool = False,
+    index_options: Optional[dict] = None,
+    dedup_options: Optional[dict] = None,
+    keep_versions: int = DEFAULT_KEEP_VERSIONS
+) -> None:
+    """Combine all completed parts into the final index artifacts."""
+    out_path = Path(out_dir)
+    if index_options is None:
+        index_options = make_index_options()
+    if dedup_options is None:
+        dedup_options = {"mode": "none"}
+    start_time = time.time()
+    reset_profile()
+
+    if num_shards is None:
+        num_shards = detect_num_shards(out_path)
+    if num_shards is None:
+        print(f"Error: No completed parts found in {parts_dir_for(out_path)}", file=sys.stderr)
+        sys.exit(1)
+
+    # Every part must be complete and built with the same model and backend
+    part_dirs = []
+    model_key = None
+    for shard_id in range(num_shards):
+        part_dir = part_dir_for(out_path, shard_id, num_shards)
+        marker = load_part_marker(part_dir)
+        if marker is None:
+            print(f"Error: Shard {shard_id} is missing or incomplete: {part_dir}", file=sys.stderr)
+            sys.exit(1)
+        if model_key is None:
+            model_key = marker['model']
+        if marker['model'] != model_key or model_key.split('#')[0] != MODEL_NAME:
+            print(
+                f"Error: Shard {shard_id} was built with {marker['model']}, expected {model_key}",
+                file=sys.stderr
+            )
+            sys.exit(1)
+        part_dirs.append(part_dir)
+
+    print(f"Merging {num_shards} shards from {parts_dir_for(out_path)}")
+    part_stores = []
+    file_records = []
+    corrupted_files = []
+    for part_dir in part_dirs:
+        part_records, part_corrupted, _ = load_shards(part_dir)
+        if part_records:
+            part_stores.append((open_store(part_dir / EMBEDDINGS_FILENAME), len(part_records)))
+        file_records.extend(part_records)
+        corrupted_files.extend(part_corrupted)
+
+    report_corrupted(corrupted_files)
+
+    if not file_records:
+        print("Error: No readable images found", file=sys.stderr)
+        sys.exit(1)
+
+    # Sequential ids in shard order, exactly as a serial build assigns them
+    files = {}
+    categories = {}
+    for record_id, record in enumerate(file_records):
+        files[record['path']] = {
+            "id": record_id,
+            "size": record['size'],
+            "mtime": record['mtime'],
+            "sha256": record['sha256'],
+            "dhash": record['dhash']
+        }
+        categories[record['path']] = record['category']
+
+    # Options the index can't be built with fail before any copying
+    embedding_dim = part_stores[0][0].shape[1]
+    try:
+        index_factory_string(index_options, embedding_dim, len(file_records))
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    # Concatenate the part stores into the new version's embeddings.npy
+    # without loading them
+    version_dir = new_version_dir(out_path)
+    embeddings_path = version_dir / EMBEDDINGS_FILENAME
+    with profile_stage("serialize", len(file_records)):
+        embeddings = create_store(embeddings_path, len(file_records), embedding_dim)
+        offset = 0
+        for part_store, rows in part_stores:
+            copy_rows(part_store, embeddings, rows, target_start=offset)
+            offset += rows
+        embeddings.flush()
+        del embeddings
+
+    with profile_stage("dedup", len(files)):
+        index_ids, duplicate_groups = select_index_ids(files, embeddings_path, dedup_options)
+    duplicate_count = len(files) - len(index_ids)
+    if dedup_options['mode'] != "none":
+        print(f"Dedup ({dedup_options['mode']}): {duplicate_count} duplicates collapsed into {len(duplicate_groups)} groups")
+
+    print(f"\nBuilding FAISS index ({index_options['index_type']})...")
+    try:
+        index, index_config = build_faiss_index(open_store(embeddings_path), index_ids, index_options)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        discard_version(version_dir)
+        sys.exit(1)
+
+    with profile_stage("serialize", len(files)):
+        write_outputs(
+            out_path, version_dir, index, index_config, files, categories, duplicate_groups,
+            model_key=model_key,
+            keep_versions=keep_versions,
+            dedup_options=dedup_options
+        )
+
+    if not keep_parts:
+        remove_checkpoint(parts_dir_for(out_path))
+
+    elapsed = time.time() - start_time
+    print(f"\n{'='*50}")
+    print(f"Merge complete!")
+    print(f"  Shards merged: {num_shards}")
+    print(f"  Total images indexed: {index.ntotal}")
+    if duplicate_count:
+        print(f"  Duplicates collapsed: {duplicate_count}")
+    print(f"  Embedding dimension: {embedding_dim}")
+    print(f"  Index type: {index_config['factory']}")
+    print(f"  Model: {MODEL_NAME}")
+    print(f"  Time elapsed: {elapsed:.1f}s")
+    print(f"  Corrupted/skipped: {len(corrupted_files)}")
+    print(f"{'='*50}")
+    report_profile(out_path, {
+        "command": "merge_shards",
+        "model": model_key,
+        "num_shards": num_shards,
+        "index_type": index_config['factory'],
+        "images": len(files),
+        "indexed": int(index.ntotal),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge index_build.py --num_shards parts into the final index"
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=str,
+        default="data",
+        help="Output directory the shards were built into (default: data)"
+    )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=None,
+        help="Number of shards to expect (default: read from the parts)"
+    )
+    parser.add_argument(
+        "--keep_parts",
+        action="store_true",
+        help="Keep out_dir/parts after merging"
+    )
+    add_index_arguments(parser)
+    add_dedup_arguments(parser)
+    add_version_arguments(parser)
+
+    args = parser.parse_args()
+    if args.keep_versions < 1:
+        parser.error("--keep_versions must be at least 1")
+    merge_shards(
+        args.out_dir,
+        args.num_shards,
+        args.keep_parts,
+        index_options=index_options_from_args(args),
+        dedup_options=dedup_options_from_args(args),
+        keep_versions=args.keep_versions
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Compact, memory-mapped metadata store (metadata.bin).
+
+index_build.py writes metadata.bin next to metadata.jsonl. Records are
+stored column-wise in id order:
+
+    ids              int64[n]      sorted index ids (they may have gaps)
+    path_offsets     int64[n + 1]  into path_bytes
+    path_bytes       uint8[]       UTF-8 relative paths, concatenated
+    category_codes   int32[n]      into the header's category list
+    flags            uint8[n]      FLAG_* bits
+    variant_offsets  int64[n + 1]  into variant_bytes
+    variant_bytes    uint8[]       "\\n"-joined variant paths per record
+
+The file starts with MAGIC, a little-endian uint32 header length and a
+JSON header (count, categories, section offsets); sections are 8-byte
+aligned. load_metadata() maps the file instead of parsing it, so startup
+time and resident memory stay nearly constant as the library grows, and
+returns a read-only id -> record mapping that behaves like the dict the
+JSONL loader used to build. Libraries built before metadata.bin existed
+still load from metadata.jsonl.
+"""
+
+import json
+import struct
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+
+
+METADATA_BIN_FILENAME = "metadata.bin"
+MAGIC = b"ICNMETA1"
+ALIGNMENT = 8
+
+FLAG_NOBG = 1
+FLAG_HAS_VARIANTS = 2
+# Name -> bit, for filters that refer to flags by name
+FLAGS = {"nobg": FLAG_NOBG, "has_variants": FLAG_HAS_VARIANTS}
+NOBG_MARKER = "_nobg"
+
+
+def record_flags(record: dict) -> int:
+    flags = 0
+    if NOBG_MARKER in Path(record['path']).stem.lower():
+        flags |= FLAG_NOBG
+    if record.get('variants'):
+        flags |= FLAG_HAS_VARIANTS
+    return flags
+
+
+def _string_table(strings: List[str]) -> tuple:
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+def write_metadata_store(path: Path, records: List[dict]) -> None:
+    """Write records (id, path, category, optional variants), sorted by id, to path."""
+    records = sorted(records, key=lambda record: record['id'])
+    categories = sorted({record['category'] for record in records})
+    category_index = {category: code for code, category in enumerate(categories)}
+
+    path_offsets, path_bytes = _string_table([record['path'] for record in records])
+    variant_offsets, variant_bytes = _string_table(
+        ["\n".join(record.get('variants', [])) for record in records]
+    )
+    sections = {
+        "ids": np.array([record['id'] for record in records], dtype=np.int64),
+        "path_offsets": path_offsets,
+        "path_bytes": path_bytes,
+        "category_codes": np.array([category_index[record['category']] for record in records], dtype=np.int32),
+        "flags": np.array([record_flags(record) for record in records], dtype=np.uint8),
+        "variant_offsets": variant_offsets,
+        "variant_bytes": variant_bytes,
+    }
+
+    # Section offsets are relative to the end of the header
+    layout = {}
+    position = 0
+    for name, array in sections.items():
+        layout[name] = {"offset": position, "dtype": array.dtype.str, "length": int(array.shape[0])}
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({
+        "count": len(records),
+        "categories": categories,
+        "flags": FLAGS,
+        "sections": layout,
+    }).encode('utf-8')
+    # Pad the header so the first section is aligned
+    prefix_length = len(MAGIC) + 4 + len(header)
+    header += b" " * (-prefix_length % ALIGNMENT)
+
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for name, array in sections.items():
+            data = array.tobytes()
+            f.write(data)
+            f.write(b"\0" * (-len(data) % ALIGNMENT))
+    tmp_path.replace(path)
+
+
+class MetadataStore(Mapping):
+    """Read-only id -> record mapping over a memory-mapped metadata.bin."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        raw = np.memmap(self.path, dtype=np.uint8, mode='r')
+        if bytes(raw[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{self.path} is not a metadata store")
+
+        header_length = struct.unpack("<I", bytes(raw[len(MAGIC):len(MAGIC) + 4]))[0]
+        data_start = len(MAGIC) + 4 + header_length
+        header = json.loads(bytes(raw[len(MAGIC) + 4:data_start]))
+
+        self.categories: List[str] = header['categories']
+        self._count = header['count']
+        self._raw = raw
+        for name, section in header['sections'].items():
+            start = data_start + section['offset']
+            dtype = np.dtype(section['dtype'])
+            view = raw[start:start + section['length'] * dtype.itemsize].view(dtype)
+            setattr(self, name, view)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[int]:
+        return (int(i) for i in self.ids)
+
+    def row_of(self, record_id: int) -> int:
+        """Row of an id, or -1 when it has no record."""
+        row = int(np.searchsorted(self.ids, record_id))
+        if row < self._count and self.ids[row] == record_id:
+            return row
+        return -1
+
+    def __contains__(self, record_id) -> bool:
+        return self.row_of(int(record_id)) >= 0
+
+    def path_at(self, row: int) -> str:
+        return bytes(self.path_bytes[self.path_offsets[row]:self.path_offsets[row + 1]]).decode('utf-8')
+
+    def variants_at(self, row: int) -> List[str]:
+        data = bytes(self.variant_bytes[self.variant_offsets[row]:self.variant_offsets[row + 1]])
+        return data.decode('utf-8').split("\n") if data else []
+
+    def __getitem__(self, record_id) -> dict:
+        row = self.row_of(int(record_id))
+        if row < 0:
+            raise KeyError(record_id)
+        return {
+            "id": int(self.ids[row]),
+            "path": self.path_at(row),
+            "category": self.categories[self.category_codes[row]],
+            "variants": self.variants_at(row),
+        }
+
+
+def load_metadata_jsonl(metadata_path) -> Dict[int, dict]:
+    records = []
+    with open(metadata_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+
+    # Key by id: ids are stable across incremental builds and may have gaps
+    return {record['id']: record for record in records}
+
+
+def metadata_columns(metadata: Mapping) -> Dict[str, object]:
+    """
+    Columns of loaded metadata (a MetadataStore or a JSONL dict), in id order.
+
+    Returns:
+        Dict with ids (sorted), categories (the dictionary),
+        category_codes (indexes into categories) and flags (FLAG_* bits)
+    """
+    if isinstance(metadata, MetadataStore):
+        return {
+            "ids": np.asarray(metadata.ids),
+            "categories": metadata.categories,
+            "category_codes": np.asarray(metadata.category_codes),
+            "flags": np.asarray(metadata.flags),
+        }
+
+    ids = np.array(sorted(metadata), dtype=np.int64)
+    records = [metadata[i] for i in ids.tolist()]
+    categories = sorted({record['category'] for record in records})
+    category_index = {category: code for code, category in enumerate(categories)}
+    return {
+        "ids": ids,
+        "categories": categories,
+        "category_codes": np.array([category_index[record['category']] for record in records], dtype=np.int32),
+        "flags": np.array([record_flags(record) for record in records], dtype=np.uint8),
+    }
+
+
+def iter_paths(metadata: Mapping) -> Iterator[Tuple[int, str]]:
+    """(id, path) of every record in id order, without building full records."""
+    if isinstance(metadata, MetadataStore):
+        for row in range(len(metadata)):
+            yield int(metadata.ids[row]), metadata.path_at(row)
+    else:
+        for record_id in sorted(metadata):
+            yield record_id, metadata[record_id]['path']
+
+
+def load_metadata(metadata_path, store_path=None) -> Union[MetadataStore, Dict[int, dict]]:
+    """
+    Load the metadata of an index: the memory-mapped store_path when given
+    (the metadata.bin published alongside metadata_path), else the JSONL at
+    metadata_path.
+    """
+    if store_path is not None:
+        return MetadataStore(store_path)
+    return load_metadata_jsonl(metadata_path)
@@ -0,0 +1,144 @@
+"""
+In-process LRU caches for clip_server.py.
+
+The image picker sends the same handful of queries over and over, so the
+server keeps two caches in memory:
+
+    embeddings  normalized query text -> text embedding, so a repeated
+                query skips tokenization and the text encoder
+    results     (index version, normalized text, top_k, filter) -> result
+                records, so a repeated search skips FAISS as well
+
+Both are bounded by an approximate size in bytes, evict the least recently
+used entries first and can expire entries after a TTL. Result keys carry
+the version of the loaded index, so results computed against another index
+never match; embeddings only depend on the model and survive index changes.
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional
+
+import numpy as np
+
+from text_embedding_cache import normalize_text
+
+
+# Bytes charged per entry on top of its value (key, bookkeeping)
+ENTRY_OVERHEAD = 200
+
+
+def approximate_size(value) -> int:
+    """Rough deep size in bytes of result records (dicts, lists, strings, numbers)."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approximate_size(item) for item in value)
+    return size
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by approximate bytes, with an optional TTL."""
+
+    def __init__(self, max_bytes: int, ttl_seconds: float = 0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._bytes = 0
+        # key -> (value, size, expiry time or 0)
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, count_miss: bool = True):
+        """
+        The cached value, or None on a miss. Lookups that will be retried
+        pass count_miss=False so a miss is only counted once.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] and entry[2] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += count_miss
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value, size: Optional[int] = None) -> None:
+        size = (approximate_size(value) if size is None else size) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        expiry = time.monotonic() + self.ttl if self.ttl > 0 else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expiry)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class EmbeddingLRUCache(LRUCache):
+    """Text embeddings keyed by normalized text."""
+
+    def embed(self, texts: List[str], compute: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """
+        Embeddings of texts in order, calling compute once for the distinct
+        texts that miss.
+        """
+        keys = [normalize_text(text) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key in found or key in missing:
+                continue
+            embedding = self.get(key)
+            if embedding is None:
+                missing[key] = text
+            else:
+                found[key] = embedding
+
+        if missing:
+            computed = compute(list(missing.values()))
+            for key, embedding in zip(missing, computed):
+                embedding = np.array(embedding, dtype=np.float32)
+                self.put(key, embedding, embedding.nbytes + len(key))
+                found[key] = embedding
+
+        return np.stack([found[key] for key in keys])
@@ -5,29 +5,56 @@ Search for images using CLIP text embeddings.
 Usage:
     python search.py --index "data/faiss.index" --metadata "data/metadata.jsonl" --query "Bola de fuego" --top_k 12
     python search.py --index "data/faiss.index" --metadata "data/metadata.jsonl" --query "fire sword" --top_k 12 --category WeaponIcons
+
+Batch mode reads JSONL queries ({"query": ..., "top_k": ..., "category": ...,
+"filter": ...}; all but query optional) from a file or stdin ("-") and
+writes one JSONL result per query to stdout, in input order:
+    python search.py --index "data/faiss.index" --metadata "data/metadata.jsonl" --queries_file queries.jsonl
+
+--timings prints how long each startup phase (imports, index and metadata
+load, model load, encoding, search) took to stderr.
 """
 
+import time
+_IMPORTS_START = time.perf_counter()
+
 import os
 # Fix OpenMP conflict on macOS (torch + faiss both link libomp)
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
 
 import argparse
 import json
+import shutil
 import sys
 from pathlib import Path
-from typing import List, Optional
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, TextIO, Tuple
 
-import faiss
 import numpy as np
-import torch
-from transformers import CLIPModel, CLIPProcessor
+
+from artifacts import load_published
+from build_profile import profile_stage, record_stage, summary
+from embedding_cache import cache_root
+from filtered_search import FilteredSearcher, merge_category_filter
+from text_embedding_cache import TextEmbeddingCache, add_text_cache_arguments, open_text_cache_from_args
+
+# torch and transformers are imported on the first text cache miss only
+if TYPE_CHECKING:
+    from transformers import CLIPTextModelWithProjection, PreTrainedTokenizerBase
 
 
 MODEL_NAME = "openai/clip-vit-base-patch32"
+DEFAULT_TOP_K = 12
+DEFAULT_BATCH_SIZE = 64
+
+
+# Embeds a list of texts into L2-normalized rows
+TextEmbedder = Callable[[List[str]], np.ndarray]
 
 
 def get_device() -> str:
     """Determine the best available device."""
+    import torch
+    
     if torch.cuda.is_available():
         return "cuda"
     if hasattr(torch.backends, 'mps') and torch.backends.mps.is_available():
@@ -35,56 +62,43 @@ def get_device() -> str:
     return "cpu"
 
 
-def load_metadata(metadata_path: str) -> List[dict]:
-    """Load metadata from JSONL file, indexed by id."""
-    records = []
-    with open(metadata_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                record = json.loads(line)
-                records.append(record)
+def get_text_embeddings(
+    tokenizer: "PreTrainedTokenizerBase",
+    model: "CLIPTextModelWithProjection",
+    texts: List[str],
+    device: str
+) -> np.ndarray:
+    """Get normalized text embeddings for a batch of queries."""
+    import torch
+    
+    with profile_stage("tokenize", len(texts)):
+        inputs = tokenizer(texts, return_tensors="pt", padding=True, truncation=True)
     
-    # Sort by id to ensure correct indexing
-    records.sort(key=lambda x: x['id'])
-    return records
+    with profile_stage("text_encode", len(texts)):
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        
+        with torch.no_grad():
+            outputs = model(**inputs).text_embeds
+        
+        # Convert to numpy and normalize L2
+        embeddings = outputs.cpu().numpy().astype(np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms = np.where(norms == 0, 1, norms)
+    return embeddings / norms
 
 
 def get_text_embedding(
-    processor: CLIPProcessor,
-    model: CLIPModel,
+    tokenizer: "PreTrainedTokenizerBase",
+    model: "CLIPTextModelWithProjection",
     text: str,
     device: str
 ) -> np.ndarray:
     """Get normalized text embedding for a query."""
-    inputs = processor(text=[text], return_tensors="pt", padding=True, truncation=True)
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-    
-    with torch.no_grad():
-        outputs = model.get_text_features(**inputs)
-    
-    # Convert to numpy and normalize L2
-    embedding = outputs.cpu().numpy().astype(np.float32)
-    norm = np.linalg.norm(embedding, axis=1, keepdims=True)
-    if norm[0, 0] != 0:
-        embedding = embedding / norm
-    
-    return embedding
+    return get_text_embeddings(tokenizer, model, [text], device)
 
 
-def search_images(
-    index_path: str,
-    metadata_path: str,
-    query: str,
-    top_k: int = 12,
-    category_filter: Optional[str] = None
-) -> dict:
-    """
-    Search for images matching the query.
-    
-    Returns:
-        Dictionary with query info and results
-    """
+def load_search_index(index_path: str, metadata_path: str) -> FilteredSearcher:
+    """Load the published index and metadata, exiting on errors."""
     
     # Validate paths
     if not Path(index_path).exists():
@@ -95,61 +109,316 @@ def search_images(
         print(f"Error: Metadata file not found: {metadata_path}", file=sys.stderr)
         sys.exit(1)
     
-    # Load index and metadata
-    index = faiss.read_index(index_path)
-    metadata = load_metadata(metadata_path)
-    
-    # Load model
-    device = get_device()
-    processor = CLIPProcessor.from_pretrained(MODEL_NAME)
-    model = CLIPModel.from_pretrained(MODEL_NAME).to(device)
-    model.eval()
-    
-    # Get query embedding
-    query_embedding = get_text_embedding(processor, model, query, device)
+    # Load index (memory-mapped: pages are read as the search touches
+    # them instead of copying the whole file) and metadata
+    try:
+        index, metadata, _ = load_published(index_path, metadata_path, mmap=True)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
     
-    # Search with multiplier if filtering
-    search_k = top_k
-    if category_filter:
-        search_k = top_k * 5  # Fetch more results to filter
+    with profile_stage("searcher"):
+        return FilteredSearcher(index, metadata)
+
+
+def text_model_snapshot_dir(model_name: str) -> Path:
+    """Local text-only snapshot of a CLIP model, under the cache root."""
+    return cache_root() / "models" / (model_name.strip("/").replace("/", "--") + "-text")
+
+
+def save_text_model_snapshot(
+    tokenizer: "PreTrainedTokenizerBase",
+    model: "CLIPTextModelWithProjection",
+    snapshot_dir: Path
+) -> None:
+    """Write the snapshot to a temporary directory and move it into place."""
+    tmp_dir = snapshot_dir.with_name(f"{snapshot_dir.name}.tmp{os.getpid()}")
+    try:
+        tokenizer.save_pretrained(tmp_dir)
+        model.save_pretrained(tmp_dir)
+        tmp_dir.rename(snapshot_dir)
+    except OSError:
+        # Another run published it first, or the cache is read-only
+        pass
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_text_model() -> Tuple["PreTrainedTokenizerBase", "CLIPTextModelWithProjection", str]:
+    """
+    Load the tokenizer and text tower of MODEL_NAME.
     
-    # Limit to available vectors
-    search_k = min(search_k, index.ntotal)
+    The first run loads the full CLIP model from the Hugging Face cache,
+    keeps the text encoder and projection only and saves them (with the
+    tokenizer) to a local snapshot; later runs load the snapshot directly,
+    without hub resolution or the vision tower weights. Delete the snapshot
+    directory to rebuild it.
+    """
+    with profile_stage("model_load"):
+        from transformers import AutoTokenizer, CLIPModel, CLIPTextModelWithProjection
+        
+        device = get_device()
+        snapshot_dir = text_model_snapshot_dir(MODEL_NAME)
+        if (snapshot_dir / "config.json").exists():
+            tokenizer = AutoTokenizer.from_pretrained(snapshot_dir, local_files_only=True)
+            model = CLIPTextModelWithProjection.from_pretrained(snapshot_dir, local_files_only=True)
+        else:
+            tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+            full_model = CLIPModel.from_pretrained(MODEL_NAME)
+            config = full_model.config.text_config
+            config.projection_dim = full_model.config.projection_dim
+            model = CLIPTextModelWithProjection(config)
+            model.text_model.load_state_dict(full_model.text_model.state_dict())
+            model.text_projection.load_state_dict(full_model.text_projection.state_dict())
+            del full_model
+            snapshot_dir.parent.mkdir(parents=True, exist_ok=True)
+            save_text_model_snapshot(tokenizer, model, snapshot_dir)
+        
+        model = model.to(device)
+        model.eval()
+    return tokenizer, model, device
+
+
+def make_text_embedder(cache: Optional[TextEmbeddingCache]) -> TextEmbedder:
+    """Embed texts through the cache, loading the model on the first miss only."""
+    loaded = []
     
-    # Search
-    scores, indices = index.search(query_embedding, search_k)
+    def embed_with_model(texts: List[str]) -> np.ndarray:
+        if not loaded:
+            loaded.append(load_text_model())
+        tokenizer, model, device = loaded[0]
+        return get_text_embeddings(tokenizer, model, texts, device)
     
-    # Build results
+    if cache is None:
+        return embed_with_model
+    return lambda texts: cache.embed(texts, embed_with_model)
+
+
+def build_results(metadata, scores: np.ndarray, indices: np.ndarray) -> List[dict]:
+    """Result records for one query's row of scores and ids."""
     results = []
-    for score, idx in zip(scores[0], indices[0]):
-        if idx < 0 or idx >= len(metadata):
+    for score, idx in zip(scores, indices):
+        if idx < 0 or idx not in metadata:
             continue
         
         record = metadata[idx]
-        
-        # Apply category filter
-        if category_filter:
-            if record['category'].lower() != category_filter.lower():
-                continue
-        
         results.append({
             "path": record['path'],
             "score": float(score),
-            "category": record['category']
+            "category": record['category'],
+            "variants": record.get('variants', [])
         })
-        
-        if len(results) >= top_k:
-            break
+    return results
+
+
+def search_images(
+    index_path: str,
+    metadata_path: str,
+    query: str,
+    top_k: int = DEFAULT_TOP_K,
+    category_filter: Optional[str] = None,
+    search_filter: Optional[dict] = None,
+    text_cache: Optional[TextEmbeddingCache] = None
+) -> dict:
+    """
+    Search for images matching the query.
+    
+    Returns:
+        Dictionary with query info and results
+    """
+    searcher = load_search_index(index_path, metadata_path)
+    
+    # Compile the filter before loading the model; it restricts the search
+    # itself instead of over-fetching
+    try:
+        with profile_stage("filter_compile"):
+            subset = searcher.compile_filter(merge_category_filter(search_filter, category_filter))
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    
+    # Get query embedding (the model is only loaded on a cache miss)
+    query_embedding = make_text_embedder(text_cache)([query])
+    
+    # Search
+    with profile_stage("search"):
+        scores, indices = searcher.search(query_embedding, top_k, subset)
     
     return {
         "query": query,
         "top_k": top_k,
         "category_filter": category_filter,
-        "results": results
+        "filter": search_filter,
+        "results": build_results(searcher.metadata, scores[0], indices[0])
     }
 
 
+def parse_query_line(line: str, defaults: dict) -> dict:
+    """
+    One JSONL query, with defaults from the command line for missing fields.
+    
+    Raises:
+        ValueError: when the line is not a valid query
+    """
+    try:
+        job = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid JSON: {e}")
+    if not isinstance(job, dict):
+        raise ValueError("expected a JSON object")
+    
+    query = job.get('query')
+    if not isinstance(query, str) or not query.strip():
+        raise ValueError("query must be a non-empty string")
+    top_k = job.get('top_k', defaults['top_k'])
+    if not isinstance(top_k, int) or top_k < 1:
+        raise ValueError("top_k must be a positive integer")
+    category = job.get('category', defaults['category'])
+    if category is not None and not isinstance(category, str):
+        raise ValueError("category must be a string")
+    search_filter = job.get('filter', defaults['filter'])
+    if search_filter is not None and not isinstance(search_filter, dict):
+        raise ValueError("filter must be a JSON object")
+    
+    return {"query": query, "top_k": top_k, "category": category, "filter": search_filter}
+
+
+def search_batch(
+    searcher: FilteredSearcher,
+    embed: TextEmbedder,
+    jobs: List[dict]
+) -> List[dict]:
+    """Embed a batch of parsed queries at once and search them with one call per distinct filter."""
+    results: List[Optional[dict]] = [None] * len(jobs)
+    
+    # Invalid filters become error results without being embedded
+    subsets = {}
+    for i, job in enumerate(jobs):
+        try:
+            with profile_stage("filter_compile"):
+                subsets[i] = searcher.compile_filter(merge_category_filter(job['filter'], job['category']))
+        except ValueError as e:
+            results[i] = {"query": job['query'], "error": str(e)}
+    
+    valid = list(subsets)
+    if valid:
+        embeddings = embed([jobs[i]['query'] for i in valid])
+        
+        groups: Dict[Optional[str], List[int]] = {}
+        for row, i in enumerate(valid):
+            subset = subsets[i]
+            groups.setdefault(subset.key if subset is not None else None, []).append(row)
+        
+        for rows in groups.values():
+            subset = subsets[valid[rows[0]]]
+            k = max(jobs[valid[row]]['top_k'] for row in rows)
+            with profile_stage("search", len(rows)):
+                scores, indices = searcher.search(embeddings[rows], k, subset)
+            for row, row_scores, row_indices in zip(rows, scores, indices):
+                job = jobs[valid[row]]
+                results[valid[row]] = {
+                    "query": job['query'],
+                    "top_k": job['top_k'],
+                    "category_filter": job['category'],
+                    "filter": job['filter'],
+                    "results": build_results(
+                        searcher.metadata, row_scores[:job['top_k']], row_indices[:job['top_k']]
+                    )
+                }
+    
+    return results
+
+
+def run_queries(
+    searcher: FilteredSearcher,
+    embed: TextEmbedder,
+    lines: Iterable[str],
+    out: TextIO,
+    defaults: dict,
+    batch_size: int = DEFAULT_BATCH_SIZE
+) -> int:
+    """
+    Answer JSONL queries, writing one JSONL result per non-blank input line
+    in input order. Lines that cannot be answered get {"line", "error"}.
+    
+    Returns:
+        Number of queries answered
+    """
+    answered = 0
+    
+    def flush(pending: List[Tuple[int, object]]) -> None:
+        nonlocal answered
+        jobs = [item for _, item in pending if isinstance(item, dict)]
+        searched = iter(search_batch(searcher, embed, jobs) if jobs else [])
+        for line_number, item in pending:
+            if isinstance(item, dict):
+                result = next(searched)
+                if 'error' in result:
+                    result = {"line": line_number, **result}
+                answered += 'results' in result
+            else:
+                result = {"line": line_number, "error": str(item)}
+            out.write(json.dumps(result, ensure_ascii=False) + '\n')
+        out.flush()
+    
+    pending: List[Tuple[int, object]] = []
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            pending.append((line_number, parse_query_line(line, defaults)))
+        except ValueError as e:
+            pending.append((line_number, e))
+        if len(pending) >= batch_size:
+            flush(pending)
+            pending = []
+    if pending:
+        flush(pending)
+    
+    return answered
+
+
+def run_queries_file(
+    args: argparse.Namespace,
+    search_filter: Optional[dict],
+    text_cache: Optional[TextEmbeddingCache]
+) -> None:
+    searcher = load_search_index(args.index, args.metadata)
+    embed = make_text_embedder(text_cache)
+    defaults = {"top_k": args.top_k, "category": args.category, "filter": search_filter}
+    start_time = time.time()
+    
+    if args.queries_file == "-":
+        answered = run_queries(searcher, embed, sys.stdin, sys.stdout, defaults, args.batch_size)
+    else:
+        if not Path(args.queries_file).exists():
+            print(f"Error: Queries file not found: {args.queries_file}", file=sys.stderr)
+            sys.exit(1)
+        with open(args.queries_file, 'r', encoding='utf-8') as f:
+            answered = run_queries(searcher, embed, f, sys.stdout, defaults, args.batch_size)
+    
+    elapsed = time.time() - start_time
+    print(f"Answered {answered} queries in {elapsed:.2f}s", file=sys.stderr)
+    if text_cache is not None:
+        stats = text_cache.stats()
+        print(f"Text cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%})", file=sys.stderr)
+
+
+def print_timings() -> None:
+    """Print the time spent in each startup and query phase to stderr."""
+    report = summary()
+    print(f"\n{'='*50}", file=sys.stderr)
+    print("Timings:", file=sys.stderr)
+    for name, stats in report['stages'].items():
+        calls = f" ({stats['calls']} calls)" if stats['calls'] > 1 else ""
+        print(f"  {name:<18}{stats['total_s'] * 1000:>10.1f} ms{calls}", file=sys.stderr)
+    print(f"  {'total':<18}{(time.perf_counter() - _IMPORTS_START) * 1000:>10.1f} ms", file=sys.stderr)
+    print(f"{'='*50}", file=sys.stderr)
+
+
 def main():
+    record_stage("imports", time.perf_counter() - _IMPORTS_START)
+    
     parser = argparse.ArgumentParser(
         description="Search images using CLIP text embeddings"
     )
@@ -165,38 +434,81 @@ def main():
         required=True,
         help="Path to metadata JSONL file"
     )
-    parser.add_argument(
+    queries = parser.add_mutually_exclusive_group(required=True)
+    queries.add_argument(
         "--query",
         type=str,
-        required=True,
         help="Text query to search for"
     )
+    queries.add_argument(
+        "--queries_file",
+        type=str,
+        help="JSONL file of queries ('-' for stdin); prints one JSONL result per query, in input order"
+    )
     parser.add_argument(
         "--top_k",
         type=int,
-        default=12,
-        help="Number of results to return (default: 12)"
+        default=DEFAULT_TOP_K,
+        help=f"Number of results to return, default for --queries_file lines without top_k (default: {DEFAULT_TOP_K})"
     )
     parser.add_argument(
         "--category",
         type=str,
         default=None,
-        help="Filter results by category (optional)"
+        help="Filter results by category, default for --queries_file lines without category (optional)"
+    )
+    parser.add_argument(
+        "--filter",
+        type=str,
+        default=None,
+        help='JSON filter, e.g. \'{"categories": ["A", "B"], "exclude_path_prefixes": ["A/old"], "flags": ["nobg"]}\' (optional)'
     )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"Queries embedded and searched together with --queries_file (default: {DEFAULT_BATCH_SIZE})"
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print a breakdown of startup and query time by phase to stderr"
+    )
+    add_text_cache_arguments(parser)
     
     args = parser.parse_args()
     
-    result = search_images(
-        index_path=args.index,
-        metadata_path=args.metadata,
-        query=args.query,
-        top_k=args.top_k,
-        category_filter=args.category
-    )
+    search_filter = None
+    if args.filter:
+        try:
+            search_filter = json.loads(args.filter)
+        except json.JSONDecodeError as e:
+            print(f"Error: invalid --filter JSON: {e}", file=sys.stderr)
+            sys.exit(1)
     
-    # Output JSON to stdout
-    print(json.dumps(result, indent=2, ensure_ascii=False))
-
+    text_cache = open_text_cache_from_args(args, MODEL_NAME)
+    try:
+        if args.queries_file:
+            run_queries_file(args, search_filter, text_cache)
+        else:
+            result = search_images(
+                index_path=args.index,
+                metadata_path=args.metadata,
+                query=args.query,
+                top_k=args.top_k,
+                category_filter=args.category,
+                search_filter=search_filter,
+                text_cache=text_cache
+            )
+            
+            # Output JSON to stdout
+            with profile_stage("output"):
+                print(json.dumps(result, indent=2, ensure_ascii=False))
+    finally:
+        if text_cache is not None:
+            text_cache.close()
+        if args.timings:
+            print_timings()
 
 if __name__ == "__main__":
     main()
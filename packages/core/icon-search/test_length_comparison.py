@@ -7,7 +7,6 @@ Compares short, medium, and longer descriptions for the same spells.
 import os
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
 
-import json
 import sys
 from pathlib import Path
 from typing import List, Dict
@@ -17,6 +16,8 @@ import numpy as np
 import torch
 from transformers import CLIPModel, CLIPProcessor
 
+from artifacts import load_published
+
 MODEL_NAME = "openai/clip-vit-base-patch32"
 
 
@@ -28,18 +29,6 @@ def get_device() -> str:
     return "cpu"
 
 
-def load_metadata(metadata_path: str) -> List[dict]:
-    records = []
-    with open(metadata_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                record = json.loads(line)
-                records.append(record)
-    records.sort(key=lambda x: x['id'])
-    return records
-
-
 def get_text_embedding(
     processor: CLIPProcessor,
     model: CLIPModel,
@@ -62,7 +51,7 @@ def get_text_embedding(
 
 def search_single(
     index: faiss.Index,
-    metadata: List[dict],
+    metadata: Dict[int, dict],
     processor: CLIPProcessor,
     model: CLIPModel,
     query: str,
@@ -74,7 +63,7 @@ def search_single(
     
     results = []
     for score, idx in zip(scores[0], indices[0]):
-        if idx < 0 or idx >= len(metadata):
+        if idx < 0 or idx not in metadata:
             continue
         
         record = metadata[idx]
@@ -100,8 +89,11 @@ def main():
         print(f"Error: Metadata file not found: {metadata_path}", file=sys.stderr)
         sys.exit(1)
     
-    index = faiss.read_index(index_path)
-    metadata = load_metadata(metadata_path)
+    try:
+        index, metadata, _ = load_published(index_path, metadata_path)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
     
     device = get_device()
     print(f"Using device: {device}\n")
@@ -0,0 +1,81 @@
+"""
+ClipSearchEngine.reload against published versions that differ only in
+their metadata (faiss.index byte-identical), e.g. a removed or moved
+image with stable ids.
+"""
+
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import clip_server  # noqa: E402
+from artifacts import new_version_dir  # noqa: E402
+from faiss_index import build_faiss_index, make_index_options  # noqa: E402
+from index_build import write_outputs  # noqa: E402
+
+DIM = 8
+
+
+def publish(out_path: Path, paths):
+    """Publish a flat index of fixed vectors with ids 0..n-1 and the given paths."""
+    vectors = np.eye(DIM, dtype=np.float32)[:len(paths)]
+    index, config = build_faiss_index(vectors, np.arange(len(paths)), make_index_options())
+    files = {
+        path: {"id": record_id, "size": 1, "mtime": 0.0, "sha256": str(record_id), "dhash": 0}
+        for record_id, path in enumerate(paths)
+    }
+    write_outputs(
+        out_path, new_version_dir(out_path), index, config, files,
+        {path: "Ice" for path in paths}
+    )
+
+
+def make_engine(monkeypatch, out_path: Path) -> clip_server.ClipSearchEngine:
+    model = SimpleNamespace(config=SimpleNamespace(projection_dim=DIM))
+    monkeypatch.setattr(clip_server, "load_text_model", lambda: (None, model, "cpu"))
+    return clip_server.ClipSearchEngine(str(out_path / "faiss.index"), str(out_path / "metadata.jsonl"))
+
+
+def search_paths(engine) -> list:
+    job = {"query": "ice", "top_k": 2, "filter": None, "category": None}
+    return [result['path'] for result in engine.search_many([job])[0]['results']]
+
+
+def test_reload_after_metadata_only_rebuild(tmp_path, monkeypatch):
+    publish(tmp_path, ["Ice/img28a.png", "Ice/img28b.png"])
+    engine = make_engine(monkeypatch, tmp_path)
+    first = engine.snapshot
+    assert engine.reload()['reloaded'] is False
+
+    index_bytes = (tmp_path / "faiss.index").read_bytes()
+    publish(tmp_path, ["Ice/img28a.png", "Ice/moved.png"])
+    assert (tmp_path / "faiss.index").read_bytes() == index_bytes
+
+    response = engine.reload()
+    assert response['reloaded'] is True
+    assert response['index_version'] != response['previous_version']
+    assert [record['path'] for _, record in sorted(engine.metadata.items())] == ["Ice/img28a.png", "Ice/moved.png"]
+    assert engine.snapshot is not first
+
+
+def test_result_cache_after_metadata_only_rebuild(tmp_path, monkeypatch):
+    publish(tmp_path, ["Ice/img28a.png", "Ice/img28b.png"])
+    engine = make_engine(monkeypatch, tmp_path)
+    query = np.zeros((1, DIM), dtype=np.float32)
+    query[0, 1] = 1.0
+    monkeypatch.setattr(engine, "_get_text_embeddings", lambda texts: np.repeat(query, len(texts), axis=0))
+    first = engine.snapshot
+    assert search_paths(engine)[0] == "Ice/img28b.png"
+
+    publish(tmp_path, ["Ice/img28a.png", "Ice/moved.png"])
+    assert engine.reload()['reloaded'] is True
+    assert search_paths(engine)[0] == "Ice/moved.png"
+
+    # A batch that started on the old snapshot stores its results after the swap
+    job = {"query": "ice", "top_k": 2, "filter": None, "category": None}
+    engine.result_cache.put(engine._result_key(job, first), [{"path": "Ice/img28b.png"}])
+    assert search_paths(engine)[0] == "Ice/moved.png"
@@ -0,0 +1,219 @@
+"""
+Persistent cache of CLIP text embeddings for the search scripts.
+
+search.py and apply_images_to_spells.py embed the same strings over and
+over (spell visualdescriptions, saved queries). Embeddings are stored in
+a SQLite file next to the image embedding cache (by default
+~/.cache/icon-search/text_embeddings.sqlite), keyed by (normalized text,
+model). Lookups happen before the model is needed, so a run whose
+queries all hit never loads torch or transformers. The file is trimmed
+to --text_cache_mb when closed, evicting the least recently used
+entries first.
+"""
+
+import argparse
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from build_profile import profile_stage
+from embedding_cache import cache_root
+
+
+DEFAULT_TEXT_CACHE_MAX_MB = 256
+# Bound parameters per lookup query (SQLite limits them)
+LOOKUP_CHUNK = 500
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Cache key for a query: NFC, collapsed whitespace, lower case.
+
+    CLIP's tokenizer lower-cases and cleans whitespace itself, so texts
+    that normalize alike get the same embedding.
+    """
+    text = unicodedata.normalize("NFC", text)
+    return _WHITESPACE.sub(" ", text).strip().lower()
+
+
+def default_text_cache_path() -> Path:
+    return cache_root() / "text_embeddings.sqlite"
+
+
+def add_text_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the --text_cache family of options to a search CLI."""
+    parser.add_argument(
+        "--text_cache",
+        type=str,
+        default=str(default_text_cache_path()),
+        help="SQLite file caching query embeddings by text and model (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--text_cache_mb",
+        type=int,
+        default=DEFAULT_TEXT_CACHE_MAX_MB,
+        help=f"Maximum text cache size in MB, least recently used entries are evicted (default: {DEFAULT_TEXT_CACHE_MAX_MB})"
+    )
+    parser.add_argument(
+        "--no_text_cache",
+        action="store_true",
+        help="Neither read nor write the text embedding cache"
+    )
+
+
+def open_text_cache_from_args(args: argparse.Namespace, model_name: str) -> Optional["TextEmbeddingCache"]:
+    if args.no_text_cache:
+        return None
+    return TextEmbeddingCache(args.text_cache, model_name, args.text_cache_mb)
+
+
+class TextEmbeddingCache:
+    """SQLite text embedding cache for one model, safe to share between threads."""
+
+    def __init__(self, path, model_name: str, max_mb: int = DEFAULT_TEXT_CACHE_MAX_MB):
+        self.path = Path(path)
+        self.model_name = model_name
+        self.max_bytes = max_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Concurrent runs may share the file: wait on their writes
+        self._conn = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS text_embeddings (
+                text TEXT NOT NULL,
+                model TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (text, model)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS text_embeddings_last_used ON text_embeddings (last_used)")
+        self._conn.commit()
+
+    def get_many(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        """Look up texts, returning normalized text -> embedding for hits."""
+        found = {}
+        keys = [normalize_text(text) for text in texts]
+        unique = list(dict.fromkeys(keys))
+
+        with self._lock, profile_stage("text_cache_lookup", len(texts)):
+            for start in range(0, len(unique), LOOKUP_CHUNK):
+                chunk = unique[start:start + LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT text, dim, vector FROM text_embeddings "
+                    f"WHERE model = ? AND text IN ({placeholders})",
+                    [self.model_name] + chunk
+                ).fetchall()
+                for text, dim, vector in rows:
+                    embedding = np.frombuffer(vector, dtype=np.float32)
+                    if embedding.shape[0] == dim:
+                        found[text] = embedding
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE text_embeddings SET last_used = ? WHERE text = ? AND model = ?",
+                    [(now, text, self.model_name) for text in found]
+                )
+                self._conn.commit()
+
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, entries: List[Tuple[str, np.ndarray]]) -> None:
+        """Store (text, embedding) entries."""
+        if not entries:
+            return
+        now = time.time()
+        rows = [
+            (
+                normalize_text(text), self.model_name, embedding.shape[0],
+                np.ascontiguousarray(embedding, dtype=np.float32).tobytes(), now
+            )
+            for text, embedding in entries
+        ]
+        with self._lock, profile_stage("text_cache_store", len(rows)):
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO text_embeddings (text, model, dim, vector, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+
+    def embed(self, texts: List[str], compute: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """
+        Embeddings of texts in order, calling compute only for the distinct
+        texts that miss (so the model is only needed on a miss).
+        """
+        found = self.get_many(texts)
+        keys = [normalize_text(text) for text in texts]
+
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            computed = compute(list(missing.values()))
+            self.put_many(list(zip(missing.values(), computed)))
+            found.update(zip(missing, computed))
+
+        return np.stack([found[key] for key in keys]).astype(np.float32)
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM text_embeddings").fetchone()
+        return row[0]
+
+    def evict(self) -> None:
+        """Drop least recently used entries (of any model) until under max size."""
+        excess = self.size_bytes() - self.max_bytes
+        if excess <= 0:
+            return
+
+        with self._lock:
+            keys = []
+            freed = 0
+            cursor = self._conn.execute(
+                "SELECT text, model, LENGTH(vector) FROM text_embeddings ORDER BY last_used"
+            )
+            for text, model, size in cursor:
+                keys.append((text, model))
+                freed += size
+                if freed >= excess:
+                    break
+
+            self._conn.executemany("DELETE FROM text_embeddings WHERE text = ? AND model = ?", keys)
+            self._conn.commit()
+            self._conn.execute("PRAGMA incremental_vacuum")
+            self.evicted += len(keys)
+
+    def close(self) -> None:
+        self.evict()
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,130 @@
+"""
+Alternative CPU backends for the CLIP vision encoder in index_build.py.
+
+    torch       CLIPModel in fp32 (default, any device)
+    onnx        the vision tower exported once to ONNX and run with
+                ONNX Runtime; the export is cached per model under
+                ~/.cache/icon-search/onnx, so later builds skip loading
+                the PyTorch weights entirely
+    torch-int8  PyTorch with dynamic int8 quantization of the Linear
+                layers (CPU only)
+
+onnx and torch-int8 need no GPU. Their embeddings differ slightly from
+fp32, so the embedding cache keys them separately and index_build.py
+reports their cosine agreement with fp32 on a sample (--backend_check).
+onnxruntime and onnx are optional: only the onnx backend imports them.
+"""
+
+import argparse
+import os
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import torch
+from transformers import CLIPModel
+
+from build_profile import profile_stage
+from embedding_cache import cache_root
+
+
+BACKENDS = ("torch", "onnx", "torch-int8")
+DEFAULT_BACKEND = "torch"
+DEFAULT_BACKEND_CHECK = 64
+ONNX_OPSET = 17
+
+# Turns a batch of preprocessed pixels into L2-normalized embeddings
+Encoder = Callable[[torch.Tensor], np.ndarray]
+
+
+def add_backend_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the --backend family of options to a builder CLI."""
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help=f"Inference backend for the vision encoder (default: {DEFAULT_BACKEND})"
+    )
+    parser.add_argument(
+        "--backend_check",
+        type=int,
+        default=DEFAULT_BACKEND_CHECK,
+        help=f"Images compared against fp32 torch before a non-torch build, 0 to skip (default: {DEFAULT_BACKEND_CHECK})"
+    )
+
+
+def backend_cache_key(model_name: str, backend: str) -> str:
+    """Embedding cache model key: non-fp32 backends must not share vectors with torch."""
+    if backend == DEFAULT_BACKEND:
+        return model_name
+    return f"{model_name}#{backend}"
+
+
+def l2_normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = embeddings.astype(np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms = np.where(norms == 0, 1, norms)  # Avoid division by zero
+    return embeddings / norms
+
+
+class VisionTower(torch.nn.Module):
+    """get_image_features() as a plain module, so it can be exported."""
+
+    def __init__(self, model: CLIPModel):
+        super().__init__()
+        self.vision_model = model.vision_model
+        self.visual_projection = model.visual_projection
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        pooled = self.vision_model(pixel_values=pixel_values).pooler_output
+        return self.visual_projection(pooled)
+
+
+def onnx_export_path(model_name: str) -> Path:
+    safe_name = model_name.strip("/").replace("/", "--")
+    return cache_root() / "onnx" / f"{safe_name}-vision-opset{ONNX_OPSET}.onnx"
+
+
+def export_onnx(model: CLIPModel, path: Path, image_size: int) -> None:
+    """Export the vision tower with a dynamic batch axis."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+
+    tower = VisionTower(model.cpu()).eval()
+    dummy = torch.zeros(1, 3, image_size, image_size)
+    with torch.no_grad():
+        torch.onnx.export(
+            tower,
+            (dummy,),
+            str(tmp_path),
+            input_names=["pixel_values"],
+            output_names=["image_embeds"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+            opset_version=ONNX_OPSET,
+            dynamo=False
+        )
+    os.replace(tmp_path, path)
+
+
+def onnx_encoder(path: Path) -> Encoder:
+    """ONNX Runtime session on the CPU, using the torch thread budget."""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = torch.get_num_threads()
+    session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+
+    def encode(pixel_values: torch.Tensor) -> np.ndarray:
+        with profile_stage("forward", len(pixel_values)):
+            outputs = session.run(None, {"pixel_values": pixel_values.cpu().numpy()})
+        with profile_stage("normalize", len(pixel_values)):
+            return l2_normalize(outputs[0])
+
+    return encode
+
+
+def quantize_int8(model: CLIPModel) -> CLIPModel:
+    """Dynamic int8 quantization of the Linear layers (weights int8, activations on the fly)."""
+    return torch.ao.quantization.quantize_dynamic(model.cpu(), {torch.nn.Linear}, dtype=torch.qint8)